@@ -0,0 +1,29 @@
+# Gunicorn settings for serving OpenODS from event loop (gevent) workers, e.g.
+#
+#     gunicorn -c gunicorn_async.py openods:app
+#
+# Each worker runs requests as greenlets, and psycopg2 is made to yield to other greenlets while it waits on the
+# database, so one worker process can hold many requests in flight at once. The routes and handlers are the same
+# as with the default sync workers. Needs the gevent and psycogreen packages, which aren't installed by default.
+import os
+
+from psycogreen.gevent import patch_psycopg
+
+bind = str.format('0.0.0.0:{0}', os.environ.get('PORT', '5000'))
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+# The most requests each worker will hold in flight at once
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '100'))
+
+# A worker now shares its connection pool between many concurrent requests rather than one at a time, so it is
+# given a larger pool unless one has been configured explicitly
+os.environ.setdefault('DATABASE_POOL_MAX_CONNECTIONS', '20')
+
+accesslog = None
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Makes psycopg2 wait for the database through gevent's event loop rather than by blocking the whole process
+    patch_psycopg()
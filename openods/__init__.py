@@ -1,7 +1,12 @@
 __version__ = '0.17'
 
 import logging
+import os
 import re
+import time
+
+# Used to report how long the app takes to start
+_started = time.perf_counter()
 
 # Import flask
 from flask import Flask
@@ -15,11 +20,10 @@ feature_flags = FeatureFlag(app)
 # Load the app configuration from the default_config.py file
 app.config.from_object('openods.default_config')
 
-# We check the version of the database schema that is available to the app
+# The version of the database schema is checked when the first request is handled rather than here, so that
+# starting a worker doesn't wait on (or fail with) the database
 from openods import schema_check
 
-schema_check.check_schema_version()
-
 from openods import routes
 
 # Set up logging
@@ -40,3 +44,9 @@ logger.debug("Logging at DEBUG level")
 # other services can use the API.
 regEx = re.compile(app.config['API_PATH'] + "/*")
 CORS(app, resources={regEx: {"origins": "*"}})
+
+from openods import metrics
+
+startup_time = time.perf_counter() - _started
+metrics.registry.set('openods_startup_seconds', startup_time)
+logger.info(str.format('logType=Startup|pid={0}|startupTimeMs={1:.1f}|', os.getpid(), startup_time * 1000))
@@ -0,0 +1,331 @@
+import bisect
+import datetime
+import logging
+import threading
+import time
+
+from openods import app, dataset
+from openods.snapshot import is_false, is_true, like_to_regex, ordered_keys, sort_key
+
+# Set bits are found a block at a time, so that blocks before the start of a page can be skipped by their count
+BLOCK_BITS = 4096
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+# The columns returned for each organisation, as by the list query
+ROW_COLUMNS = ('odscode', 'name', 'record_class', 'status', 'post_code')
+
+
+# Counts the bits set in a bitmap. int.bit_count (Python 3.10 and later) does so without building a string.
+if hasattr(int, 'bit_count'):
+    def popcount(bitmap):
+        return bitmap.bit_count()
+else:
+    def popcount(bitmap):
+        return bin(bitmap).count('1')
+
+
+def bitmap_from_positions(positions, size):
+    """
+    Builds a bitmap with the given bit positions set
+    """
+    buffer = bytearray((size + 7) // 8)
+
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_bits(bitmap, skip=0):
+    """
+    Yields the positions of the bits set in a bitmap in increasing order, after skipping the first skip of them
+    """
+    position = 0
+
+    while bitmap:
+        block = bitmap & BLOCK_MASK
+        count = popcount(block)
+
+        if skip >= count:
+            skip -= count
+        else:
+            while block:
+                lowest = block & -block
+
+                if skip:
+                    skip -= 1
+                else:
+                    yield position + lowest.bit_length() - 1
+
+                block ^= lowest
+
+        bitmap >>= BLOCK_BITS
+        position += BLOCK_BITS
+
+
+class BitmapIndex(object):
+    """
+    An in-memory filter engine over the organisation list, for the filters which take a handful of values.
+
+    Organisations are numbered by their position when ordered by (name, odscode) in the database, and there is a
+    bitmap for each value of each filter with a bit set for every organisation which has it. A combination of
+    filters is answered by ANDing and ORing bitmaps, its total by counting the bits set, and a page by finding the
+    set bits from the page's starting position in name order.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.size = 0
+        self.rows = []
+        self._keys = None
+        self._positions = {}
+        self._by_record_class = {}
+        self._by_status = {}
+        self._by_role_code = {}
+        self._by_primary_role_code = {}
+        self._legal_end_dates = []
+        self._legally_active = (None, 0, 0)
+        self._legally_active_lock = threading.Lock()
+
+    def load(self, conn):
+        logger = logging.getLogger(__name__)
+        started = time.time()
+
+        cur = conn.cursor()
+
+        cur.execute(str.format("SELECT {0}, legal_end_date "
+                               "FROM organisations "
+                               "ORDER BY name NULLS LAST, odscode;",
+                               ", ".join(ROW_COLUMNS)))
+
+        by_record_class = {}
+        by_status = {}
+        by_odscode = {}
+        keys = []
+
+        for position, row in enumerate(cur):
+            organisation = dict(zip(ROW_COLUMNS, row))
+
+            self.rows.append(organisation)
+            keys.append(sort_key(organisation['name'], organisation['odscode']))
+            self._legal_end_dates.append(row[-1])
+
+            by_odscode[organisation['odscode']] = position
+            by_record_class.setdefault(organisation['record_class'], []).append(position)
+            by_status.setdefault(organisation['status'], []).append(position)
+
+        self.size = len(self.rows)
+        self._positions = by_odscode
+        self._keys = ordered_keys(keys)
+
+        cur.execute("SELECT org_odscode, code, primary_role "
+                    "FROM roles "
+                    "WHERE status = 'Active';")
+
+        by_role_code = {}
+        by_primary_role_code = {}
+
+        for org_odscode, code, primary_role in cur:
+            position = by_odscode.get(org_odscode)
+
+            if position is None:
+                continue
+
+            by_role_code.setdefault(code, []).append(position)
+
+            if primary_role:
+                by_primary_role_code.setdefault(code, []).append(position)
+
+        self._by_record_class = self._bitmaps(by_record_class)
+        self._by_status = self._bitmaps(by_status)
+        self._by_role_code = self._bitmaps(by_role_code)
+        self._by_primary_role_code = self._bitmaps(by_primary_role_code)
+
+        logger.info(str.format('Built bitmap index for dataset version {0}|organisations={1}|bitmaps={2}|'
+                               'loadTime={3:.2f}s|',
+                               self.version, self.size,
+                               sum(len(bitmaps) for bitmaps in (self._by_record_class, self._by_status,
+                                                                self._by_role_code, self._by_primary_role_code)),
+                               time.time() - started))
+
+        return self
+
+    def _bitmaps(self, positions_by_value):
+        return {value: bitmap_from_positions(positions, self.size) for value, positions in positions_by_value.items()}
+
+    @staticmethod
+    def supports(query=None, postcode=None, last_updated_since=None):
+        """
+        Returns True if the index can answer a combination of filters. Searches of the name and postcode, and the
+        last change date, aren't indexed.
+        """
+        return not (query or postcode or last_updated_since)
+
+    def _legally_active_bitmaps(self):
+        """
+        Returns bitmaps of the organisations which are legally active today and of those which are not. They are
+        built on first use each day, as an organisation stops being legally active on its legal end date.
+        """
+        today = datetime.date.today()
+
+        with self._legally_active_lock:
+            built, active, ended = self._legally_active
+
+            if built != today:
+                ended_positions = [position for position, legal_end_date in enumerate(self._legal_end_dates)
+                                   if legal_end_date is not None and legal_end_date <= today]
+
+                ended = bitmap_from_positions(ended_positions, self.size)
+                active = ((1 << self.size) - 1) & ~ended
+                self._legally_active = (today, active, ended)
+
+        return active, ended
+
+    def match(self, recordclass=None, primary_role_code_list=None, role_code_list=None, active=None,
+              legally_active=None):
+        """
+        Returns a bitmap of the organisations matching the filters, which are applied in the same way as the list
+        query in db.get_org_list
+        """
+        bitmap = (1 << self.size) - 1
+
+        if recordclass:
+            if '%' in recordclass or '_' in recordclass:
+                regex = like_to_regex(recordclass)
+                matching = 0
+
+                for value, value_bitmap in self._by_record_class.items():
+                    if value is not None and regex.fullmatch(value):
+                        matching |= value_bitmap
+
+                bitmap &= matching
+            else:
+                bitmap &= self._by_record_class.get(recordclass, 0)
+
+        if active:
+            bitmap &= self._by_status.get('Active' if is_true(active) else 'Inactive', 0)
+
+        if legally_active and (is_true(legally_active) or is_false(legally_active)):
+            legally_active_bitmap, ended_bitmap = self._legally_active_bitmaps()
+            bitmap &= legally_active_bitmap if is_true(legally_active) else ended_bitmap
+
+        if role_code_list:
+            matching = 0
+
+            for code in role_code_list:
+                matching |= self._by_role_code.get(code, 0)
+
+            bitmap &= matching
+
+        elif primary_role_code_list:
+            matching = 0
+
+            for code in primary_role_code_list:
+                matching |= self._by_primary_role_code.get(code, 0)
+
+            bitmap &= matching
+
+        return bitmap
+
+    def _position_after(self, after):
+        """
+        Returns the position of the first organisation after the (name, odscode) of a cursor, or None if it can't be
+        found
+        """
+        name, odscode = after
+        position = self._positions.get(odscode)
+
+        if position is not None and self.rows[position]['name'] == name:
+            return position + 1
+
+        # The record the cursor was taken from is no longer in the dataset, so find where it would have been. This
+        # can only be done if the database orders names by code point.
+        if self._keys is None:
+            return None
+
+        return bisect.bisect_right(self._keys, sort_key(name, odscode))
+
+    def find_organisations(self, offset=0, limit=20, after=None, **filters):
+        """Filters the organisations in the same way as the list query in db.get_org_list
+
+        Returns
+        -------
+        Tuple of the page of organisation rows (as dicts) and the total number of organisations matching the filter,
+        or None if the organisation a cursor was taken from is no longer in the dataset and its place can't be found
+        """
+        start = None
+
+        if after:
+            start = self._position_after(after)
+
+            if start is None:
+                return None
+
+        bitmap = self.match(**filters)
+        count = popcount(bitmap)
+
+        if after:
+            # Clear the bits of the organisations up to and including the last one on the previous page
+            bitmap &= ~((1 << start) - 1)
+            offset = 0
+
+        rows = []
+
+        for position in iter_bits(bitmap, int(offset)):
+            if len(rows) >= int(limit):
+                break
+
+            rows.append(dict(self.rows[position]))
+
+        return rows, count
+
+    def count_facets(self, facets, **filters):
+        """
+        Counts the organisations matching the filter by each value of the facets named, in the same way as
+        db.get_org_facets
+        """
+        bitmap = self.match(**filters)
+
+        facet_bitmaps = {
+            'recordClass': self._by_record_class,
+            'status': self._by_status,
+            'primaryRoleCode': self._by_primary_role_code,
+        }
+
+        counts = {}
+
+        for facet in facets:
+            value_counts = {value: popcount(bitmap & value_bitmap)
+                            for value, value_bitmap in facet_bitmaps[facet].items()}
+
+            # Organisations without an active primary role are counted under null
+            if facet == 'primaryRoleCode':
+                with_primary_role = 0
+
+                for value_bitmap in facet_bitmaps[facet].values():
+                    with_primary_role |= value_bitmap
+
+                value_counts[None] = popcount(bitmap & ~with_primary_role)
+
+            counts[facet] = {value: count for value, count in value_counts.items() if count}
+
+        return counts
+
+
+_indexes = dataset.VersionedIndex(BitmapIndex, 'bitmap index')
+
+
+def get_bitmap_index():
+    """
+    Returns the bitmap index of the current dataset, or None if the index is disabled or hasn't been built yet
+    """
+    if not app.config['BITMAP_INDEX_ENABLED']:
+        return None
+
+    return _indexes.get()
+
+
+@app.before_first_request
+def load_bitmap_index():
+    if app.config['BITMAP_INDEX_ENABLED']:
+        _indexes.reload()
@@ -1,22 +1,203 @@
+import collections
+import functools
 import logging
+import threading
+import time
 import urllib.parse
 from flask_cacheify import init_cacheify
 
-from openods import app
-from flask import request, g
+from openods import app, dataset, metrics, serializer
+from flask import request, g, make_response, Response
 
 cache = init_cacheify(app)
 
+_stats = {
+    'local': {'hits': 0, 'misses': 0},
+    'shared': {'hits': 0, 'misses': 0},
+}
 
-def generate_cache_key():
+
+class LocalCache(object):
+    """
+    A bounded, in-process LRU cache which sits in front of the shared cache. Entries are evicted, least recently
+    used first, once the total size of the cached response bodies goes over max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+
+            if item is None:
+                return None
+
+            expires, entry = item
+
+            if expires < time.time():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, timeout):
+        size = entry_size(entry)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.time() + timeout, entry)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, entry = self._entries.pop(key)
+        self.size -= entry_size(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalCache(app.config['LOCAL_CACHE_MAX_BYTES'])
+
+
+def generate_cache_key(version=None):
 
     logger = logging.getLogger(__name__)
 
     args = request.args
-    key = request.path + '?' + urllib.parse.urlencode([
-        (k, v) for k in sorted(args) for v in sorted(args.getlist(k))
-    ])
+
+    # Keys are namespaced by the dataset version so that importing a new dataset stops the old responses being
+    # served, without having to wait for them to expire or clear the cache. The representation is included as
+    # XHR requests are answered with compact JSON rather than pretty printed.
+    query_string = urllib.parse.urlencode([(k, v) for k in sorted(args) for v in sorted(args.getlist(k))])
+    key = str.format('{0}:{1}:{2}?{3}',
+                     version or dataset.current_version(), serializer.representation(), request.path, query_string)
 
     logger.debug(str.format('requestId="{0}"|cacheKey={1}|', g.request_id, key))
 
     return key
+
+
+# Responses are cached as a tuple of (status code, headers, body) rather than as a pickled Response object, so
+# they are cheap to store and rebuild
+def entry_from_response(response):
+    headers = [(k, v) for k, v in response.headers.items() if k != 'Content-Length']
+    return response.status_code, headers, response.get_data()
+
+
+def response_from_entry(entry):
+    status_code, headers, body = entry
+    return Response(body, status=status_code, headers=headers)
+
+
+def entry_size(entry):
+    status_code, headers, body = entry
+    return len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+def get_cache_stats():
+    """
+    Returns the hit and miss counts for each cache tier in this worker process
+    """
+    stats = {tier: dict(counts) for tier, counts in _stats.items()}
+    stats['local']['entries'] = len(local_cache)
+    stats['local']['bytes'] = local_cache.size
+    return stats
+
+
+def get_previous_entry(timeout):
+    """
+    Returns the response cached for the current request under the previous dataset version, if the delta import
+    since then didn't change the organisation named in the request, and copies it to the current version's key.
+    Otherwise returns None.
+    """
+    previous_version = dataset.previous_version_for(request.view_args['ods_code'])
+
+    if previous_version is None:
+        return None
+
+    previous_key = generate_cache_key(previous_version)
+    entry = local_cache.get(previous_key) or cache.get(previous_key)
+
+    if entry is not None:
+        key = generate_cache_key()
+        cache.set(key, entry, timeout=timeout)
+        local_cache.set(key, entry, timeout)
+
+    return entry
+
+
+def cached(timeout, per_organisation=False):
+    """
+    Caches successful responses from the decorated function, first in the worker's local cache and then in the
+    shared cache. The cache key is taken from the current request by generate_cache_key.
+
+    per_organisation marks responses which only depend on the organisation named by the ods_code URL parameter.
+    These are carried over from the previous dataset version when a delta import hasn't changed the organisation.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not app.config['RESPONSE_CACHE_ENABLED']:
+                metrics.record_cache('disabled')
+                return f(*args, **kwargs)
+
+            logger = logging.getLogger(__name__)
+
+            key = generate_cache_key()
+
+            entry = local_cache.get(key)
+
+            if entry is not None:
+                _stats['local']['hits'] += 1
+                metrics.record_cache('local-hit')
+                logger.debug(str.format('requestId="{0}"|cacheTier=local|cacheHit=True|', g.request_id))
+                return response_from_entry(entry)
+
+            _stats['local']['misses'] += 1
+            entry = cache.get(key)
+
+            if entry is not None:
+                _stats['shared']['hits'] += 1
+                metrics.record_cache('shared-hit')
+                logger.debug(str.format('requestId="{0}"|cacheTier=shared|cacheHit=True|', g.request_id))
+                local_cache.set(key, entry, timeout)
+                return response_from_entry(entry)
+
+            _stats['shared']['misses'] += 1
+
+            if per_organisation:
+                entry = get_previous_entry(timeout)
+
+                if entry is not None:
+                    metrics.record_cache('carried-over')
+                    logger.debug(str.format('requestId="{0}"|cacheTier=previousVersion|cacheHit=True|',
+                                            g.request_id))
+                    return response_from_entry(entry)
+
+            metrics.record_cache('miss')
+
+            response = make_response(f(*args, **kwargs))
+
+            if response.status_code == 200:
+                entry = entry_from_response(response)
+                cache.set(key, entry, timeout=timeout)
+                local_cache.set(key, entry, timeout)
+
+            return response
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,79 @@
+import functools
+import hashlib
+import logging
+
+from flask import request, g, make_response
+
+from openods import app, dataset, metrics, request_utils
+from openods import cache as ocache
+
+
+def get_etag():
+    """
+    Returns the entity tag for the requested resource. Resources only change when a new dataset is imported, so
+    the tag is derived from the dataset version, the representation of the response and the request path and
+    parameters, without touching the data.
+    """
+    return hashlib.md5(ocache.generate_cache_key().encode('utf-8')).hexdigest()
+
+
+def is_not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since when a client sends both
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+
+    return False
+
+
+def add_validators(response, etag, last_modified):
+    response.set_etag(etag)
+
+    # The body is pretty printed unless the request was made by XHR, so shared caches must store both
+    response.vary.add('X-Requested-With')
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    response.headers['Cache-Control'] = str.format('public, max-age={0}', app.config['CACHE_CONTROL_MAX_AGE'])
+
+    return response
+
+
+def conditional(f):
+    """
+    Adds an ETag, Last-Modified and Cache-Control headers to successful responses from the decorated route, and
+    answers conditional requests for a resource the client already holds with a 304 before the route is called
+    """
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        request_utils.get_request_id(request)
+        request_utils.get_source_ip(request)
+
+        etag = get_etag()
+        last_modified = dataset.current_import_time()
+
+        if is_not_modified(etag, last_modified):
+            logger = logging.getLogger(__name__)
+            logger.info('logType=Request|requestId="{request_id}"|statusCode={status_code}|path="{path}"|'
+                        'sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                            request_id=g.request_id,
+                            source_ip=g.source_ip,
+                            path=request.path,
+                            url=request.url,
+                            status_code=304,
+                            timings=metrics.format_request_timings())
+                        )
+
+            return add_validators(make_response('', 304), etag, last_modified)
+
+        response = make_response(f(*args, **kwargs))
+
+        if response.status_code == 200:
+            add_validators(response, etag, last_modified)
+
+        return response
+
+    return decorated_function
@@ -1,5 +1,8 @@
+import contextlib
 import logging
+import os
 import sys
+import threading
 from urllib.parse import urlparse as urlparse
 
 import psycopg2
@@ -7,30 +10,130 @@ import psycopg2.extras
 import psycopg2.pool
 from flask import g
 
-from openods import app
+from openods import app, metrics, request_utils
 
 url = urlparse(app.config['DATABASE_URL'])
 
+# The pool is created lazily so that each gunicorn worker builds its own after forking
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+_pool_stats = {
+    'checkouts': 0,
+    'exhausted': 0,
+}
+
+
+def get_pool():
+    global _pool, _pool_pid, _pool_slots
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                app.config['DATABASE_POOL_MIN_CONNECTIONS'],
+                app.config['DATABASE_POOL_MAX_CONNECTIONS'],
+                database=url.path[1:],
+                user=url.username,
+                password=url.password,
+                host=url.hostname,
+                port=url.port,
+                connection_factory=metrics.TimedConnection
+            )
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(app.config['DATABASE_POOL_MAX_CONNECTIONS'])
+
+            logger = logging.getLogger(__name__)
+            logger.debug('Created connection pool for {db_url}|minConnections={min}|maxConnections={max}|'.format(
+                db_url=app.config['DATABASE_URL'],
+                min=app.config['DATABASE_POOL_MIN_CONNECTIONS'],
+                max=app.config['DATABASE_POOL_MAX_CONNECTIONS']))
+
+    return _pool
+
+
+def get_pool_stats():
+    """
+    Returns a snapshot of the connection pool usage for this worker process
+    """
+    stats = dict(_pool_stats)
+    stats['maxConnections'] = app.config['DATABASE_POOL_MAX_CONNECTIONS']
+    stats['inUse'] = len(_pool._used) if _pool is not None and _pool_pid == os.getpid() else 0
+    return stats
+
+
+def checkout_connection(request_id=None):
+    """
+    Takes a connection from the pool, waiting for one to become free if they are all in use. Connections taken
+    with this method must be handed back with checkin_connection.
+    """
+    logger = logging.getLogger(__name__)
+
+    pool = get_pool()
+
+    # Wait for a free slot in the pool rather than failing straight away when all connections are in use
+    if not _pool_slots.acquire(timeout=app.config['DATABASE_POOL_WAIT_TIMEOUT']):
+        _pool_stats['exhausted'] += 1
+        logger.warning('requestId="{request_id}"|Connection pool exhausted|waitTimeout={timeout}|'
+                       '{stats}'.format(request_id=request_id,
+                                        timeout=app.config['DATABASE_POOL_WAIT_TIMEOUT'],
+                                        stats=request_utils.dict_to_piped_kv_pairs(get_pool_stats())))
+        raise psycopg2.pool.PoolError('connection pool exhausted')
+
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+    _pool_stats['checkouts'] += 1
+
+    return conn
+
+
+def checkin_connection(conn):
+    try:
+        # Connections that have been closed (e.g. by a server restart) are discarded rather than re-used
+        _pool.putconn(conn, close=conn.closed != 0)
+    finally:
+        _pool_slots.release()
+
+
+@contextlib.contextmanager
+def borrow_connection():
+    """
+    Lends a pooled connection for work done outside of a request, such as in a background thread
+    """
+    conn = checkout_connection()
+    try:
+        yield conn
+    finally:
+        checkin_connection(conn)
+
 
 def get_connection():
+    # Re-use the connection already checked out for this request, if there is one
+    conn = g.get('db_conn')
+    if conn is not None:
+        return conn
+
+    logger = logging.getLogger(__name__)
+
     try:
-        conn = psycopg2.connect(
-            database=url.path[1:],
-            user=url.username,
-            password=url.password,
-            host=url.hostname,
-            port=url.port
-        )
-        
-        logger = logging.getLogger(__name__)
+        conn = checkout_connection(g.request_id)
+        g.db_conn = conn
+
         logger.debug('requestId="{request_id}"|Connected to {db_url}'.format(db_url=app.config['DATABASE_URL'],
                                                                              request_id=g.request_id))
-    
+
+    except psycopg2.pool.PoolError:
+        raise
+
     except psycopg2.Error:
-        logger = logging.getLogger(__name__)
         logger.critical("Unable to connect to the database on {db_url}".format(db_url=app.config['DATABASE_URL']))
         sys.exit(1)
-    
+
     return conn
 
 
@@ -38,3 +141,14 @@ def get_cursor():
     conn = get_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     return cur
+
+
+# Returns the request's connection (if one was checked out) to the pool once the request has finished
+@app.teardown_appcontext
+def release_connection(exception=None):
+    conn = g.pop('db_conn', None)
+
+    if conn is None:
+        return
+
+    checkin_connection(conn)
@@ -0,0 +1,235 @@
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from openods import app, connection as connect
+
+# The version of the dataset last read from the database, when it was imported and when it was read
+_version = None
+_imported_at = None
+_version_checked_at = 0
+_version_lock = threading.Lock()
+
+# The version the current one was produced from by a delta import, and the ODS codes that import changed
+_previous_version = None
+_changed_odscodes = None
+
+# The version given to a database whose versions table is empty, so that there is still a namespace for cache keys
+UNVERSIONED = 'unversioned'
+
+
+def read_dataset_version(cur):
+    """
+    Reads the latest row of the versions table, returning a tuple of the version identifier (see
+    get_dataset_version) and the time the dataset was imported, or (UNVERSIONED, None) if there isn't one
+    """
+    cur.execute("SELECT version_ref, import_timestamp "
+                "FROM versions "
+                "ORDER BY version_ref DESC "
+                "LIMIT 1;")
+
+    row = cur.fetchone()
+
+    if row is None:
+        return UNVERSIONED, None
+
+    # Works with both plain tuple cursors and the RealDictCursor
+    if isinstance(row, dict):
+        row = (row['version_ref'], row['import_timestamp'])
+
+    version = hashlib.md5(str.format('{0}:{1}', *row).encode('utf-8')).hexdigest()[:16]
+
+    return version, parse_import_timestamp(row[1])
+
+
+def parse_import_timestamp(import_timestamp):
+    """
+    Converts the import timestamp recorded in the versions table to a datetime, or None if it isn't recognised
+    """
+    for timestamp_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(import_timestamp, timestamp_format)
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+def get_dataset_version(cur):
+    """
+    Reads an identifier for the dataset currently in the database, which changes whenever a new file is imported.
+    The identifier is a short hex digest so that it is safe to use in cache keys and ETags.
+    """
+    return read_dataset_version(cur)[0]
+
+
+def read_changed_odscodes(cur, version):
+    """
+    Reads the organisations changed by the delta import which produced a dataset version (see
+    openods.delta_import), returning a tuple of the version it was imported over and the set of ODS codes
+    changed, or (None, None) if the version wasn't produced by a delta import
+    """
+    # The table is added by a migration, which may not have been applied
+    cur.execute("SELECT to_regclass('organisation_changes') IS NOT NULL AS present;")
+    row = cur.fetchone()
+
+    if not (row['present'] if isinstance(row, dict) else row[0]):
+        return None, None
+
+    cur.execute("SELECT previous_version, odscode "
+                "FROM organisation_changes "
+                "WHERE dataset_version = %s;",
+                (version,))
+
+    rows = [(row['previous_version'], row['odscode']) if isinstance(row, dict) else row for row in cur.fetchall()]
+
+    if not rows:
+        return None, None
+
+    return rows[0][0], {odscode for _, odscode in rows}
+
+
+def current_version():
+    """
+    Returns the version of the dataset being served.
+
+    The version is only read from the database once every DATASET_VERSION_CHECK_INTERVAL seconds, so this is cheap
+    enough to call on every request. Must be called from within a request.
+    """
+    _refresh()
+    return _version
+
+
+def current_import_time():
+    """
+    Returns the time at which the dataset being served was imported, or None if it isn't known.
+    Must be called from within a request.
+    """
+    _refresh()
+    return _imported_at
+
+
+def previous_version_for(odscode):
+    """
+    Returns the previous version of the dataset if the current one was produced from it by a delta import which
+    didn't change the organisation with the given ODS code, so anything cached about the organisation under the
+    previous version is still correct. Otherwise returns None. Must be called from within a request.
+    """
+    _refresh()
+
+    if _changed_odscodes is None or str.upper(odscode) in _changed_odscodes:
+        return None
+
+    return _previous_version
+
+
+def _refresh():
+    global _version, _imported_at, _version_checked_at, _previous_version, _changed_odscodes
+
+    now = time.time()
+
+    if now - _version_checked_at > app.config['DATASET_VERSION_CHECK_INTERVAL']:
+        with _version_lock:
+            if now - _version_checked_at > app.config['DATASET_VERSION_CHECK_INTERVAL']:
+                cur = connect.get_cursor()
+                version, imported_at = read_dataset_version(cur)
+
+                if version != _version:
+                    logger = logging.getLogger(__name__)
+                    logger.info(str.format('Dataset version is {0}', version))
+
+                    _previous_version, _changed_odscodes = read_changed_odscodes(cur, version)
+
+                _version = version
+                _imported_at = imported_at
+                _version_checked_at = now
+
+
+class VersionedIndex(object):
+    """
+    Holds an in-memory structure built from the dataset, such as the snapshot, and rebuilds it when a new dataset is
+    imported. The structure is replaced as a whole, so readers holding a reference to the old one can carry on using
+    it while the new one is built.
+
+    build is called with the dataset version and returns an object whose load(conn) method reads the dataset and
+    returns the loaded object, which must have a version attribute. description names it in log messages.
+    """
+
+    def __init__(self, build, description):
+        self.build = build
+        self.description = description
+        self.current = None
+        self._lock = threading.Lock()
+        self._rebuilding_for = None
+
+    def get(self, wait=False):
+        """
+        Returns the structure built from the current dataset, or None if there isn't one. If wait is True, builds
+        it first if there isn't one.
+
+        Responses are cached under the current version, so a structure built from an older dataset is never
+        returned. Without wait, a new one is built in the background and None is returned until it's ready, so that
+        the caller can read from the database instead.
+        """
+        version = current_version()
+        current = self.current
+
+        if current is not None and current.version == version:
+            return current
+
+        if wait:
+            self.reload(wait=True)
+
+            # The database is read again when building, so the structure may be from a newer dataset than the
+            # version last checked, but never an older one
+            return self.current
+
+        if self._rebuilding_for != version and not self._lock.locked():
+            self._rebuilding_for = version
+            threading.Thread(target=self._rebuild, name=str.format('{0}-reload', self.description.replace(' ', '-')),
+                             daemon=True).start()
+
+        return None
+
+    def _rebuild(self):
+        if not self.reload():
+            # Allows the next request to try again
+            self._rebuilding_for = None
+
+    def reload(self, wait=False):
+        """
+        Builds the structure from the current dataset and swaps it in for the one being served. If another thread is
+        already building one, does nothing, or if wait is True waits for it to finish instead. Returns False if the
+        build failed.
+
+        Errors are logged. When waiting, they are raised as well, as the caller has nothing to serve.
+        """
+        if not self._lock.acquire(blocking=wait):
+            return True
+
+        logger = logging.getLogger(__name__)
+
+        try:
+            with connect.borrow_connection() as conn:
+                try:
+                    version = get_dataset_version(conn.cursor())
+
+                    if self.current is None or version != self.current.version:
+                        self.current = self.build(version).load(conn)
+                finally:
+                    conn.rollback()
+
+        except Exception:
+            logger.error(str.format('Unable to build {0} of the dataset', self.description), exc_info=True)
+
+            if wait:
+                raise
+
+            return False
+
+        finally:
+            self._lock.release()
+
+        return True
@@ -6,7 +6,10 @@ import psycopg2
 import psycopg2.extras
 import psycopg2.pool
 
-from openods import app, connection as connect
+from openods import app, bitmap_index, connection as connect, queries, query_builder, snapshot
+
+# Whether the pg_trgm extension used to rank search results by relevance is installed. It is checked on first use.
+_trigram_search_available = None
 
 
 def remove_none_values_from_dictionary(dirty_dict):
@@ -47,10 +50,115 @@ def ping_database():
         return False
     
 
+def build_org_list_filter(recordclass=None, primary_role_code_list=None, role_code_list=None,
+                          query=None, postcode=None, active=None, last_updated_since=None,
+                          legally_active=None):
+    """Builds the WHERE clause used to filter the list of organisations
+
+    The same clause is used by every statement that works over the filtered list (the page itself, its total
+    count and any estimate of that count) so that they can't drift apart.
+
+    Returns
+    -------
+    Tuple of the SQL for the WHERE clause and a tuple of the parameters it references
+    """
+    where = query_builder.org_list_filter(recordclass, primary_role_code_list, role_code_list, query, postcode,
+                                          active, last_updated_since, legally_active)
+
+    return where.sql, tuple(where.params)
+
+
+def count_org_list(cur, where):
+    """
+    Counts every organisation matched by a filter from query_builder.org_list_filter
+    """
+    query_builder.execute(cur, query_builder.org_list_count(where))
+    return cur.fetchone()['count']
+
+
+def estimate_org_list_count(cur, where):
+    """
+    Returns the planner's estimate of the number of organisations matched by a filter from
+    query_builder.org_list_filter, which is much cheaper than counting them for broad filters
+    """
+    # EXPLAIN can't be prepared, and only needs planning anyway
+    query_builder.execute(cur, query_builder.org_list_estimate(where), prepare=False)
+    plan = cur.fetchone()['QUERY PLAN']
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def query_org_list(offset, limit, recordclass, primary_role_code_list, role_code_list,
+                   query, postcode, active, last_updated_since, legally_active, after,
+                   count_mode, order_by_relevance):
+    """Runs the list query for get_org_list against the database
+
+    Returns
+    -------
+    Tuple of the page of organisation rows and the total number of organisations matching the filter
+    """
+    
+    logger = logging.getLogger(__name__)
+    
+    conn = connect.get_connection()
+    
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    
+    where = query_builder.org_list_filter(recordclass, primary_role_code_list, role_code_list, query, postcode,
+                                          active, last_updated_since, legally_active)
+    
+    # When paging by offset an exact total can be counted alongside the page itself, saving a separate scan.
+    # A window count can't be used when resuming from a cursor as it would only count the records after it.
+    count_in_page = count_mode == 'exact' and not after
+    
+    page = query_builder.org_list_page(where, offset, limit, after, count_in_page,
+                                       query if order_by_relevance else None)
+    
+    logger.debug(page.sql)
+    
+    # Execute the main query
+    query_builder.execute(cur, page)
+    rows = cur.fetchall()
+    
+    logger.debug(str.format("{0} results", len(rows)))
+    
+    if count_in_page and rows:
+        count = rows[0]['total_count']
+    elif count_mode == 'estimate':
+        count = estimate_org_list_count(cur, where)
+    elif count_mode == 'none':
+        count = None
+    elif count_in_page and int(offset) == 0:
+        # An empty first page means nothing matched the filter
+        count = 0
+    else:
+        count = count_org_list(cur, where)
+    
+    return rows, count
+
+
+def trigram_search_available():
+    """
+    Returns True if the pg_trgm extension is installed, so that search results can be ranked by relevance. The
+    extension is added by migration 002, which needs a superuser before Postgres 13 and so may not have been applied.
+    """
+    global _trigram_search_available
+
+    if _trigram_search_available is None:
+        cur = connect.get_cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS present;")
+        _trigram_search_available = cur.fetchone()['present']
+
+        if not _trigram_search_available:
+            logger = logging.getLogger(__name__)
+            logger.warning('The pg_trgm extension is not installed, so sort=relevance results are ordered by name')
+
+    return _trigram_search_available
+
+
 def get_org_list(offset=0, limit=20, recordclass='both',
                  primary_role_code_list=None, role_code_list=None,
                  query=None, postcode=None, active=True, last_updated_since=None,
-                 legally_active=None):
+                 legally_active=None, after=None, count_mode='exact', order_by_relevance=False):
     """Retrieves a list of organisations
 
     Parameters
@@ -65,10 +173,14 @@ def get_org_list(offset=0, limit=20, recordclass='both',
     active = filter organisations by their status (active / inactive)
     last_changed_since = filter organisations by their lastUpdated date
     legally_active = filter organisations to exclude those with legal end date prior to now
+    after = (name, odscode) of the last record of the previous page, used instead of offset to resume paging
+    count_mode = how the total is calculated: 'exact', 'estimate' (from the query planner) or 'none' (skipped)
+    order_by_relevance = order by how closely the name matches the search term, rather than alphabetically
 
     Returns
     -------
-    List of organisations filtered by provided parameters
+    Tuple of the page of organisations filtered by provided parameters, the total number of organisations matching
+    the filter (None if count_mode is 'none'), and whether the total is an estimate
     """
     
     logger = logging.getLogger(__name__)
@@ -76,221 +188,608 @@ def get_org_list(offset=0, limit=20, recordclass='both',
     if int(limit) > 1000:
         limit = 1000
     
-    conn = connect.get_connection()
+    # Without pg_trgm there is nothing to rank by relevance, so the results are ordered by name as usual
+    if order_by_relevance and not trigram_search_available():
+        order_by_relevance = False
     
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    # Serve the list from the in-memory bitmap index or snapshot of the dataset if there is one. Neither holds the
+    # trigram similarities needed to rank by relevance, so those searches always go to the database.
+    bitmaps = bitmap_index.get_bitmap_index()
+    snap = snapshot.get_snapshot()
+    found = None
     
-    # TODO: Sort out this slightly dodgy code for filtering by record class.
-    # Statement below doesn't look like it's actually using the filtered value...
+    if bitmaps is not None and not order_by_relevance and bitmaps.supports(query, postcode, last_updated_since):
+        logger.debug("Filtering organisations using bitmap index")
+        found = bitmaps.find_organisations(offset, limit, after, recordclass=recordclass,
+                                           primary_role_code_list=primary_role_code_list,
+                                           role_code_list=role_code_list, active=active,
+                                           legally_active=legally_active)
+    elif snap is not None and not order_by_relevance:
+        logger.debug("Filtering organisations using snapshot")
+        found = snap.find_organisations(offset, limit, recordclass, primary_role_code_list,
+                                        role_code_list, query, postcode, active, last_updated_since,
+                                        legally_active, after)
     
-    record_class_param = '%' if recordclass == 'both' else recordclass
+    # The in-memory copies can't resume from a cursor taken from an organisation which has since been removed
+    # unless the database orders names by code point, so those pages are read from the database instead
+    if found is not None:
+        rows, count = found
+        
+        # The in-memory copies count exactly as cheaply as they could estimate
+        if count_mode == 'none':
+            count = None
+        elif count_mode == 'estimate':
+            count_mode = 'exact'
+    else:
+        rows, count = query_org_list(offset, limit, recordclass, primary_role_code_list, role_code_list,
+                                     query, postcode, active, last_updated_since, legally_active, after,
+                                     count_mode, order_by_relevance)
     
-    # Start the select statement with the field list and from clause
-    sql = "SELECT odscode, name, record_class, status, post_code " \
-          "FROM organisations " \
-          "WHERE TRUE "
+    result = [format_org_list_item(row) for row in rows]
     
-    sql_count = "SELECT COUNT(*) FROM organisations WHERE TRUE "
+    # Return both the paged results and the count of total results
+    return result, count, count_mode == 'estimate'
+
+
+def format_org_list_item(row):
+    """
+    Formats an organisation row as an item of the organisation list
+    """
+    link_self_href = str.format('{0}/organisations/{1}',
+                                app.config['APP_HOSTNAME'],
+                                row['odscode'])
+
+    return {
+        'postCode': row['post_code'],
+        'odsCode': row['odscode'],
+        'name': row['name'],
+        'recordClass': row['record_class'],
+        'status': row['status'],
+        'links': [{
+            'rel': 'self',
+            'href': link_self_href
+        }]
+    }
+
+
+def get_org_facets(facets, odscodes=None, recordclass=None, primary_role_code_list=None, role_code_list=None,
+                   query=None, postcode=None, active=None, last_updated_since=None, legally_active=None):
+    """Counts the organisations matching the list filters by each value of the facets named
+
+    Parameters
+    ----------
+    facets = names of the facets to count by, from recordClass, status and primaryRoleCode
+    odscodes = restricts the count to these organisations, e.g. those near a postcode
+    the filters are as for get_org_list
+
+    Returns
+    -------
+    Dictionary of facet name to a list of {'value', 'count'} for each value, largest count first
+    """
+
+    filters = (recordclass, primary_role_code_list, role_code_list, query, postcode, active, last_updated_since,
+               legally_active)
+
+    bitmaps = bitmap_index.get_bitmap_index()
+    snap = snapshot.get_snapshot()
+
+    if bitmaps is not None and odscodes is None and bitmaps.supports(query, postcode, last_updated_since):
+        counts = bitmaps.count_facets(facets, recordclass=recordclass,
+                                      primary_role_code_list=primary_role_code_list,
+                                      role_code_list=role_code_list, active=active, legally_active=legally_active)
+
+    elif snap is not None and odscodes is None:
+        counts = snap.count_facets(facets, *filters)
+
+    else:
+        where = query_builder.org_list_filter(*filters)
+
+        if odscodes is not None:
+            where.add("AND odscode = ANY(%s)", list(odscodes))
+
+        facet_names = [facet for facet, _ in query_builder.FACET_COLUMNS if facet in facets]
+
+        cur = connect.get_cursor()
+        query_builder.execute(cur, query_builder.org_list_facets(where, facet_names))
+
+        counts = {facet: {} for facet in facet_names}
+
+        for row in cur.fetchall():
+            for number, facet in enumerate(facet_names):
+                if row[str.format('grouped_{0}', number)] == 0:
+                    counts[facet][row[str.format('value_{0}', number)]] = row['count']
+
+    return {
+        facet: [{'value': value, 'count': count}
+                for value, count in sorted(value_counts.items(),
+                                           key=lambda item: (-item[1], item[0] is None, item[0] or ''))]
+        for facet, value_counts in counts.items()
+    }
+
+
+def get_org_list_near(nearby, offset=0, limit=20, recordclass=None, primary_role_code_list=None,
+                      role_code_list=None, query=None, postcode=None, active=None, last_updated_since=None,
+                      legally_active=None):
+    """Retrieves a list of organisations near a location, nearest first
+
+    Parameters
+    ----------
+    nearby = list of (odscode, distance in km) of the organisations within range, from geo.LocationIndex.near
+    offset, limit and the filters are as for get_org_list
+
+    Returns
+    -------
+    Tuple of the page of organisations, each with its distance, and the total number matching the filters
+    """
+
+    logger = logging.getLogger(__name__)
+
+    if int(limit) > 1000:
+        limit = 1000
+
+    if not nearby:
+        return [], 0
+
+    distances = dict(nearby)
+
+    filter_sql, filter_data = build_org_list_filter(recordclass, primary_role_code_list, role_code_list,
+                                                    query, postcode, active, last_updated_since,
+                                                    legally_active)
+
+    # The organisations in range are few enough to filter in one statement and put in order of distance here
+    sql = str.format("SELECT odscode, name, record_class, status, post_code "
+                     "FROM organisations "
+                     "{0} "
+                     "AND odscode = ANY(%s);",
+                     filter_sql)
+
+    cur = connect.get_cursor()
+    cur.execute(sql, filter_data + (list(distances),))
+    rows = sorted(cur.fetchall(), key=lambda row: (distances[row['odscode']], row['odscode']))
+
+    logger.debug(str.format("{0} results", len(rows)))
+
+    result = []
+
+    for row in rows[int(offset):int(offset) + int(limit)]:
+        item = format_org_list_item(row)
+        item['distance'] = round(distances[row['odscode']], 3)
+        result.append(item)
+
+    return result, len(rows)
+
+
+def get_org_changes(after=None, limit=100):
+    """Retrieves a page of the organisations feed, in which organisations are ordered by their last change date and
+    then ODS code, so that a client can pick up the changes made since it last read the feed
+
+    Parameters
+    ----------
+    after: (last change date, ODS code) to start the page after, e.g. of the last record of the previous page
+    limit: the maximum number of records to return (hard limit of 1000)
+
+    Returns
+    -------
+    List of organisations, each with its lastChangeDate. Organisations removed by a delta import (see
+    openods.delta_import) are listed as removed on the publication date of the dataset they were removed from.
+    """
+    if int(limit) > 1000:
+        limit = 1000
+
+    cur = connect.get_cursor()
+
+    sql = "SELECT odscode, name, record_class, status, post_code, last_changed, FALSE AS removed " \
+          "FROM organisations " \
+          "WHERE last_changed IS NOT NULL "
     data = ()
+
+    # Seeks straight to the start of the page using the (last_changed, odscode) index
+    if after:
+        sql += "AND (last_changed, odscode) > (%s, %s) "
+        data = tuple(after)
+
+    sql += "ORDER BY last_changed, odscode " \
+           "LIMIT %s"
+    data += (limit,)
+
+    # The removals are dated by migration 008, which may not have been applied. An organisation which has been
+    # added again since it was removed is only listed as it is now.
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_attribute "
+                "WHERE attrelid = to_regclass('organisation_changes') "
+                "AND attname = 'last_changed' "
+                "AND NOT attisdropped) AS present;")
+
+    if cur.fetchone()['present']:
+        removed_sql = "SELECT c.odscode, NULL, NULL, NULL, NULL, MAX(c.last_changed), TRUE " \
+                      "FROM organisation_changes c " \
+                      "WHERE c.change_type = 'removed' " \
+                      "AND c.last_changed IS NOT NULL " \
+                      "AND NOT EXISTS (SELECT 1 FROM organisations o WHERE o.odscode = c.odscode) " \
+                      "GROUP BY c.odscode "
+
+        if after:
+            removed_sql += "HAVING (MAX(c.last_changed), c.odscode) > (%s, %s) "
+            data += tuple(after)
+
+        removed_sql += "ORDER BY 6, 1 " \
+                       "LIMIT %s"
+        data += (limit,)
+
+        sql = str.format("SELECT * FROM (({0}) UNION ALL ({1})) changes "
+                         "ORDER BY last_changed, odscode "
+                         "LIMIT %s", sql, removed_sql)
+        data += (limit,)
+
+    cur.execute(sql + ";", data)
+
+    result = []
+
+    for row in cur.fetchall():
+        # Removed organisations are listed by their ODS code alone
+        if row['removed']:
+            result.append({
+                'odsCode': row['odscode'],
+                'lastChangeDate': row['last_changed'],
+                'removed': True
+            })
+        else:
+            result.append({
+                'postCode': row['post_code'],
+                'odsCode': row['odscode'],
+                'name': row['name'],
+                'recordClass': row['record_class'],
+                'status': row['status'],
+                'lastChangeDate': row['last_changed'],
+                'links': [{
+                    'rel': 'self',
+                    'href': str.format('{0}/organisations/{1}', app.config['APP_HOSTNAME'], row['odscode'])
+                }]
+            })
+
+    return result
+
+
+# The fields included in an export of the organisation list, as (field name, column name) pairs
+EXPORT_FIELDS = (
+    ('odsCode', 'odscode'),
+    ('name', 'name'),
+    ('postCode', 'post_code'),
+    ('recordClass', 'record_class'),
+    ('status', 'status'),
+    ('lastChangeDate', 'last_changed'),
+    ('legalStartDate', 'legal_start_date'),
+    ('legalEndDate', 'legal_end_date'),
+    ('operationalStartDate', 'operational_start_date'),
+    ('operationalEndDate', 'operational_end_date'),
+    ('refOnly', 'ref_only'),
+)
+
+
+def iter_org_list(recordclass=None, primary_role_code_list=None, role_code_list=None,
+                  query=None, postcode=None, active=None, last_updated_since=None,
+                  legally_active=None):
+    """Generates every organisation matching the same filters as get_org_list, ordered by name
+
+    The organisations are read through a server-side cursor EXPORT_FETCH_SIZE rows at a time, so memory use doesn't
+    grow with the number of organisations exported. The request's connection is used throughout, so the generator
+    must be consumed within the request (e.g. by wrapping it in stream_with_context).
+
+    Returns
+    -------
+    Generator of dictionaries holding the EXPORT_FIELDS of each organisation
+    """
+
+    logger = logging.getLogger(__name__)
+
+    conn = connect.get_connection()
+
+    filter_sql, data = build_org_list_filter(recordclass, primary_role_code_list, role_code_list,
+                                             query, postcode, active, last_updated_since,
+                                             legally_active)
+
+    sql = str.format("SELECT {0} "
+                     "FROM organisations "
+                     "{1}"
+                     "ORDER BY name NULLS LAST, odscode;",
+                     ", ".join(column for field, column in EXPORT_FIELDS),
+                     filter_sql)
+
+    logger.debug(sql)
+
+    # Naming the cursor makes it a server-side cursor, which Postgres reads from as rows are fetched
+    cur = conn.cursor('organisation_export', cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = app.config['EXPORT_FETCH_SIZE']
+
+    try:
+        cur.execute(sql, data)
+
+        for row in cur:
+            yield {field: row[column] for field, column in EXPORT_FIELDS}
+
+    finally:
+        cur.close()
+
+
+# The date fields of organisations, roles and relationships, as (column name, field name) pairs. Dates are left
+# as they are, to be written in ISO 8601 format by the serializer.
+DATE_FIELDS = (
+    ('operational_start_date', 'operationalStartDate'),
+    ('legal_end_date', 'legalEndDate'),
+    ('legal_start_date', 'legalStartDate'),
+    ('operational_end_date', 'operationalEndDate'),
+)
+
+
+def rename_keys(dictionary, names):
+    """
+    Renames the keys of a dictionary, given a list of (old name, new name) pairs. Keys which aren't present are
+    skipped.
+    """
+    for old_name, new_name in names:
+        if old_name in dictionary:
+            dictionary[new_name] = dictionary.pop(old_name)
+
+
+def fetch_organisation_rows(cur, odscode):
+    """Retrieves the organisation record and its child records using one query per table
+
+    Returns
+    -------
+    Tuple of (organisation, roles, relationships, addresses, successors), or None if the organisation doesn't exist
+    """
+    logger = logging.getLogger(__name__)
+
+    sql = "SELECT * " \
+          "FROM organisations " \
+          "WHERE odscode = UPPER(%s) " \
+          "LIMIT 1;"
+
+    cur.execute(sql, (odscode,))
+    row_org = cur.fetchone()
+
+    if row_org is None:
+        return None
+
+    data = (row_org['odscode'],)
+
+    cur.execute(queries.ORGANISATION_ROLES_SQL.format(odscode='UPPER(%s)'), data)
+    rows_roles = cur.fetchall()
+
+    cur.execute(queries.ORGANISATION_RELATIONSHIPS_SQL.format(odscode='UPPER(%s)'), data)
+    rows_relationships = cur.fetchall()
+
+    cur.execute(queries.ORGANISATION_ADDRESSES_SQL.format(odscode='UPPER(%s)'), data)
+    rows_addresses = cur.fetchall()
+    logger.debug("Addresses: %s" % rows_addresses)
+
+    cur.execute(queries.ORGANISATION_SUCCESSORS_SQL.format(odscode='UPPER(%s)'), data)
+    rows_successors = cur.fetchall()
+
+    return row_org, rows_roles, rows_relationships, rows_addresses, rows_successors
+
+
+def fetch_organisation_rows_single_query(cur, odscode):
+    """Retrieves the organisation record and its child records in a single round trip to the database.
+
+    The child records are aggregated into JSON arrays by correlated subqueries, so the rows returned have the same
+    keys as those from fetch_organisation_rows, except that dates are returned as ISO 8601 strings.
+
+    Returns
+    -------
+    Tuple of (organisation, roles, relationships, addresses, successors), or None if the organisation doesn't exist
+    """
+    sql = str.format("SELECT org.*, {0} "
+                     "FROM organisations org "
+                     "WHERE org.odscode = UPPER(%s) "
+                     "LIMIT 1;",
+                     queries.organisation_children_columns())
+
+    cur.execute(sql, (odscode,))
+    row_org = cur.fetchone()
+
+    if row_org is None:
+        return None
+
+    return (row_org,
+            row_org.pop('_roles'),
+            row_org.pop('_relationships'),
+            row_org.pop('_addresses'),
+            row_org.pop('_successors'))
+
+
+def fetch_organisations_rows(cur, odscodes):
+    """Retrieves several organisations and their child records in a single round trip to the database
+
+    Returns
+    -------
+    Dictionary of ODS code to a tuple of (organisation, roles, relationships, addresses, successors), as returned
+    by fetch_organisation_rows_single_query. Organisations which don't exist are left out.
+    """
+    sql = str.format("SELECT org.*, {0} "
+                     "FROM organisations org "
+                     "WHERE org.odscode = ANY(%s);",
+                     queries.organisation_children_columns())
+
+    cur.execute(sql, (list(odscodes),))
+
+    result = {}
+
+    for row_org in cur.fetchall():
+        result.setdefault(row_org['odscode'], (row_org,
+                                               row_org.pop('_roles'),
+                                               row_org.pop('_relationships'),
+                                               row_org.pop('_addresses'),
+                                               row_org.pop('_successors')))
+
+    return result
+
+
+def format_organisation(rows, hostname=None):
+    """Builds the API representation of an organisation from its database rows
+
+    Parameters
+    ----------
+    rows: Tuple of (organisation, roles, relationships, addresses, successors), as returned by
+        fetch_organisation_rows
+    hostname: The base URL of the links to other resources, which defaults to APP_HOSTNAME
+
+    Returns
+    -------
+    Dictionary of the organisation with its roles, relationships, addresses and successors
+    """
+    row_org, rows_roles, rows_relationships, rows_addresses, rows_successors = rows
     
-    # If a record_class parameter was specified, add that to the statement
-    if recordclass:
-        logger.debug('record_class parameter was provided')
-        sql = str.format("{0} {1}",
-                         sql,
-                         "AND record_class LIKE %s ")
+    if hostname is None:
+        hostname = app.config['APP_HOSTNAME']
+    
+    row_org = remove_none_values_from_dictionary(row_org)
+    
+    # Create an object from the returned organisation record to hold the data to be returned
+    result_data = row_org
+    
+    # Add the retrieved relationships data to the object
+    relationships = []
+    
+    for relationship in rows_relationships:
         
-        sql_count = str.format("{0} {1}",
-                               sql_count,
-                               "AND record_class LIKE %s ")
+        relationship = remove_none_values_from_dictionary(relationship)
         
-        data = (recordclass,)
-    
-    # If a query parameter was specified, add that to the statement
-    if query:
-        logger.debug("q parameter was provided")
+        link_target_href = str.format('{0}/organisations/{1}',
+                                      hostname,
+                                      relationship['target_odscode'])
         
-        sql = str.format("{0} {1}",
-                         sql,
-                         "AND name LIKE UPPER(%s) ")
+        relationship['uniqueId'] = int(relationship.pop('unique_id'))
+        relationship['relatedOdsCode'] = relationship.pop('target_odscode')
+        relationship['relatedOrganisationName'] = relationship.pop('name')
+        relationship['description'] = relationship.pop('displayname')
+        relationship['status'] = relationship.pop('status')
         
-        sql_count = str.format("{0} {1}",
-                               sql_count,
-                               "AND name LIKE UPPER(%s) ")
+        rename_keys(relationship, DATE_FIELDS)
         
-        search_query = str.format("%{0}%",
-                                  query)
+        relationship['links'] = [{
+            'rel': 'related-organisation',
+            'href': link_target_href
+        }]
         
-        data = data + (search_query,)
+        relationships.append(relationship)
     
-    # If a postcode parameter was specified, add that to the statement
-    if postcode:
-        logger.debug("postcode parameter was provided")
-        
-        new_clause = "AND post_code LIKE UPPER(%s) "
+    result_data['relationships'] = relationships
+    
+    # Add the retrieved roles data to the object
+    roles = []
+    
+    for role in rows_roles:
         
-        sql = "{sql} {new_sql}".format(
-            sql=sql, new_sql=new_clause)
+        role = remove_none_values_from_dictionary(role)
         
-        sql_count = "{sql} {new_sql}".format(
-            sql=sql_count, new_sql=new_clause)
+        link_role_href = str.format('{0}/role-types/{1}',
+                                    hostname,
+                                    role['code'])
         
-        postcode_query = str.format("%{0}%",
-                                    postcode)
+        role['code'] = role.pop('code')
+        role['description'] = role.pop('displayname')
+        role['primaryRole'] = role.pop('primary_role')
         
-        data = data + (postcode_query,)
-    
-    # If the active parameter was specified, add that to the statement
-    if active:
-        logger.debug("active parameter was provided")
+        try:
+            role['status'] = role.pop('status')
+        except:
+            pass
         
-        if active in (True, 1, '1', 'True', 'true', 'TRUE', 'yes', 'Yes', 'YES'):
-            active_value = 'Active'
-            new_clause = "AND status = %s "
-        else:
-            active_value = 'Inactive'
-            new_clause = "AND status = %s "
+        try:
+            role['uniqueId'] = int(role.pop('unique_id'))
+        except:
+            pass
         
-        sql = "{sql} {new_sql}".format(
-            sql=sql, new_sql=new_clause)
+        rename_keys(role, DATE_FIELDS)
         
-        sql_count = "{sql} {new_sql}".format(
-            sql=sql_count, new_sql=new_clause)
+        role['links'] = [{
+            'rel': 'role-type',
+            'href': link_role_href
+        }]
         
-        data = data + (active_value,)
+        roles.append(role)
+    
+    result_data['roles'] = roles
     
-    # If the last_changed_since parameter was specified, add that to the statement
-    if last_updated_since:
-        logger.debug("last_changed_since parameter was provided")
+    # Add the addresses to the object
+    addresses = []
+    
+    for address in rows_addresses:
+        address = remove_none_values_from_dictionary(address)
         
-        new_clause = "AND last_changed > %s "
+        address_lines = []
         
-        sql = "{sql} {new_sql}".format(
-            sql=sql, new_sql=new_clause)
+        try:
+            address_lines.append(address.pop('address_line1'))
+        except:
+            pass
+        
+        try:
+            address_lines.append(address.pop('address_line2'))
+        except:
+            pass
         
-        sql_count = "{sql} {new_sql}".format(
-            sql=sql_count, new_sql=new_clause)
+        try:
+            address_lines.append(address.pop('address_line3'))
+        except:
+            pass
         
-        data = data + (last_updated_since,)
+        if len(address_lines) > 0:
+            address['addressLines'] = address_lines
         
-    # If the legally_active parameter was specified, check for true or false, and append correct clause to query
-    if legally_active:
-        # If value for legallyActive parameter is any of the below list (True), filter the query to include only
-        # organisations that have a legal_end_date in the future, or do not have one
-        if legally_active in (True, 1, '1', 'True', 'true', 'TRUE', 'yes', 'Yes', 'YES'):
-            logger.debug("legally_active parameter was True")
-            new_clause = "AND (legal_end_date > now() or legal_end_date ISNULL) "
+        try:
+            address['postCode'] = address.pop('post_code')
+        except:
+            pass
         
-            sql = "{sql} {new_sql}".format(
-                sql=sql, new_sql=new_clause)
+        addresses.append(address)
+    
+    result_data['addresses'] = addresses
     
-            sql_count = "{sql} {new_sql}".format(
-                sql=sql_count, new_sql=new_clause)
+    # Add the successors to the object
+    successors = []
+    
+    for successor in rows_successors:
+        link_successor_href = str.format('{0}/organisations/{1}',
+                                         hostname,
+                                         successor['targetodscode'])
         
-        # If value for legallyActive parameter is any of the below list (False), filter the query to include only
-        # organisations that have a legal_end_date in the past and are therefore not legally active today
-        elif legally_active in (False, 0, '0', 'False', 'false', 'FALSE', 'no', 'No', 'NO'):
-            logger.debug("legally_active parameter was False")
-            new_clause = "AND legal_end_date < now() "
+        successor = remove_none_values_from_dictionary(successor)
         
-            sql = "{sql} {new_sql}".format(
-                sql=sql, new_sql=new_clause)
+        successor['targetOdsCode'] = successor.pop('targetodscode')
+        successor['targetPrimaryRoleCode'] = successor.pop('targetprimaryrolecode')
+        successor['targetName'] = successor.pop('targetname')
+        successor['uniqueId'] = successor.pop('uniqueid')
         
-            sql_count = "{sql} {new_sql}".format(
-                sql=sql_count, new_sql=new_clause)
-
-        # If value for legallyActive parameter doesn't match the True or False list, ignore it
-        else:
-            logger.debug("legally_active parameter value not recognised - ignored")
-
-    # If a role_code parameter was specified, add that to the statement
-    if role_code_list:
-        logger.debug('role_code parameter was provided')
-        
-        sql = str.format("{0} {1}",
-                         sql,
-                         "AND odscode in "
-                         "(SELECT org_odscode "
-                         "FROM roles "
-                         "WHERE status = 'Active' "
-                         "AND code = ANY(%s)) ")
-        
-        sql_count = str.format("{0} {1}",
-                               sql_count,
-                               "AND odscode in "
-                               "(SELECT org_odscode "
-                               "FROM roles "
-                               "WHERE status = 'Active' "
-                               "AND UPPER(code) = ANY(%s)) ")
-        data = data + (role_code_list,)
-    
-    # Or if a primary_role_code parameter was specified, add that to the statement
-    elif primary_role_code_list:
-        logger.debug('primary_role_code parameter was provided')
-        
-        sql = str.format("{0} {1}",
-                         sql,
-                         "AND odscode IN "
-                         "(SELECT org_odscode "
-                         "FROM roles "
-                         "WHERE primary_role = TRUE "
-                         "AND status = 'Active' "
-                         "AND code = ANY(%s)) ")
-        
-        sql_count = str.format("{0} {1}",
-                               sql_count,
-                               "AND odscode IN "
-                               "(SELECT org_odscode "
-                               "FROM roles "
-                               "WHERE primary_role = TRUE "
-                               "AND status = 'Active' "
-                               "AND code = ANY(%s)) ")
-        
-        data = data + (primary_role_code_list,)
-    
-    # Quickly get total number of query results before applying offset and limit
-    cur.execute(sql_count, data)
-    count = cur.fetchone()['count']
-    
-    # Lastly, add the offset and limit clauses to the main select statement
-    sql = str.format("{0} {1}",
-                     sql,
-                     "ORDER BY name "
-                     "OFFSET %s "
-                     "LIMIT %s;")
-    
-    data = data + (offset, limit)
+        successor['links'] = [{
+            'rel': str.lower(successor['type']),
+            'href': link_successor_href
+        }]
+        
+        successors.append(successor)
     
-    logger.debug(sql)
+    result_data['successors'] = successors
     
-    # Execute the main query
-    cur.execute(sql, data)
-    rows = cur.fetchall()
+    # Tidy up the field names etc. in the organisation dictionary before it's returned
+    result_data['odsCode'] = result_data.pop('odscode')
+    result_data['lastChangeDate'] = result_data.pop('last_changed')
+    result_data['refOnly'] = bool(result_data.pop('ref_only'))
+    result_data['recordClass'] = result_data.pop('record_class')
+    result_data.pop('post_code')
+    result_data.pop('ref')
     
-    logger.debug(str.format("{0} results", len(rows)))
+    link_self_href = str.format('{0}/organisations/{1}',
+                                hostname,
+                                result_data['odsCode'])
+    result_data['links'] = [
+        {'rel': 'self',
+         'href': link_self_href
+         }
+    ]
     
-    result = []
+    rename_keys(result_data, DATE_FIELDS)
     
-    for row in rows:
-        link_self_href = str.format('{0}/organisations/{1}',
-                                    app.config['APP_HOSTNAME'],
-                                    row['odscode'])
-        
-        item = {
-            'postCode': row['post_code'],
-            'odsCode': row['odscode'],
-            'name': row['name'],
-            'recordClass': row['record_class'],
-            'status': row['status'],
-            'links': [{
-                'rel': 'self',
-                'href': link_self_href
-            }]
-        }
-        result.append(item)
-    
-    # Return both the paged results and the count of total results
-    return result, count
+    return result_data
 
 
 def get_organisation_by_odscode(odscode):
@@ -304,304 +803,27 @@ def get_organisation_by_odscode(odscode):
     
     # Try and retrieve the organisation record for the provided ODS code
     try:
-        sql = "SELECT * " \
-              "FROM organisations " \
-              "WHERE odscode = UPPER(%s) " \
-              "LIMIT 1;"
-        
-        data = (odscode,)
+        snap = snapshot.get_snapshot()
         
-        cur.execute(sql, data)
-        row_org = cur.fetchone()
-        logger.debug(str.format('requestId="{1}"|Organisation Record:{0}',
-                                row_org, g.request_id))
+        if snap is not None:
+            rows = snap.fetch_organisation_rows(odscode)
+        elif app.config['ORGANISATION_FETCH_MODE'] == 'single':
+            rows = fetch_organisation_rows_single_query(cur, odscode)
+        else:
+            rows = fetch_organisation_rows(cur, odscode)
         
         # Raise an exception if the organisation record is not found
-        if row_org is None:
+        if rows is None:
             raise Exception(str.format('requestId="{0}"|Record Not Found', g.request_id))
         
-        row_org = remove_none_values_from_dictionary(row_org)
-        
-        # Get the organisation ref from the retrieved record
-        organisation_odscode = row_org['odscode']
-        
-        # Retrieve the roles for the organisation
-        try:
-            sql = "SELECT r.code, csr.displayname, r.unique_id, r.status, " \
-                  "r.operational_start_date, r.operational_end_date, r.legal_start_date, " \
-                  "r.legal_end_date, r.primary_role " \
-                  "FROM roles r " \
-                  "LEFT JOIN codesystems csr on r.code = csr.id " \
-                  "WHERE r.org_odscode = UPPER(%s) " \
-                  "AND csr.name = 'OrganisationRole';"
-            
-            data = (organisation_odscode,)
-            
-            cur.execute(sql, data)
-            rows_roles = cur.fetchall()
-        
-        except Exception:
-            raise
-        
-        # Retrieve the relationships for the organisation
-        try:
-            sql = "SELECT rs.code, csr.displayname, rs.unique_id, rs.target_odscode, rs.status, " \
-                  "rs.operational_start_date, rs.operational_end_date, rs.legal_start_date, " \
-                  "rs.legal_end_date, o.name " \
-                  "FROM relationships rs " \
-                  "LEFT JOIN codesystems csr on rs.code = csr.id " \
-                  "LEFT JOIN organisations o on rs.target_odscode = o.odscode " \
-                  "WHERE rs.org_odscode = UPPER(%s);"
-            
-            data = (organisation_odscode,)
-            
-            cur.execute(sql, data)
-            rows_relationships = cur.fetchall()
-        
-        except Exception:
-            raise
-        
-        # Retrieve the addresses for the organisation
-        try:
-            sql = "SELECT address_line1, " \
-                  "address_line2, " \
-                  "address_line3, " \
-                  "town, county, " \
-                  "post_code, " \
-                  "country  " \
-                  "FROM addresses a " \
-                  "WHERE a.org_odscode = UPPER(%s);"
-            
-            data = (organisation_odscode,)
-            
-            cur.execute(sql, data)
-            rows_addresses = cur.fetchall()
-            logger.debug("Addresses: %s" % rows_addresses)
-        
-        except Exception:
-            raise
-        
-        # Retrieve the successors / predecessors for the organisation
-        try:
-            sql = "SELECT type, target_odscode as targetOdsCode, " \
-                  "o.name as targetName, " \
-                  "target_primary_role_code as targetPrimaryRoleCode, " \
-                  "unique_id as uniqueId " \
-                  "FROM successors s " \
-                  "LEFT JOIN organisations o on s.target_odscode = o.odscode " \
-                  "WHERE s.org_odscode = UPPER(%s);"
-            
-            data = (organisation_odscode,)
-            
-            cur.execute(sql, data)
-            rows_successors = cur.fetchall()
-            logger.debug(str.format('requestId="{0}"|Successors: {1}',
-                                    g.request_id,
-                                    rows_successors))
-        
-        except Exception:
-            raise
-        
-        # Create an object from the returned organisation record to hold the data to be returned
-        result_data = row_org
-        
-        # Add the retrieved relationships data to the object
-        relationships = []
-        
-        for relationship in rows_relationships:
-            
-            relationship = remove_none_values_from_dictionary(relationship)
-            
-            link_target_href = str.format('{0}/organisations/{1}',
-                                          app.config['APP_HOSTNAME'],
-                                          relationship['target_odscode'])
-            
-            relationship['uniqueId'] = int(relationship.pop('unique_id'))
-            relationship['relatedOdsCode'] = relationship.pop('target_odscode')
-            relationship['relatedOrganisationName'] = relationship.pop('name')
-            relationship['description'] = relationship.pop('displayname')
-            relationship['status'] = relationship.pop('status')
-            
-            try:
-                relationship['operationalStartDate'] = relationship.pop('operational_start_date').isoformat()
-            except:
-                pass
-            
-            try:
-                relationship['legalEndDate'] = relationship.pop('legal_end_date').isoformat()
-            except:
-                pass
-            
-            try:
-                relationship['legalStartDate'] = relationship.pop('legal_start_date').isoformat()
-            except:
-                pass
-            
-            try:
-                relationship['operationalEndDate'] = relationship.pop('operational_end_date').isoformat()
-            except:
-                pass
-            
-            relationship['links'] = [{
-                'rel': 'related-organisation',
-                'href': link_target_href
-            }]
-            
-            relationships.append(relationship)
-        
-        result_data['relationships'] = relationships
-        
-        # Add the retrieved roles data to the object
-        roles = []
-        
-        for role in rows_roles:
-            
-            role = remove_none_values_from_dictionary(role)
-            
-            link_role_href = str.format('{0}/role-types/{1}',
-                                        app.config['APP_HOSTNAME'],
-                                        role['code'])
-            
-            role['code'] = role.pop('code')
-            role['description'] = role.pop('displayname')
-            role['primaryRole'] = role.pop('primary_role')
-            
-            try:
-                role['status'] = role.pop('status')
-            except:
-                pass
-            
-            try:
-                role['uniqueId'] = int(role.pop('unique_id'))
-            except:
-                pass
-            
-            try:
-                role['operationalStartDate'] = role.pop('operational_start_date').isoformat()
-            except Exception:
-                pass
-            
-            try:
-                role['legalEndDate'] = role.pop('legal_end_date').isoformat()
-            except Exception:
-                pass
-            
-            try:
-                role['legalStartDate'] = role.pop('legal_start_date').isoformat()
-            except Exception:
-                pass
-            
-            try:
-                role['operationalEndDate'] = role.pop('operational_end_date').isoformat()
-            except Exception:
-                pass
-            
-            role['links'] = [{
-                'rel': 'role-type',
-                'href': link_role_href
-            }]
-            
-            roles.append(role)
-        
-        result_data['roles'] = roles
-        
-        # Add the addresses to the object
-        addresses = []
-        
-        for address in rows_addresses:
-            address = remove_none_values_from_dictionary(address)
-            
-            address_lines = []
-            
-            try:
-                address_lines.append(address.pop('address_line1'))
-            except:
-                pass
-            
-            try:
-                address_lines.append(address.pop('address_line2'))
-            except:
-                pass
-            
-            try:
-                address_lines.append(address.pop('address_line3'))
-            except:
-                pass
-            
-            if len(address_lines) > 0:
-                address['addressLines'] = address_lines
-            
-            try:
-                address['postCode'] = address.pop('post_code')
-            except:
-                pass
-            
-            addresses.append(address)
-        
-        result_data['addresses'] = addresses
-        
-        # Add the successors to the object
-        successors = []
-        
-        for successor in rows_successors:
-            link_successor_href = str.format('{0}/organisations/{1}',
-                                             app.config['APP_HOSTNAME'],
-                                             successor['targetodscode'])
-            
-            successor = remove_none_values_from_dictionary(successor)
-            
-            successor['targetOdsCode'] = successor.pop('targetodscode')
-            successor['targetPrimaryRoleCode'] = successor.pop('targetprimaryrolecode')
-            successor['targetName'] = successor.pop('targetname')
-            successor['uniqueId'] = successor.pop('uniqueid')
-            
-            successor['links'] = [{
-                'rel': str.lower(successor['type']),
-                'href': link_successor_href
-            }]
-            
-            successors.append(successor)
-        
-        result_data['successors'] = successors
-        
-        # Tidy up the field names etc. in the organisation dictionary before it's returned
-        result_data['odsCode'] = result_data.pop('odscode')
-        result_data['lastChangeDate'] = result_data.pop('last_changed')
-        result_data['refOnly'] = bool(result_data.pop('ref_only'))
-        result_data['recordClass'] = result_data.pop('record_class')
-        result_data.pop('post_code')
-        result_data.pop('ref')
-        
-        link_self_href = str.format('{0}/organisations/{1}',
-                                    app.config['APP_HOSTNAME'],
-                                    result_data['odsCode'])
-        result_data['links'] = [
-            {'rel': 'self',
-             'href': link_self_href
-             }
-        ]
-        
-        try:
-            result_data['operationalStartDate'] = result_data.pop('operational_start_date').isoformat()
-        except:
-            pass
-        
-        try:
-            result_data['legalEndDate'] = result_data.pop('legal_end_date').isoformat()
-        except:
-            pass
-        
-        try:
-            result_data['legalStartDate'] = result_data.pop('legal_start_date').isoformat()
-        except:
-            pass
-        
-        try:
-            result_data['operationalEndDate'] = result_data.pop('operational_end_date').isoformat()
-        except:
-            pass
+        row_org, rows_roles, rows_relationships, rows_addresses, rows_successors = rows
+        logger.debug(str.format('requestId="{1}"|Organisation Record:{0}',
+                                row_org, g.request_id))
+        logger.debug(str.format('requestId="{0}"|Successors: {1}',
+                                g.request_id,
+                                rows_successors))
         
-        return result_data
+        return format_organisation(rows)
     
     except psycopg2.DatabaseError as e:
         logger.error(str.format("Error {0}", e))
@@ -610,6 +832,46 @@ def get_organisation_by_odscode(odscode):
         logger.error(e)
 
 
+def get_organisations_by_odscodes(odscodes):
+    """Retrieves several organisations at once, fetching them all with one query rather than one per organisation
+
+    Parameters
+    ----------
+    odscodes: List of upper case ODS codes
+
+    Returns
+    -------
+    Dictionary of ODS code to the organisation, in the same form as get_organisation_by_odscode, or None if the
+    organisation doesn't exist
+    """
+    logger = logging.getLogger(__name__)
+
+    snap = snapshot.get_snapshot()
+
+    if snap is not None:
+        rows_by_odscode = {odscode: snap.fetch_organisation_rows(odscode) for odscode in odscodes}
+    else:
+        rows_by_odscode = fetch_organisations_rows(connect.get_cursor(), odscodes)
+
+    result = {}
+
+    for odscode in odscodes:
+        rows = rows_by_odscode.get(odscode)
+
+        if rows is None:
+            result[odscode] = None
+            continue
+
+        try:
+            result[odscode] = format_organisation(rows)
+        except Exception as e:
+            logger.error(str.format('requestId="{0}"|odsCode={1}|Unable to format organisation: {2}',
+                                    g.request_id, odscode, repr(e)))
+            result[odscode] = None
+
+    return result
+
+
 # This method currently not called from anywhere
 def search_organisation(search_text, offset=0, limit=1000, ):
     logger = logging.getLogger(__name__)
@@ -0,0 +1,345 @@
+import argparse
+import datetime
+import logging
+import sys
+import tempfile
+import time
+
+import psycopg2
+import psycopg2.extras
+from openods import app, connection as connect, dataset
+
+# The columns copied for each table, leaving out the serial primary keys which the target database assigns itself.
+# Each table is keyed by the organisation its rows belong to.
+ORGANISATION_COLUMNS = ('odscode', 'name', 'status', 'record_class', 'last_changed', 'legal_start_date',
+                        'legal_end_date', 'operational_start_date', 'operational_end_date', 'ref_only', 'post_code')
+
+CHILD_TABLES = (
+    ('roles', ('org_odscode', 'code', 'primary_role', 'unique_id', 'status', 'legal_start_date', 'legal_end_date',
+               'operational_start_date', 'operational_end_date')),
+    ('relationships', ('code', 'target_odscode', 'org_odscode', 'legal_start_date', 'legal_end_date',
+                       'operational_start_date', 'operational_end_date', 'status', 'unique_id')),
+    ('addresses', ('org_odscode', 'address_line1', 'address_line2', 'address_line3', 'town', 'county', 'post_code',
+                   'country')),
+    ('successors', ('unique_id', 'org_odscode', 'legal_start_date', 'type', 'target_odscode',
+                    'target_primary_role_code', 'target_unique_role_id')),
+)
+
+CODESYSTEM_COLUMNS = ('id', 'name', 'displayname')
+
+VERSION_COLUMNS = ('file_version', 'publication_seqno', 'publication_date', 'publication_type', 'publication_source',
+                   'file_creation_date', 'record_count', 'content_description')
+
+# Rows staged for COPY are held in memory up to this size, and spill to a temporary file beyond it
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+# Channel on which the new dataset version is announced once a delta import has been committed
+NOTIFY_CHANNEL = 'openods_dataset_changes'
+
+
+def read_last_changed(cur):
+    """
+    Returns a dictionary of ODS code to the last change date of every organisation in a database
+    """
+    cur.execute("SELECT odscode, last_changed FROM organisations WHERE odscode IS NOT NULL;")
+    return dict(cur.fetchall())
+
+
+def find_changes(source, target):
+    """
+    Compares the last change dates of the organisations in a new publication (source) with those in the database
+    being served (target)
+
+    Returns
+    -------
+    Tuple of sorted lists of the ODS codes which have been added, updated and removed
+    """
+    added = sorted(odscode for odscode in source if odscode not in target)
+    updated = sorted(odscode for odscode, last_changed in source.items()
+                     if odscode in target and target[odscode] != last_changed)
+    removed = sorted(odscode for odscode in target if odscode not in source)
+
+    return added, updated, removed
+
+
+def copy_rows(source_cur, target_cur, query, staging_table):
+    """
+    Copies the rows returned by query on the source database into staging_table on the target, using COPY at both
+    ends
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as buffer:
+        source_cur.copy_expert(str.format('COPY ({0}) TO STDOUT', query), buffer)
+        buffer.seek(0)
+        target_cur.copy_expert(str.format('COPY {0} FROM STDIN', staging_table), buffer)
+
+
+def stage_table(source_cur, target_cur, table, columns, where_sql='', where_data=None):
+    """
+    Creates a temporary staging table on the target with the given columns of table, and fills it from the source.
+    Returns the name of the staging table.
+    """
+    staging_table = 'staging_' + table
+    column_list = ', '.join(columns)
+
+    target_cur.execute(str.format("CREATE TEMP TABLE {0} ON COMMIT DROP AS "
+                                  "SELECT {1} FROM {2} WITH NO DATA;",
+                                  staging_table, column_list, table))
+
+    query = source_cur.mogrify(str.format("SELECT {0} FROM {1} {2}", column_list, table, where_sql),
+                               where_data).decode('utf-8')
+    copy_rows(source_cur, target_cur, query, staging_table)
+
+    return staging_table
+
+
+def apply_organisations(source_cur, target_cur, changed, removed):
+    """
+    Replaces the organisations listed in changed, and all of their child records, with those from the source, and
+    deletes the organisations listed in removed
+    """
+    staging_table = stage_table(source_cur, target_cur, 'organisations', ORGANISATION_COLUMNS,
+                                "WHERE odscode = ANY(%s)", (changed,))
+
+    target_cur.execute(str.format("UPDATE organisations o "
+                                  "SET ({0}) = ({1}) "
+                                  "FROM {2} s "
+                                  "WHERE o.odscode = s.odscode;",
+                                  ', '.join(ORGANISATION_COLUMNS),
+                                  ', '.join('s.' + column for column in ORGANISATION_COLUMNS),
+                                  staging_table))
+
+    target_cur.execute(str.format("INSERT INTO organisations ({0}) "
+                                  "SELECT {0} FROM {1} s "
+                                  "WHERE NOT EXISTS (SELECT 1 FROM organisations o WHERE o.odscode = s.odscode);",
+                                  ', '.join(ORGANISATION_COLUMNS), staging_table))
+
+    target_cur.execute("DELETE FROM organisations WHERE odscode = ANY(%s);", (removed,))
+
+    # Child records don't have a key of their own, so an organisation's records are replaced as a whole
+    for table, columns in CHILD_TABLES:
+        staging_table = stage_table(source_cur, target_cur, table, columns, "WHERE org_odscode = ANY(%s)",
+                                    (changed,))
+
+        target_cur.execute(str.format("DELETE FROM {0} WHERE org_odscode = ANY(%s);", table), (changed + removed,))
+        target_cur.execute(str.format("INSERT INTO {0} ({1}) SELECT {1} FROM {2};",
+                                      table, ', '.join(columns), staging_table))
+
+
+def apply_codesystems(source_cur, target_cur):
+    """
+    Replaces the code systems with those from the source if they differ. Returns True if they were replaced.
+    """
+    query = str.format("SELECT {0} FROM codesystems", ', '.join(CODESYSTEM_COLUMNS))
+
+    source_cur.execute(query)
+    source_rows = set(source_cur.fetchall())
+    target_cur.execute(query)
+    target_rows = set(target_cur.fetchall())
+
+    if source_rows == target_rows:
+        return False
+
+    staging_table = stage_table(source_cur, target_cur, 'codesystems', CODESYSTEM_COLUMNS)
+    target_cur.execute("DELETE FROM codesystems;")
+    target_cur.execute(str.format("INSERT INTO codesystems ({0}) SELECT {0} FROM {1};",
+                                  ', '.join(CODESYSTEM_COLUMNS), staging_table))
+
+    return True
+
+
+def find_related(target_cur, odscodes):
+    """
+    Returns the ODS codes of the organisations whose relationships or successors name any of odscodes, as their
+    documents include the names of those organisations
+    """
+    target_cur.execute("SELECT org_odscode FROM relationships WHERE target_odscode = ANY(%(odscodes)s) "
+                       "UNION "
+                       "SELECT org_odscode FROM successors WHERE target_odscode = ANY(%(odscodes)s);",
+                       {'odscodes': odscodes})
+
+    return {row[0] for row in target_cur.fetchall()}
+
+
+def read_publication_date(source_cur):
+    """
+    Returns the publication date of the source dataset, or today's date if it isn't recorded
+    """
+    source_cur.execute("SELECT publication_date FROM versions ORDER BY version_ref DESC LIMIT 1;")
+    row = source_cur.fetchone()
+
+    if row is None or not row[0]:
+        return datetime.date.today().isoformat()
+
+    return str(row[0])
+
+
+def record_version(source_cur, target_cur):
+    """
+    Adds a row to the versions table for the source publication, stamped with the time of this import, and returns
+    the new dataset version
+    """
+    column_list = ', '.join(VERSION_COLUMNS)
+
+    source_cur.execute(str.format("SELECT {0} FROM versions ORDER BY version_ref DESC LIMIT 1;", column_list))
+    row = source_cur.fetchone() or (None,) * len(VERSION_COLUMNS)
+
+    # Written in the same format as the import tool, which is what dataset.parse_import_timestamp reads
+    import_timestamp = str(datetime.datetime.now())
+
+    target_cur.execute(str.format("INSERT INTO versions (import_timestamp, {0}) VALUES (%s, {1});",
+                                  column_list, ', '.join(['%s'] * len(VERSION_COLUMNS))),
+                       (import_timestamp,) + tuple(row))
+
+    return dataset.get_dataset_version(target_cur)
+
+
+def apply_delta(source_conn, target_conn):
+    """
+    Brings the database on target_conn up to date with a newly imported publication on source_conn, copying only
+    the organisations whose last change date has moved. The changes are made in the target connection's
+    transaction, which is left for the caller to commit.
+
+    Returns
+    -------
+    Dictionary of the previous and new dataset versions and the ODS codes added, updated, removed and related, or
+    None if nothing has changed (in which case the dataset version stays the same)
+    """
+    source_cur = source_conn.cursor()
+    target_cur = target_conn.cursor()
+
+    previous_version = dataset.get_dataset_version(target_cur)
+
+    added, updated, removed = find_changes(read_last_changed(source_cur), read_last_changed(target_cur))
+    changed = added + updated
+
+    if changed or removed:
+        apply_organisations(source_cur, target_cur, changed, removed)
+
+    codesystems_changed = apply_codesystems(source_cur, target_cur)
+
+    if not (changed or removed or codesystems_changed):
+        return None
+
+    # Every document includes the descriptions of its roles and relationships, so new code systems affect them all
+    if codesystems_changed:
+        target_cur.execute("SELECT odscode FROM organisations;")
+        related = {row[0] for row in target_cur.fetchall()}
+    else:
+        related = find_related(target_cur, changed + removed)
+
+    related = sorted(related.difference(changed, removed))
+
+    # Removals are listed in the changes feed on the publication date of the dataset they were made from
+    removed_on = read_publication_date(source_cur)
+
+    version = record_version(source_cur, target_cur)
+
+    changes = [(version, previous_version, odscode, change_type, removed_on if change_type == 'removed' else None)
+               for change_type, odscodes in (('added', added), ('updated', updated), ('removed', removed),
+                                             ('related', related))
+               for odscode in odscodes]
+
+    psycopg2.extras.execute_values(target_cur,
+                                   "INSERT INTO organisation_changes "
+                                   "(dataset_version, previous_version, odscode, change_type, last_changed) "
+                                   "VALUES %s;",
+                                   changes, page_size=1000)
+
+    # The stored documents of the organisations which haven't changed are still correct for the new version
+    target_cur.execute("UPDATE organisation_documents "
+                       "SET dataset_version = %s "
+                       "WHERE dataset_version = %s "
+                       "AND odscode <> ALL(%s);",
+                       (version, previous_version, changed + removed + related))
+
+    target_cur.execute(str.format("NOTIFY {0}, %s;", NOTIFY_CHANNEL), (version,))
+
+    return {
+        'previousVersion': previous_version,
+        'version': version,
+        'added': added,
+        'updated': updated,
+        'removed': removed,
+        'related': related,
+    }
+
+
+def run(source_url, dry_run=False):
+    """
+    Applies the changes in the publication imported into the database at source_url to the app's database, and
+    rebuilds the stored documents of the organisations affected
+
+    Returns
+    -------
+    The summary returned by apply_delta
+    """
+    logger = logging.getLogger(__name__)
+    started = time.time()
+
+    source_conn = psycopg2.connect(source_url)
+
+    try:
+        with connect.borrow_connection() as target_conn:
+            try:
+                documents_in_use = document_store_in_use(target_conn)
+                summary = apply_delta(source_conn, target_conn)
+            except Exception:
+                target_conn.rollback()
+                raise
+
+            if summary is None:
+                target_conn.rollback()
+                logger.info('No organisations have changed')
+                return None
+
+            if dry_run:
+                target_conn.rollback()
+            else:
+                target_conn.commit()
+
+            logger.info(str.format('{0} dataset version {1} to {2}|added={3}|updated={4}|removed={5}|related={6}|'
+                                   'importTime={7:.2f}s|',
+                                   'Would move' if dry_run else 'Moved',
+                                   summary['previousVersion'], summary['version'], len(summary['added']),
+                                   len(summary['updated']), len(summary['removed']), len(summary['related']),
+                                   time.time() - started))
+
+            # Only the documents which weren't carried over to the new version need building
+            if not dry_run and documents_in_use:
+                from openods import documents
+                documents.materialize_documents(target_conn, summary['added'] + summary['updated'] +
+                                                summary['related'])
+    finally:
+        source_conn.close()
+
+    return summary
+
+
+def document_store_in_use(conn):
+    """
+    Returns True if documents have been built for the dataset version currently in the database
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT EXISTS (SELECT 1 FROM organisation_documents WHERE dataset_version = %s);",
+                (dataset.get_dataset_version(cur),))
+    return cur.fetchone()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Applies the organisations changed in a new ODS publication to '
+                                                 'the OpenODS database')
+    parser.add_argument('--source', required=True,
+                        help='URL of a database into which the new publication has been imported in full')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would change without changing anything')
+    args = parser.parse_args()
+
+    # Run through the imported module so that its log messages go to the app's logger rather than __main__
+    from openods import delta_import
+
+    with app.app_context():
+        try:
+            delta_import.run(args.source, args.dry_run)
+        except Exception:
+            logging.getLogger('openods.delta_import').error("Unable to apply the delta import", exc_info=True)
+            sys.exit(1)
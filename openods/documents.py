@@ -0,0 +1,177 @@
+import json
+import logging
+import sys
+import time
+
+import psycopg2.extras
+from flask import Response
+
+from openods import app, connection as connect, dataset, db, queries, serializer
+
+# Stands in for APP_HOSTNAME in the links of stored documents, so the same documents can be served from any host
+HOSTNAME_PLACEHOLDER = '${APP_HOSTNAME}'
+
+
+def render_document(organisation, pretty=False):
+    """
+    Serialises an organisation in the same way as the detail endpoint does, compact as for XHR requests or else
+    pretty printed
+    """
+    return (serializer.dumps(organisation, pretty) + b'\n').decode('utf-8')
+
+
+def document_response(document):
+    """
+    Builds the response for a stored document, which is already in the representation of the request
+    """
+    return Response(document, mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+def prefix_links(document, hostname=None):
+    """
+    Fills in the host part of the links in a stored document
+    """
+    if hostname is None:
+        hostname = app.config['APP_HOSTNAME']
+
+    # The hostname is written inside JSON strings, so has to be escaped in the same way as the rest of the document
+    return document.replace(HOSTNAME_PLACEHOLDER, json.dumps(hostname)[1:-1])
+
+
+def get_document(odscode):
+    """
+    Returns the stored JSON document for an organisation with its links filled in, pretty printed if the response
+    to the request would be, or None if there isn't one for the current version of the dataset
+    """
+    cur = connect.get_cursor()
+
+    cur.execute(str.format("SELECT {0} AS document "
+                           "FROM organisation_documents "
+                           "WHERE odscode = %s "
+                           "AND dataset_version = %s;",
+                           'pretty_document' if serializer.is_pretty() else 'document'),
+                (odscode, dataset.current_version()))
+
+    row = cur.fetchone()
+
+    # Pretty documents aren't built while pretty printing is turned off
+    if row is None or row['document'] is None:
+        return None
+
+    return prefix_links(row['document'])
+
+
+def get_documents(odscodes):
+    """
+    Returns a dictionary of ODS code to the stored compact JSON document for each of the organisations which has
+    one for the current version of the dataset, with their links filled in
+    """
+    cur = connect.get_cursor()
+
+    cur.execute("SELECT odscode, document "
+                "FROM organisation_documents "
+                "WHERE odscode = ANY(%s) "
+                "AND dataset_version = %s;",
+                (list(odscodes), dataset.current_version()))
+
+    return {row['odscode']: prefix_links(row['document']) for row in cur.fetchall()}
+
+
+def materialize_documents(conn, odscodes=None):
+    """
+    Builds the document for every organisation in the dataset and writes them to the organisation_documents table,
+    replacing any left over from earlier versions of the dataset. If odscodes is given, only the documents of those
+    organisations are built, e.g. after a delta import has carried the rest over to the new version.
+
+    Returns
+    -------
+    The number of documents written
+    """
+    logger = logging.getLogger(__name__)
+    started = time.time()
+
+    version = dataset.get_dataset_version(conn.cursor())
+
+    # Responses are only ever pretty printed if JSONIFY_PRETTYPRINT_REGULAR is set
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR']
+
+    sql = str.format("SELECT org.*, {0} "
+                     "FROM organisations org",
+                     queries.organisation_children_columns())
+    data = None
+
+    if odscodes is not None:
+        sql += " WHERE org.odscode = ANY(%s)"
+        data = (list(odscodes),)
+
+    read_cur = conn.cursor('organisation_documents', cursor_factory=psycopg2.extras.RealDictCursor)
+    read_cur.itersize = app.config['EXPORT_FETCH_SIZE']
+    read_cur.execute(sql + ';', data)
+
+    write_cur = conn.cursor()
+    batch = {}
+    written = 0
+
+    for row_org in read_cur:
+        odscode = row_org['odscode']
+        rows = (row_org,
+                row_org.pop('_roles'),
+                row_org.pop('_relationships'),
+                row_org.pop('_addresses'),
+                row_org.pop('_successors'))
+
+        # Organisations which can't be formatted are left out, so requests for them go through the normal lookup
+        try:
+            organisation = db.format_organisation(rows, HOSTNAME_PLACEHOLDER)
+            document = render_document(organisation)
+            pretty_document = render_document(organisation, pretty=True) if pretty else None
+        except Exception as e:
+            logger.warning(str.format('odsCode={0}|Unable to build document: {1}', odscode, repr(e)))
+            continue
+
+        # Keyed by ODS code, as one statement can't insert the same key twice
+        batch[odscode] = (odscode, version, document, pretty_document)
+
+        if len(batch) >= app.config['EXPORT_FETCH_SIZE']:
+            written += write_documents(write_cur, list(batch.values()))
+            batch = {}
+
+    written += write_documents(write_cur, list(batch.values()))
+    read_cur.close()
+
+    write_cur.execute("DELETE FROM organisation_documents WHERE dataset_version <> %s;", (version,))
+    conn.commit()
+
+    logger.info(str.format('Built organisation documents for dataset version {0}|documents={1}|buildTime={2:.2f}s|',
+                           version, written, time.time() - started))
+
+    return written
+
+
+def write_documents(cur, batch):
+    if not batch:
+        return 0
+
+    psycopg2.extras.execute_values(cur,
+                                   "INSERT INTO organisation_documents "
+                                   "(odscode, dataset_version, document, pretty_document) "
+                                   "VALUES %s "
+                                   "ON CONFLICT (odscode) DO UPDATE "
+                                   "SET dataset_version = EXCLUDED.dataset_version, "
+                                   "document = EXCLUDED.document, "
+                                   "pretty_document = EXCLUDED.pretty_document;",
+                                   batch)
+    return len(batch)
+
+
+if __name__ == '__main__':
+    # Run through the imported module so that its log messages go to the app's logger rather than __main__
+    from openods import documents
+
+    with app.app_context(), connect.borrow_connection() as connection:
+        try:
+            documents.materialize_documents(connection)
+        except Exception:
+            connection.rollback()
+            logging.getLogger('openods.documents').error("Unable to build organisation documents", exc_info=True)
+            sys.exit(1)
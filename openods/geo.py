@@ -0,0 +1,318 @@
+import argparse
+import array
+import csv
+import io
+import logging
+import math
+import sys
+import tempfile
+import time
+
+from openods import app, connection as connect, dataset
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Column names used for the postcode and its location by the common postcode lookup files, e.g. the ONS Postcode
+# Directory (pcds, lat, long)
+POSTCODE_COLUMNS = ('pcds', 'pcd', 'postcode')
+LATITUDE_COLUMNS = ('lat', 'latitude')
+LONGITUDE_COLUMNS = ('long', 'longitude', 'lon')
+
+# Rows read from the lookup file are held in memory up to this size, and spill to a temporary file beyond it
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+
+def normalise_postcode(postcode):
+    """
+    Puts a postcode in the form it is stored in the postcodes table, in upper case without spaces
+    """
+    return ''.join(postcode.split()).upper()
+
+
+def to_cartesian(latitude, longitude):
+    """
+    Returns the position of a point on the earth's surface as (x, y, z) on a sphere of radius 1, where the
+    straight line distance between two points increases with the distance along the surface
+    """
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def chord_length(distance_km):
+    """
+    Converts a distance along the earth's surface to the straight line distance between points on the unit sphere
+    """
+    return 2 * math.sin(min(distance_km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def surface_distance(chord):
+    """
+    Converts a straight line distance between points on the unit sphere to the distance in km along the surface
+    """
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+class KDTree(object):
+    """
+    A k-d tree over points in three dimensions, for finding the points within a distance of another.
+
+    The tree is held as a permutation of the points: the point at the middle of any range of the permutation
+    splits the rest of that range in two by one coordinate, cycling through x, y and z at each level.
+    """
+
+    def __init__(self, points):
+        self.coordinates = tuple(array.array('d', (point[axis] for point in points)) for axis in range(3))
+
+        order = list(range(len(points)))
+        ranges = [(0, len(order), 0)]
+
+        while ranges:
+            lo, hi, axis = ranges.pop()
+
+            if hi - lo < 2:
+                continue
+
+            values = self.coordinates[axis]
+            order[lo:hi] = sorted(order[lo:hi], key=values.__getitem__)
+
+            mid = (lo + hi) // 2
+            ranges.append((lo, mid, (axis + 1) % 3))
+            ranges.append((mid + 1, hi, (axis + 1) % 3))
+
+        self.order = array.array('l', order)
+
+    def within(self, point, radius):
+        """
+        Returns a list of (distance, index) for each point within radius of point, in no particular order
+        """
+        xs, ys, zs = self.coordinates
+        x, y, z = point
+        radius_squared = radius * radius
+        found = []
+
+        ranges = [(0, len(self.order), 0)]
+
+        while ranges:
+            lo, hi, axis = ranges.pop()
+
+            if lo >= hi:
+                continue
+
+            mid = (lo + hi) // 2
+            index = self.order[mid]
+
+            distance_squared = (xs[index] - x) ** 2 + (ys[index] - y) ** 2 + (zs[index] - z) ** 2
+
+            if distance_squared <= radius_squared:
+                found.append((math.sqrt(distance_squared), index))
+
+            difference = point[axis] - self.coordinates[axis][index]
+
+            # Only look on each side of the split if the circle around the point reaches it
+            if difference <= radius:
+                ranges.append((lo, mid, (axis + 1) % 3))
+
+            if difference >= -radius:
+                ranges.append((mid + 1, hi, (axis + 1) % 3))
+
+        return found
+
+
+class LocationIndex(object):
+    """
+    An index of where each organisation is, by the location of its postcode, built once for each version of the
+    dataset. Organisations without a postcode, or whose postcode isn't in the lookup, aren't included.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.odscodes = []
+        self.tree = KDTree([])
+
+    def build(self, locations):
+        """
+        Builds the index from (odscode, latitude, longitude) tuples
+        """
+        self.odscodes = [odscode for odscode, _, _ in locations]
+        self.tree = KDTree([to_cartesian(latitude, longitude) for _, latitude, longitude in locations])
+
+        return self
+
+    def load(self, conn):
+        """
+        Reads the location of each organisation's postcode from the database and builds the index
+        """
+        logger = logging.getLogger(__name__)
+        started = time.time()
+
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('postcodes') IS NOT NULL;")
+
+        if cur.fetchone()[0]:
+            cur.execute("SELECT o.odscode, p.latitude, p.longitude "
+                        "FROM organisations o "
+                        "JOIN postcodes p ON p.postcode = upper(replace(o.post_code, ' ', '')) "
+                        "WHERE o.odscode IS NOT NULL;")
+            locations = cur.fetchall()
+        else:
+            logger.warning('The postcodes table is missing, so no organisations can be found by location')
+            locations = []
+
+        self.build(locations)
+
+        logger.info(str.format('Built location index for dataset version {0}|organisations={1}|loadTime={2:.2f}s|',
+                               self.version, len(self.odscodes), time.time() - started))
+
+        return self
+
+    def near(self, latitude, longitude, radius_km):
+        """
+        Returns a list of (odscode, distance in km) for each organisation within radius_km of a point, nearest first
+        """
+        found = self.tree.within(to_cartesian(latitude, longitude), chord_length(radius_km))
+
+        # Organisations at the same distance (such as those sharing a postcode) are ordered by ODS code
+        nearest = sorted((chord, self.odscodes[index]) for chord, index in found)
+
+        return [(odscode, surface_distance(chord)) for chord, odscode in nearest]
+
+
+_indexes = dataset.VersionedIndex(LocationIndex, 'location index')
+
+
+def get_index():
+    """
+    Returns the location index of the current dataset, building it first if there isn't one
+    """
+    return _indexes.get(wait=True)
+
+
+def find_postcode(postcode):
+    """
+    Returns the (latitude, longitude) of a postcode, or None if it isn't in the lookup
+    """
+    cur = connect.get_cursor()
+
+    cur.execute("SELECT to_regclass('postcodes') IS NOT NULL AS present;")
+
+    if not cur.fetchone()['present']:
+        return None
+
+    cur.execute("SELECT latitude, longitude "
+                "FROM postcodes "
+                "WHERE postcode = %s;",
+                (normalise_postcode(postcode),))
+
+    row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    return row['latitude'], row['longitude']
+
+
+def find_column(header, names):
+    """
+    Returns the position in header of the first of names it contains, ignoring case
+    """
+    header = [column.strip().lower() for column in header]
+
+    for name in names:
+        if name in header:
+            return header.index(name)
+
+    raise ValueError(str.format('The postcode lookup file has none of the columns {0}', ', '.join(names)))
+
+
+def read_postcode_lookup(lookup_file):
+    """
+    Reads a CSV postcode lookup file with a header row, yielding (postcode, latitude, longitude) for each postcode
+    with a location. Postcodes without one are marked in the ONS Postcode Directory with a latitude of 99.999999,
+    and are skipped.
+    """
+    reader = csv.reader(lookup_file)
+    header = next(reader)
+
+    postcode_column = find_column(header, POSTCODE_COLUMNS)
+    latitude_column = find_column(header, LATITUDE_COLUMNS)
+    longitude_column = find_column(header, LONGITUDE_COLUMNS)
+
+    for row in reader:
+        try:
+            latitude = float(row[latitude_column])
+            longitude = float(row[longitude_column])
+        except (ValueError, IndexError):
+            continue
+
+        if abs(latitude) > 90 or abs(longitude) > 180:
+            continue
+
+        postcode = normalise_postcode(row[postcode_column])
+
+        if postcode:
+            yield postcode, latitude, longitude
+
+
+def load_postcodes(conn, lookup_file):
+    """
+    Replaces the contents of the postcodes table with the postcodes read from a lookup file, in the connection's
+    transaction, which is left for the caller to commit. Returns the number of postcodes loaded.
+    """
+    cur = conn.cursor()
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as buffer:
+        text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+
+        for postcode, latitude, longitude in read_postcode_lookup(lookup_file):
+            text.write(str.format('{0}\t{1!r}\t{2!r}\n', postcode, latitude, longitude))
+
+        text.flush()
+        buffer.seek(0)
+
+        cur.execute("CREATE TEMP TABLE staging_postcodes ON COMMIT DROP AS "
+                    "SELECT postcode, latitude, longitude FROM postcodes WITH NO DATA;")
+        cur.copy_expert("COPY staging_postcodes FROM STDIN", buffer)
+
+        text.detach()
+
+    # A postcode may appear more than once in a lookup file, e.g. in both its 7 character and display forms
+    cur.execute("DELETE FROM postcodes;")
+    cur.execute("INSERT INTO postcodes (postcode, latitude, longitude) "
+                "SELECT DISTINCT ON (postcode) postcode, latitude, longitude "
+                "FROM staging_postcodes "
+                "ORDER BY postcode;")
+
+    return cur.rowcount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads a postcode lookup file (CSV with a header row, such as the '
+                                                 'ONS Postcode Directory) into the OpenODS database')
+    parser.add_argument('lookup_file', help='path of the postcode lookup file')
+    args = parser.parse_args()
+
+    # Run through the imported module so that its log messages go to the app's logger rather than __main__
+    from openods import geo
+
+    logger = logging.getLogger('openods.geo')
+    started = time.time()
+
+    with app.app_context():
+        try:
+            with open(args.lookup_file, newline='', encoding='utf-8-sig') as lookup_file:
+                with connect.borrow_connection() as conn:
+                    try:
+                        count = geo.load_postcodes(conn, lookup_file)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+        except Exception:
+            logger.error("Unable to load the postcode lookup file", exc_info=True)
+            sys.exit(1)
+
+    logger.info(str.format('Loaded postcode lookup|postcodes={0}|loadTime={1:.2f}s|', count, time.time() - started))
@@ -0,0 +1,224 @@
+import array
+import collections
+import logging
+import time
+
+from openods import app, dataset
+
+
+class Adjacency(object):
+    """
+    Edges between organisations in compressed sparse row form. The edges leaving organisation i are
+    targets[offsets[i]:offsets[i + 1]], each with the matching entry of types.
+    """
+
+    __slots__ = ('offsets', 'targets', 'types')
+
+    def __init__(self, node_count, edges):
+        """
+        Builds the arrays from a list of (source, target, type) integer triples
+        """
+        edges = sorted(set(edges))
+
+        counts = [0] * (node_count + 1)
+        for source, _, _ in edges:
+            counts[source + 1] += 1
+
+        for i in range(node_count):
+            counts[i + 1] += counts[i]
+
+        self.offsets = array.array('l', counts)
+        self.targets = array.array('l', (target for _, target, _ in edges))
+        self.types = array.array('l', (edge_type for _, _, edge_type in edges))
+
+    def neighbours(self, node):
+        for i in range(self.offsets[node], self.offsets[node + 1]):
+            yield self.targets[i], self.types[i]
+
+
+class OrganisationGraph(object):
+    """
+    An index of the relationships and successions between organisations, built once for each version of the
+    dataset so that hierarchies can be walked without a query per level.
+
+    Organisations are numbered in order of ODS code. Active relationships are stored in both directions: from an
+    organisation to the organisations it is related to (e.g. a site to the trust that operates it), and back.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.odscodes = []
+        self.names = []
+        self.node_ids = {}
+        self.relationship_types = []
+        self.relationship_descriptions = {}
+        self.parents = None
+        self.children = None
+        self.successors = None
+
+    def build(self, organisations, relationships, successions, descriptions=None):
+        """
+        Builds the index from (odscode, name) pairs, (odscode, related odscode, relationship code) triples and
+        (predecessor odscode, successor odscode) pairs. Organisations which are only named by relationships or
+        successions are included without a name.
+        """
+        names = dict(organisations)
+
+        for odscode, target_odscode, _ in relationships:
+            names.setdefault(odscode, None)
+            names.setdefault(target_odscode, None)
+
+        for odscode, target_odscode in successions:
+            names.setdefault(odscode, None)
+            names.setdefault(target_odscode, None)
+
+        self.odscodes = sorted(names)
+        self.names = [names[odscode] for odscode in self.odscodes]
+        self.node_ids = {odscode: node for node, odscode in enumerate(self.odscodes)}
+
+        self.relationship_types = sorted({code for _, _, code in relationships})
+        type_ids = {code: type_id for type_id, code in enumerate(self.relationship_types)}
+        self.relationship_descriptions = dict(descriptions or {})
+
+        edges = [(self.node_ids[odscode], self.node_ids[target_odscode], type_ids[code])
+                 for odscode, target_odscode, code in relationships]
+
+        node_count = len(self.odscodes)
+        self.parents = Adjacency(node_count, edges)
+        self.children = Adjacency(node_count, [(target, source, edge_type) for source, target, edge_type in edges])
+        self.successors = Adjacency(node_count, [(self.node_ids[odscode], self.node_ids[target_odscode], 0)
+                                                 for odscode, target_odscode in successions])
+
+        return self
+
+    def load(self, conn):
+        """
+        Reads the organisations, relationships and successors from the database and builds the index
+        """
+        logger = logging.getLogger(__name__)
+        started = time.time()
+
+        cur = conn.cursor()
+
+        cur.execute("SELECT odscode, name FROM organisations WHERE odscode IS NOT NULL;")
+        organisations = cur.fetchall()
+
+        # Ended relationships are kept in the dataset, but are no longer part of the hierarchy
+        cur.execute("SELECT org_odscode, target_odscode, code "
+                    "FROM relationships "
+                    "WHERE status = 'Active' "
+                    "AND org_odscode IS NOT NULL "
+                    "AND target_odscode IS NOT NULL "
+                    "AND code IS NOT NULL;")
+        relationships = cur.fetchall()
+
+        # Each succession may be recorded against either organisation, so both are read as (predecessor, successor)
+        cur.execute("SELECT org_odscode, target_odscode FROM successors WHERE type = 'Successor' "
+                    "UNION "
+                    "SELECT target_odscode, org_odscode FROM successors WHERE type = 'Predecessor';")
+        successions = [row for row in cur.fetchall() if None not in row]
+
+        cur.execute("SELECT id, displayname FROM codesystems WHERE name = 'OrganisationRelationship';")
+        descriptions = cur.fetchall()
+
+        self.build(organisations, relationships, successions, descriptions)
+
+        logger.info(str.format('Built organisation graph for dataset version {0}|organisations={1}|'
+                               'relationships={2}|successions={3}|loadTime={4:.2f}s|',
+                               self.version, len(self.odscodes), len(relationships), len(successions),
+                               time.time() - started))
+
+        return self
+
+    def __contains__(self, odscode):
+        return odscode in self.node_ids
+
+    def traverse(self, odscode, adjacency, depth=None, relationship_types=None):
+        """
+        Walks the graph breadth first from an organisation, returning each organisation reached once, nearest
+        first, as a tuple of (node, depth, node it was reached from, relationship type id)
+        """
+        type_ids = None
+
+        if relationship_types is not None:
+            type_ids = {type_id for type_id, code in enumerate(self.relationship_types) if code in relationship_types}
+
+        start = self.node_ids[odscode]
+        seen = {start}
+        queue = collections.deque([(start, 0)])
+        reached = []
+
+        while queue:
+            node, node_depth = queue.popleft()
+
+            if depth is not None and node_depth >= depth:
+                continue
+
+            for neighbour, edge_type in adjacency.neighbours(node):
+                if neighbour in seen or (type_ids is not None and edge_type not in type_ids):
+                    continue
+
+                seen.add(neighbour)
+                reached.append((neighbour, node_depth + 1, node, edge_type))
+                queue.append((neighbour, node_depth + 1))
+
+        return reached
+
+    def describe(self, reached, with_relationships=True):
+        """
+        Formats the result of traverse for the API
+        """
+        result = []
+
+        for node, node_depth, from_node, edge_type in reached:
+            item = {
+                'odsCode': self.odscodes[node],
+                'depth': node_depth,
+                'fromOdsCode': self.odscodes[from_node],
+                'links': [{
+                    'rel': 'self',
+                    'href': str.format('{0}/organisations/{1}', app.config['APP_HOSTNAME'], self.odscodes[node])
+                }]
+            }
+
+            if self.names[node] is not None:
+                item['name'] = self.names[node]
+
+            if with_relationships:
+                code = self.relationship_types[edge_type]
+                item['relationshipType'] = code
+
+                if code in self.relationship_descriptions:
+                    item['relationshipDescription'] = self.relationship_descriptions[code]
+
+            result.append(item)
+
+        return result
+
+    def descendants(self, odscode, depth=None, relationship_types=None):
+        """
+        Returns the organisations related to the given one, e.g. the sites of a trust, and those related to them
+        """
+        return self.describe(self.traverse(odscode, self.children, depth, relationship_types))
+
+    def ancestors(self, odscode, depth=None, relationship_types=None):
+        """
+        Returns the organisations the given one is related to, e.g. the trust operating a site, and so on upwards
+        """
+        return self.describe(self.traverse(odscode, self.parents, depth, relationship_types))
+
+    def successor_chain(self, odscode, depth=None):
+        """
+        Returns the organisations which succeeded the given one, and those which succeeded them
+        """
+        return self.describe(self.traverse(odscode, self.successors, depth), with_relationships=False)
+
+
+_graphs = dataset.VersionedIndex(OrganisationGraph, 'relationship index')
+
+
+def get_graph():
+    """
+    Returns the relationship index of the current dataset, building it first if there isn't one
+    """
+    return _graphs.get(wait=True)
@@ -0,0 +1,242 @@
+import bisect
+import threading
+import time
+
+import psycopg2.extensions
+from flask import g, has_app_context, request
+
+from openods import app, request_utils
+
+# Upper bounds in seconds of the histogram buckets, following the Prometheus client defaults
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class Registry(object):
+    """
+    Holds the counters, gauges and histograms for this worker process, and renders them in the Prometheus text
+    format.
+    Each series is keyed by its metric name and a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, metric_type, help_text):
+        self._help[name] = (metric_type, help_text)
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._counters[(name, tuple(labels))] = value
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            key = (name, tuple(labels))
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            key = (name, tuple(labels))
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(DURATION_BUCKETS), 0, 0.0]
+
+            bucket = bisect.bisect_left(DURATION_BUCKETS, value)
+
+            if bucket < len(DURATION_BUCKETS):
+                histogram[0][bucket] += 1
+
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        lines = []
+
+        with self._lock:
+            for name, (metric_type, help_text) in sorted(self._help.items()):
+                lines.append(str.format('# HELP {0} {1}', name, help_text))
+                lines.append(str.format('# TYPE {0} {1}', name, metric_type))
+
+                for (series_name, labels), value in sorted(self._counters.items()):
+                    if series_name == name:
+                        lines.append(str.format('{0}{1} {2}', name, format_labels(labels), value))
+
+                for (series_name, labels), (buckets, count, total) in sorted(self._histograms.items()):
+                    if series_name != name:
+                        continue
+
+                    cumulative = 0
+
+                    for upper_bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                        cumulative += bucket_count
+                        lines.append(str.format('{0}_bucket{1} {2}', name,
+                                                format_labels(labels + (('le', repr(upper_bound)),)), cumulative))
+
+                    lines.append(str.format('{0}_bucket{1} {2}', name, format_labels(labels + (('le', '+Inf'),)),
+                                            count))
+                    lines.append(str.format('{0}_count{1} {2}', name, format_labels(labels), count))
+                    lines.append(str.format('{0}_sum{1} {2}', name, format_labels(labels), total))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(str.format('{0}="{1}"', label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for label, value in labels) + '}'
+
+
+registry = Registry()
+registry.describe('openods_requests_total', 'counter', 'Requests handled, by endpoint and status code')
+registry.describe('openods_request_duration_seconds', 'histogram', 'Time taken to handle requests, by endpoint')
+registry.describe('openods_db_queries_total', 'counter', 'Database queries run while handling requests, by endpoint')
+registry.describe('openods_db_query_duration_seconds', 'histogram', 'Time taken by each database query')
+registry.describe('openods_cache_requests_total', 'counter', 'Response cache lookups, by result')
+registry.describe('openods_serialization_duration_seconds', 'histogram', 'Time taken to encode JSON responses')
+registry.describe('openods_prepared_statements_total', 'counter',
+                  'Organisation list statements run, by whether they had to be prepared first or were reused')
+registry.describe('openods_startup_seconds', 'gauge', 'Time taken to import and configure the app')
+registry.describe('openods_api_spec_build_seconds', 'gauge', 'Time taken to build the Swagger spec')
+
+
+def _request_timings():
+    # Queries run outside of a request, e.g. by the snapshot loader, aren't attributed to anything
+    if not has_app_context():
+        return None
+
+    return g.get('timings')
+
+
+def record_query(seconds):
+    registry.observe('openods_db_query_duration_seconds', seconds)
+
+    timings = _request_timings()
+
+    if timings is not None:
+        timings['dbQueries'] += 1
+        timings['dbTime'] += seconds
+
+
+def record_cache(result):
+    registry.inc('openods_cache_requests_total', (('result', result),))
+
+    timings = _request_timings()
+
+    if timings is not None:
+        timings['cache'] = result
+
+
+def record_serialization(seconds):
+    registry.observe('openods_serialization_duration_seconds', seconds)
+
+    timings = _request_timings()
+
+    if timings is not None:
+        timings['serializeTime'] += seconds
+
+
+def get_request_timings():
+    """
+    Returns the timings of the current request so far as a dictionary of log fields, with times in milliseconds
+    """
+    timings = _request_timings()
+
+    if timings is None:
+        return {}
+
+    return {
+        'durationMs': round((time.perf_counter() - timings['started']) * 1000, 2),
+        'dbQueries': timings['dbQueries'],
+        'dbTimeMs': round(timings['dbTime'] * 1000, 2),
+        'cache': timings['cache'],
+        'serializeTimeMs': round(timings['serializeTime'] * 1000, 2),
+    }
+
+
+def format_request_timings():
+    """
+    Returns the timings of the current request as piped key=value pairs for the logType=Request log line
+    """
+    return request_utils.dict_to_piped_kv_pairs(get_request_timings())
+
+
+_timed_cursor_classes = {}
+
+
+def timed_cursor_class(cursor_class):
+    """
+    Returns a subclass of cursor_class which records how long each query takes
+    """
+    timed_class = _timed_cursor_classes.get(cursor_class)
+
+    if timed_class is None:
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return super(timed_class, self).execute(query, vars)
+            finally:
+                record_query(time.perf_counter() - started)
+
+        timed_class = type('Timed' + cursor_class.__name__, (cursor_class,), {'execute': execute})
+        _timed_cursor_classes[cursor_class] = timed_class
+
+    return timed_class
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """
+    A connection whose cursors, of whatever class, record how long their queries take
+    """
+
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = timed_cursor_class(cursor_class)
+        return super(TimedConnection, self).cursor(*args, **kwargs)
+
+
+@app.before_request
+def start_request_timings():
+    g.timings = {
+        'started': time.perf_counter(),
+        'dbQueries': 0,
+        'dbTime': 0.0,
+        'cache': 'none',
+        'serializeTime': 0.0,
+    }
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = _request_timings()
+
+    if timings is None:
+        return response
+
+    duration = time.perf_counter() - timings['started']
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    registry.inc('openods_requests_total', (('endpoint', endpoint), ('status', response.status_code)))
+    registry.observe('openods_request_duration_seconds', duration, (('endpoint', endpoint),))
+
+    if timings['dbQueries']:
+        registry.inc('openods_db_queries_total', (('endpoint', endpoint),), timings['dbQueries'])
+
+    response.headers['Server-Timing'] = str.format(
+        'db;dur={0:.2f};desc="{1} queries", cache;desc="{2}", serialize;dur={3:.2f}, total;dur={4:.2f}',
+        timings['dbTime'] * 1000, timings['dbQueries'], timings['cache'], timings['serializeTime'] * 1000,
+        duration * 1000)
+
+    return response
+
+
+def render_metrics():
+    """
+    Returns the metrics for this worker process in the Prometheus text format. When running several gunicorn
+    workers, each is scraped separately as it answers the request.
+    """
+    return registry.render()
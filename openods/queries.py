@@ -0,0 +1,63 @@
+# SQL shared by the modules that read organisation records from the database
+
+# The queries for an organisation's child records. Each is keyed on the organisation's ODS code so that it can
+# either be run on its own or embedded as a correlated subquery when fetching the whole document in one statement.
+ORGANISATION_ROLES_SQL = "SELECT r.code, csr.displayname, r.unique_id, r.status, " \
+                         "r.operational_start_date, r.operational_end_date, r.legal_start_date, " \
+                         "r.legal_end_date, r.primary_role " \
+                         "FROM roles r " \
+                         "LEFT JOIN codesystems csr on r.code = csr.id " \
+                         "WHERE r.org_odscode = {odscode} " \
+                         "AND csr.name = 'OrganisationRole'"
+
+ORGANISATION_RELATIONSHIPS_SQL = "SELECT rs.code, csr.displayname, rs.unique_id, rs.target_odscode, rs.status, " \
+                                 "rs.operational_start_date, rs.operational_end_date, rs.legal_start_date, " \
+                                 "rs.legal_end_date, o.name " \
+                                 "FROM relationships rs " \
+                                 "LEFT JOIN codesystems csr on rs.code = csr.id " \
+                                 "LEFT JOIN organisations o on rs.target_odscode = o.odscode " \
+                                 "WHERE rs.org_odscode = {odscode}"
+
+ORGANISATION_ADDRESSES_SQL = "SELECT address_line1, " \
+                             "address_line2, " \
+                             "address_line3, " \
+                             "town, county, " \
+                             "post_code, " \
+                             "country  " \
+                             "FROM addresses a " \
+                             "WHERE a.org_odscode = {odscode}"
+
+ORGANISATION_SUCCESSORS_SQL = "SELECT type, target_odscode as targetOdsCode, " \
+                              "o.name as targetName, " \
+                              "target_primary_role_code as targetPrimaryRoleCode, " \
+                              "unique_id as uniqueId " \
+                              "FROM successors s " \
+                              "LEFT JOIN organisations o on s.target_odscode = o.odscode " \
+                              "WHERE s.org_odscode = {odscode}"
+
+ORGANISATION_CHILDREN_SQL = (
+    ('_roles', ORGANISATION_ROLES_SQL),
+    ('_relationships', ORGANISATION_RELATIONSHIPS_SQL),
+    ('_addresses', ORGANISATION_ADDRESSES_SQL),
+    ('_successors', ORGANISATION_SUCCESSORS_SQL),
+)
+
+
+def organisation_children_subqueries(org_alias='org'):
+    """
+    Returns the correlated subqueries which aggregate each type of child record of the organisation aliased as
+    org_alias into a JSON array, in the order roles, relationships, addresses, successors
+    """
+    return [str.format("(SELECT COALESCE(json_agg(x), '[]') FROM ({0}) x)",
+                       sql.format(odscode=str.format('{0}.odscode', org_alias)))
+            for _, sql in ORGANISATION_CHILDREN_SQL]
+
+
+def organisation_children_columns(org_alias='org'):
+    """
+    Returns a select list of the child record subqueries, aliased as _roles, _relationships, _addresses and
+    _successors
+    """
+    return ", ".join(str.format("{0} AS {1}", subquery, name)
+                     for subquery, (name, _) in zip(organisation_children_subqueries(org_alias),
+                                                    ORGANISATION_CHILDREN_SQL))
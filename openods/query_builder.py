@@ -0,0 +1,265 @@
+import hashlib
+import logging
+import re
+import threading
+import weakref
+
+from openods import app, metrics
+
+# The names of the statements prepared on each connection. Prepared statements last for the life of the
+# connection (they aren't undone by a rollback), so the record is dropped along with the connection.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+_PLACEHOLDER = re.compile(r'%([%s])')
+
+# The facets the organisation list can be counted by, and the columns they are read from by org_list_facets
+FACET_COLUMNS = (
+    ('recordClass', 'o.record_class'),
+    ('status', 'o.status'),
+    ('primaryRoleCode', 'r.code'),
+)
+
+
+class Query(object):
+    """
+    A SQL statement built up from fragments, each referencing its own parameters with %s placeholders.
+
+    The text of a statement depends only on which fragments it was built from, and never on the values of their
+    parameters, so every request with the same combination of filters produces the same statement and can re-use
+    the plan prepared for it.
+    """
+
+    def __init__(self, sql=None, *params):
+        self.fragments = []
+        self.params = []
+
+        if sql is not None:
+            self.add(sql, *params)
+
+    def add(self, sql, *params):
+        if len(_PLACEHOLDER.findall(sql.replace('%%', ''))) != len(params):
+            raise ValueError(str.format('Expected {0} parameters for "{1}"', sql.count('%s'), sql))
+
+        self.fragments.append(sql)
+        self.params.extend(params)
+
+        return self
+
+    def extend(self, other):
+        self.fragments.extend(other.fragments)
+        self.params.extend(other.params)
+
+        return self
+
+    @property
+    def sql(self):
+        return ' '.join(self.fragments)
+
+    def numbered_sql(self):
+        """
+        Returns the statement with its placeholders numbered $1, $2 and so on, as PREPARE expects
+        """
+        numbers = iter(range(1, len(self.params) + 1))
+
+        return _PLACEHOLDER.sub(lambda match: '%' if match.group(1) == '%' else str.format('${0}', next(numbers)),
+                                self.sql)
+
+
+def org_list_filter(recordclass=None, primary_role_code_list=None, role_code_list=None,
+                    query=None, postcode=None, active=None, last_updated_since=None,
+                    legally_active=None):
+    """Builds the WHERE clause used to filter the list of organisations
+
+    The conditions are always added in the same order, so each combination of filters gives one statement.
+
+    Returns
+    -------
+    Query holding the WHERE clause
+    """
+
+    logger = logging.getLogger(__name__)
+
+    where = Query("WHERE TRUE")
+
+    # If a record_class parameter was specified, add that to the statement
+    if recordclass:
+        logger.debug('record_class parameter was provided')
+        where.add("AND record_class LIKE %s", recordclass)
+
+    # If a query parameter was specified, add that to the statement. The pattern is upper-cased here rather than in
+    # SQL so that the predicate is a plain LIKE against a constant, which the trigram index on name can answer
+    # despite the leading wildcard
+    if query:
+        logger.debug("q parameter was provided")
+        where.add("AND name LIKE %s", str.format("%{0}%", str.upper(query)))
+
+    # If a postcode parameter was specified, add that to the statement
+    if postcode:
+        logger.debug("postcode parameter was provided")
+        where.add("AND post_code LIKE %s", str.format("%{0}%", str.upper(postcode)))
+
+    # If the active parameter was specified, add that to the statement
+    if active:
+        logger.debug("active parameter was provided")
+
+        if active in (True, 1, '1', 'True', 'true', 'TRUE', 'yes', 'Yes', 'YES'):
+            where.add("AND status = %s", 'Active')
+        else:
+            where.add("AND status = %s", 'Inactive')
+
+    # If the last_changed_since parameter was specified, add that to the statement
+    if last_updated_since:
+        logger.debug("last_changed_since parameter was provided")
+        where.add("AND last_changed > %s", last_updated_since)
+
+    # If the legally_active parameter was specified, check for true or false, and append correct clause to query
+    if legally_active:
+        # If value for legallyActive parameter is any of the below list (True), filter the query to include only
+        # organisations that have a legal_end_date in the future, or do not have one
+        if legally_active in (True, 1, '1', 'True', 'true', 'TRUE', 'yes', 'Yes', 'YES'):
+            logger.debug("legally_active parameter was True")
+            where.add("AND (legal_end_date > now() or legal_end_date ISNULL)")
+
+        # If value for legallyActive parameter is any of the below list (False), filter the query to include only
+        # organisations that have a legal_end_date in the past and are therefore not legally active today
+        elif legally_active in (False, 0, '0', 'False', 'false', 'FALSE', 'no', 'No', 'NO'):
+            logger.debug("legally_active parameter was False")
+            where.add("AND legal_end_date < now()")
+
+        # If value for legallyActive parameter doesn't match the True or False list, ignore it
+        else:
+            logger.debug("legally_active parameter value not recognised - ignored")
+
+    # If a role_code parameter was specified, add that to the statement. The role conditions match the predicates
+    # of the partial indexes on roles (code, org_odscode), so each organisation is checked against the index alone.
+    if role_code_list:
+        logger.debug('role_code parameter was provided')
+        where.add("AND EXISTS "
+                  "(SELECT 1 "
+                  "FROM roles "
+                  "WHERE roles.org_odscode = organisations.odscode "
+                  "AND roles.status = 'Active' "
+                  "AND roles.code = ANY(%s))",
+                  role_code_list)
+
+    # Or if a primary_role_code parameter was specified, add that to the statement
+    elif primary_role_code_list:
+        logger.debug('primary_role_code parameter was provided')
+        where.add("AND EXISTS "
+                  "(SELECT 1 "
+                  "FROM roles "
+                  "WHERE roles.org_odscode = organisations.odscode "
+                  "AND roles.status = 'Active' "
+                  "AND roles.primary_role = TRUE "
+                  "AND roles.code = ANY(%s))",
+                  primary_role_code_list)
+
+    return where
+
+
+def org_list_page(where, offset, limit, after=None, count_in_page=False, relevance_query=None):
+    """
+    Builds the statement for a page of the organisations matched by where, ordered by name with unnamed
+    organisations last (or by how closely their names match relevance_query), starting after the (name, odscode)
+    in after or else at offset
+    """
+    columns = str.format("odscode, name, record_class, status, post_code{0}",
+                         ", COUNT(*) OVER() AS total_count" if count_in_page else "")
+
+    # If resuming from a cursor, seek past the last record of the previous page rather than using an offset
+    # so that the (name, odscode) index can be used to jump straight to the start of the page
+    if after and after[0] is None:
+        page = Query(str.format("SELECT {0} FROM organisations", columns)).extend(where)
+        page.add("AND name IS NULL AND odscode > %s", after[1])
+        offset = 0
+    elif after:
+        # Unnamed organisations sort after every name but fail the row comparison, so they are fetched by a
+        # second branch rather than an OR, which would stop the index from being used for the first
+        page = Query(str.format("SELECT {0} FROM ((SELECT {0} FROM organisations", columns)).extend(where)
+        page.add("AND (name, odscode) > (%s, %s) ORDER BY name, odscode LIMIT %s)", after[0], after[1], limit)
+        page.add(str.format("UNION ALL (SELECT {0} FROM organisations", columns)).extend(where)
+        page.add("AND name IS NULL ORDER BY odscode LIMIT %s)) after_cursor", limit)
+        offset = 0
+    else:
+        page = Query(str.format("SELECT {0} FROM organisations", columns)).extend(where)
+
+    # If ranking search results, put the closest trigram matches to the search term first
+    if relevance_query:
+        page.add("ORDER BY similarity(name, %s) DESC, name NULLS LAST, odscode", str.upper(relevance_query))
+    else:
+        page.add("ORDER BY name NULLS LAST, odscode")
+
+    return page.add("OFFSET %s LIMIT %s", offset, limit)
+
+
+def org_list_facets(where, facets):
+    """
+    Builds the statement counting the organisations matched by where by each value of the facets named, in one
+    grouped aggregate. Each row holds a value of one facet, flagged by a grouped_<n> column of 0, and its count.
+    Organisations without an active primary role are counted under a null primaryRoleCode.
+    """
+    columns = [column for facet, column in FACET_COLUMNS if facet in facets]
+
+    statement = Query(str.format("SELECT {0}, COUNT(DISTINCT o.odscode) AS count "
+                                 "FROM (SELECT odscode, record_class, status FROM organisations",
+                                 ", ".join(str.format("{0} AS value_{1}, GROUPING({0}) AS grouped_{1}", column, number)
+                                           for number, column in enumerate(columns))))
+    statement.extend(where)
+    statement.add(") o")
+
+    if 'primaryRoleCode' in facets:
+        statement.add("LEFT JOIN roles r "
+                      "ON r.org_odscode = o.odscode "
+                      "AND r.status = 'Active' "
+                      "AND r.primary_role = TRUE")
+
+    return statement.add(str.format("GROUP BY GROUPING SETS ({0})",
+                                    ", ".join(str.format("({0})", column) for column in columns)))
+
+
+def org_list_count(where):
+    """
+    Builds the statement counting every organisation matched by where
+    """
+    return Query("SELECT COUNT(*) FROM organisations").extend(where)
+
+
+def org_list_estimate(where):
+    """
+    Builds the statement returning the query planner's estimate of the number of organisations matched by where
+    """
+    return Query("EXPLAIN (FORMAT JSON) SELECT odscode FROM organisations").extend(where)
+
+
+def statement_name(sql):
+    return 'openods_' + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:16]
+
+
+def execute(cur, query, prepare=True):
+    """
+    Runs a query on a cursor. Unless prepared statements are disabled (or prepare is False), the query is prepared
+    the first time a statement of its shape is run on the cursor's connection, and executed from then on by name,
+    so that the statement is only parsed once and its plan can be cached.
+    """
+    if not (prepare and app.config['PREPARED_STATEMENTS_ENABLED']):
+        cur.execute(query.sql, query.params)
+        return
+
+    sql = query.numbered_sql()
+    name = statement_name(sql)
+
+    with _prepared_lock:
+        prepared = _prepared.setdefault(cur.connection, set())
+
+    if name not in prepared:
+        cur.execute(str.format("PREPARE {0} AS {1}", name, sql))
+        prepared.add(name)
+        metrics.registry.inc('openods_prepared_statements_total', (('result', 'prepared'),))
+    else:
+        metrics.registry.inc('openods_prepared_statements_total', (('result', 'reused'),))
+
+    if query.params:
+        cur.execute(str.format("EXECUTE {0} ({1})", name, ', '.join(['%s'] * len(query.params))), query.params)
+    else:
+        cur.execute(str.format("EXECUTE {0}", name))
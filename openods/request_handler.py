@@ -1,8 +1,13 @@
+import collections
+import csv
+import datetime
+import io
 import logging
+import urllib.parse
 
-from flask import jsonify, g, abort
+from flask import g, abort, Response, stream_with_context
 
-from openods import app, db
+from openods import app, db, documents, geo, graph, query_builder, request_utils, serializer
 from openods import cache as ocache
 
 
@@ -10,8 +15,7 @@ def ping_database():
     return db.ping_database()
 
 
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
 def get_root_response():
     logger = logging.getLogger(__name__)
     logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
@@ -24,11 +28,10 @@ def get_root_response():
                                  app.config['APP_HOSTNAME'])
     }
 
-    return root_resource
+    return serializer.json_response(root_resource)
 
 
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
 def get_info_response():
     logger = logging.getLogger(__name__)
     logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
@@ -36,23 +39,14 @@ def get_info_response():
 
     dataset_info = db.get_dataset_info()
 
-    return dataset_info
+    return serializer.json_response(dataset_info)
 
 
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
-def get_organisations_response(request):
-    logger = logging.getLogger(__name__)
-    logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
-                            g.request_id))
-
-    # Collect any query parameters that were supplied
+# Collects the parameters used to filter the list of organisations from the request. These are shared by the
+# list and export endpoints, and are returned with the names of the matching db.get_org_list arguments.
+def get_org_list_filters(request):
     query = request.args.get('q') if request.args.get('q') else None
 
-    offset = request.args.get('offset') if request.args.get('offset') else 0
-
-    limit = request.args.get('limit') if request.args.get('limit') else 20
-
     record_class = request.args.get('recordClass') \
         if request.args.get('recordClass') \
         else None
@@ -105,41 +99,289 @@ def get_organisations_response(request):
         if request.args.get('legallyActive') \
         else None
 
-    # Call the get_org_list method from the database controller,
-    # passing in parameters. Method will return a tuple containing the data
-    # and the total record count for the specified filter.
-    data, total_record_count = db.get_org_list(offset, limit, record_class,
-                                               primary_role_code_list,
-                                               role_code_list, query, postcode,
-                                               active, last_updated_since,
-                                               legally_active)
+    return {
+        'recordclass': record_class,
+        'primary_role_code_list': primary_role_code_list,
+        'role_code_list': role_code_list,
+        'query': query,
+        'postcode': postcode,
+        'active': active,
+        'last_updated_since': last_updated_since,
+        'legally_active': legally_active,
+    }
+
+
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
+def get_organisations_response(request):
+    logger = logging.getLogger(__name__)
+    logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
+                            g.request_id))
+
+    # Collect any query parameters that were supplied
+    filters = get_org_list_filters(request)
+
+    query = filters['query']
+
+    offset = request.args.get('offset') if request.args.get('offset') else 0
+
+    limit = request.args.get('limit') if request.args.get('limit') else 20
+
+    cursor = request.args.get('cursor') \
+        if request.args.get('cursor') \
+        else None
+
+    # Search results can be ranked by how closely names match the search term instead of alphabetically
+    order_by_relevance = request.args.get('sort') == 'relevance' and query is not None
+
+    # A cursor takes the place of offset, resuming the listing after the last record of the previous page.
+    # Cursors follow the alphabetical ordering, so can't be combined with relevance ranking.
+    if cursor and order_by_relevance:
+        abort(400)
+    elif cursor:
+        try:
+            after = request_utils.decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+    else:
+        after = None
+
+    # Clients that don't need X-Total-Count can ask for it to be estimated or skipped, as counting every
+    # organisation matching a broad filter costs as much as fetching the page itself
+    total_count = request.args.get('totalCount')
+
+    if total_count == 'estimate':
+        count_mode = 'estimate'
+    elif total_count in ('none', '0', 'False', 'false', 'FALSE', 'no', 'No', 'NO'):
+        count_mode = 'none'
+    else:
+        count_mode = 'exact'
+
+    facets = get_facets(request)
+
+    near = request.args.get('near') if request.args.get('near') else None
+    nearby = None
+
+    if near:
+        # Results near a postcode are ordered by distance, so are paged by offset rather than by cursor
+        if cursor or order_by_relevance:
+            abort(400, 'near cannot be combined with cursor or sort=relevance')
+
+        radius = get_radius(request)
+        location = geo.find_postcode(near)
+
+        if location is None:
+            abort(400, 'near must be a known postcode')
+
+        latitude, longitude = location
+        nearby = geo.get_index().near(latitude, longitude, radius)
+        data, total_record_count = db.get_org_list_near(nearby, offset, limit, **filters)
+
+        # The matching organisations are all read to sort them by distance, so the total is always exact
+        if count_mode == 'none':
+            total_record_count = None
+
+        count_estimated = False
+
+    else:
+        # Call the get_org_list method from the database controller,
+        # passing in parameters. Method will return a tuple containing the data
+        # and the total record count for the specified filter.
+        data, total_record_count, count_estimated = db.get_org_list(offset, limit, after=after,
+                                                                    count_mode=count_mode,
+                                                                    order_by_relevance=order_by_relevance,
+                                                                    **filters)
+
+    # Counts by facet cover every organisation matching the filters, not just those on this page
+    if facets:
+        facet_counts = db.get_org_facets(facets,
+                                         odscodes=[odscode for odscode, _ in nearby] if near else None,
+                                         **filters)
+    else:
+        facet_counts = None
 
     if data:
         results = {'organisations': data}
-        resp = jsonify(results)
-        resp.headers['X-Total-Count'] = total_record_count
-        resp.headers['Access-Control-Expose-Headers'] = 'X-Total-Count'
+
+        if facet_counts is not None:
+            results['facets'] = facet_counts
+        next_page_href = get_next_page_href(request, data, limit,
+                                            offset if order_by_relevance or near else None)
+
+        # Clients paging by cursor are given the link to the next page in the body as well as the Link header
+        if cursor and next_page_href:
+            results['links'] = [{
+                'rel': 'next',
+                'href': next_page_href
+            }]
+
+        resp = serializer.json_response(results)
+        exposed_headers = []
+
+        if total_record_count is not None:
+            resp.headers['X-Total-Count'] = total_record_count
+            exposed_headers.append('X-Total-Count')
+
+        if count_estimated:
+            resp.headers['X-Total-Count-Estimated'] = 'true'
+            exposed_headers.append('X-Total-Count-Estimated')
+
+        if next_page_href:
+            resp.headers['Link'] = str.format('<{0}>; rel="next"', next_page_href)
+            exposed_headers.append('Link')
+
+        if exposed_headers:
+            resp.headers['Access-Control-Expose-Headers'] = ', '.join(exposed_headers)
+
         return resp
 
     else:
         result = {'organisations': []}
-        resp = jsonify(result)
-        resp.headers['X-Total-Count'] = 0
-        resp.headers['Access-Control-Expose-Headers'] = 'X-Total-Count'
+
+        if facet_counts is not None:
+            result['facets'] = facet_counts
+
+        resp = serializer.json_response(result)
+
+        if count_mode != 'none':
+            resp.headers['X-Total-Count'] = 0
+            resp.headers['Access-Control-Expose-Headers'] = 'X-Total-Count'
+
         return resp
 
 
+# Reads the list of facets to count the organisations by, returning a 400 response if any of them can't be counted
+def get_facets(request):
+    if not request.args.get('facets'):
+        return None
+
+    facets = request.args.get('facets').split(',')
+    facet_names = [facet for facet, _ in query_builder.FACET_COLUMNS]
+
+    if any(facet not in facet_names for facet in facets):
+        abort(400, str.format('facets must be one or more of {0}', ', '.join(facet_names)))
+
+    return facets
+
+
+# Reads the number of results asked for, returning a 400 response if it isn't a whole number greater than 0
+def get_limit(request, default):
+    if not request.args.get('limit'):
+        return default
+
+    try:
+        limit = int(request.args.get('limit'))
+    except ValueError:
+        limit = None
+
+    if limit is None or limit < 1:
+        abort(400, 'limit must be a whole number greater than 0')
+
+    return limit
+
+
+# Reads the radius in km of a search near a postcode, returning a 400 response if it isn't a number greater than
+# 0 and no more than NEAR_MAX_RADIUS_KM
+def get_radius(request):
+    if not request.args.get('radius'):
+        return min(5.0, app.config['NEAR_MAX_RADIUS_KM'])
+
+    try:
+        radius = float(request.args.get('radius'))
+    except ValueError:
+        radius = None
+
+    if radius is None or not 0 < radius <= app.config['NEAR_MAX_RADIUS_KM']:
+        abort(400, str.format('radius must be a number of km greater than 0 and no more than {0:g}',
+                              app.config['NEAR_MAX_RADIUS_KM']))
+
+    return radius
+
+
+# Handles a request for an export of every organisation matching the list filters.
+# The organisations are streamed to the client as they are read from the database, either as newline delimited
+# JSON (the default) or as CSV with a header row, so that the whole register can be downloaded in one request.
+# Returns a 400 response if the format isn't recognised.
+def get_organisations_export_response(request):
+    logger = logging.getLogger(__name__)
+    logger.debug(str.format('requestId="{0}"|Streaming data from database|',
+                            g.request_id))
+
+    export_format = request.args.get('format', 'ndjson')
+
+    if export_format not in ('ndjson', 'csv'):
+        abort(400, 'format must be one of ndjson or csv')
+
+    organisations = db.iter_org_list(**get_org_list_filters(request))
+
+    if export_format == 'csv':
+        resp = Response(stream_with_context(generate_csv(organisations)), mimetype='text/csv')
+        resp.headers['Content-Disposition'] = 'attachment; filename=organisations.csv'
+    else:
+        resp = Response(stream_with_context(generate_ndjson(organisations)), mimetype='application/x-ndjson')
+
+    return resp
+
+
+def generate_ndjson(organisations):
+    for organisation in organisations:
+        yield serializer.dumps(organisation) + b'\n'
+
+
+def generate_csv(organisations):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([field for field, column in db.EXPORT_FIELDS])
+
+    for organisation in organisations:
+        writer.writerow([organisation[field] for field, column in db.EXPORT_FIELDS])
+
+        # Hand each line over as it's written rather than building up the whole file
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+# Builds the link to the page of organisations following the one in data. Where possible this uses a cursor so
+# that the next page can be read from the index rather than by skipping over all of the preceding records, but
+# pages in an order the cursor can't resume (such as by relevance) are linked by offset instead.
+# Returns None if data is the last page.
+def get_next_page_href(request, data, limit, offset=None):
+    if len(data) < min(int(limit), 1000):
+        return None
+
+    args = [(k, v) for k, v in request.args.items(multi=True) if k not in ('offset', 'cursor')]
+
+    if offset is not None:
+        args.append(('offset', int(offset) + len(data)))
+    else:
+        last_record = data[-1]
+        args.append(('cursor', request_utils.encode_cursor(last_record['name'], last_record['odsCode'])))
+
+    return str.format('{0}/organisations?{1}',
+                      app.config['APP_HOSTNAME'],
+                      urllib.parse.urlencode(args))
+
+
 # Handles the request for a single organisation resource.
 # Takes an ODS code and returns the record from the database.
 # If record exists a JSON object is returned with a 200 response.
 # If record does not exist a 404 response is returned.
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'], per_organisation=True)
 def get_single_organisation_response(ods_code):
     logger = logging.getLogger(__name__)
     logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
                             g.request_id))
 
+    # Serve the finished document if one has been built for the current dataset, only falling back to building
+    # it from the database when it hasn't
+    if app.config['DOCUMENT_STORE_ENABLED']:
+        document = documents.get_document(ods_code)
+
+        if document is not None:
+            return documents.document_response(document)
+
     data = db.get_organisation_by_odscode(ods_code)
 
     if data:
@@ -149,19 +391,223 @@ def get_single_organisation_response(ods_code):
         except KeyError:
             pass
 
-        result = jsonify(data)
+        result = serializer.json_response(data)
         return result
 
     else:
         abort(404)
 
 
+# Handles a request for several organisation resources at once.
+# Takes a JSON body of the form {"odsCodes": ["RRF12", ...]} and returns a 200 response with a JSON object
+# holding each organisation keyed by its ODS code, or null for codes which don't exist.
+# Returns a 400 response if the body is invalid or contains more than BATCH_MAX_ORGANISATIONS codes.
+def get_batch_organisations_response(request):
+    logger = logging.getLogger(__name__)
+    logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
+                            g.request_id))
+
+    body = request.get_json(force=True, silent=True)
+    ods_codes = body.get('odsCodes') if isinstance(body, dict) else None
+
+    if not isinstance(ods_codes, list) or not all(isinstance(ods_code, str) for ods_code in ods_codes):
+        abort(400, 'Request body must contain a list of odsCodes')
+
+    # Ensure the provided codes are in upper case and only looked up once
+    ods_codes = list(collections.OrderedDict.fromkeys(str.upper(ods_code) for ods_code in ods_codes))
+
+    if len(ods_codes) > app.config['BATCH_MAX_ORGANISATIONS']:
+        abort(400, str.format('No more than {0} odsCodes can be requested at once',
+                              app.config['BATCH_MAX_ORGANISATIONS']))
+
+    return serializer.json_response({'organisations': get_organisation_documents(ods_codes)})
+
+
+# Looks up the full representation of several organisations at once, as returned for a single organisation.
+# Returns an ordered dictionary of ODS code to the organisation, or None if it doesn't exist.
+def get_organisation_documents(ods_codes):
+    data = collections.OrderedDict.fromkeys(ods_codes)
+
+    # Prebuilt documents are copied into the response as they are, and only the rest are built from the database
+    if app.config['DOCUMENT_STORE_ENABLED']:
+        for ods_code, document in documents.get_documents(ods_codes).items():
+            data[ods_code] = serializer.Fragment(document)
+
+    missing_ods_codes = [ods_code for ods_code in ods_codes if data[ods_code] is None]
+
+    if missing_ods_codes:
+        data.update(db.get_organisations_by_odscodes(missing_ods_codes))
+
+    for organisation in data.values():
+        if isinstance(organisation, dict):
+            organisation.pop('org_lastchanged', None)
+
+    return data
+
+
+# Handles a request for the organisations feed, which lists organisations in the order they were last changed.
+# Each page carries a cursor marking the point reached, which the client keeps and passes back to receive only the
+# organisations changed after it. Organisations removed by a delta import are listed with removed set. With
+# include=documents, the full representation of each organisation is included so that a copy of the register can
+# be kept up to date without fetching each one separately.
+# Returns a 400 response if the since date, cursor or limit isn't valid.
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
+def get_organisation_changes_response(request):
+    logger = logging.getLogger(__name__)
+    logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
+                            g.request_id))
+
+    since = request.args.get('since')
+    cursor = request.args.get('cursor')
+    limit = get_limit(request, 100)
+    include = request.args.get('include')
+
+    if include not in (None, 'documents'):
+        abort(400, 'include must be documents')
+
+    if cursor:
+        try:
+            after = request_utils.decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+
+        # Every change in the feed has a date, so a cursor without one wasn't taken from it
+        if after[0] is None:
+            abort(400)
+
+    elif since:
+        try:
+            datetime.datetime.strptime(since, '%Y-%m-%d')
+        except ValueError:
+            abort(400, 'since must be a date in the format YYYY-MM-DD')
+
+        # Starts before the first organisation changed on the since date
+        after = (since, '')
+
+    else:
+        after = None
+
+    changes = db.get_org_changes(after, limit)
+
+    if include == 'documents':
+        organisations = get_organisation_documents([change['odsCode'] for change in changes
+                                                    if not change.get('removed')])
+
+        for change in changes:
+            if not change.get('removed'):
+                change['organisation'] = organisations[change['odsCode']]
+
+    if changes:
+        after = (changes[-1]['lastChangeDate'], changes[-1]['odsCode'])
+
+    results = {'changes': changes}
+    resp_headers = {}
+
+    # A cursor is returned even with the last page, so the client can come back later for anything changed since
+    if after:
+        next_cursor = request_utils.encode_cursor(*after)
+        results['cursor'] = next_cursor
+
+        if len(changes) >= min(int(limit), 1000):
+            args = [(k, v) for k, v in request.args.items(multi=True) if k not in ('since', 'cursor')]
+            args.append(('cursor', next_cursor))
+            next_page_href = str.format('{0}/organisations/changes?{1}',
+                                        app.config['APP_HOSTNAME'],
+                                        urllib.parse.urlencode(args))
+
+            results['links'] = [{
+                'rel': 'next',
+                'href': next_page_href
+            }]
+            resp_headers['Link'] = str.format('<{0}>; rel="next"', next_page_href)
+            resp_headers['Access-Control-Expose-Headers'] = 'Link'
+
+    resp = serializer.json_response(results)
+    resp.headers.extend(resp_headers)
+
+    return resp
+
+
+def get_graph_traversal_filters(request):
+    """
+    Reads the depth and relationshipType parameters of the graph endpoints, returning a 400 response if the depth
+    isn't a positive whole number
+    """
+    depth = request.args.get('depth') if request.args.get('depth') else None
+
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            abort(400, 'depth must be a positive whole number')
+
+        if depth < 1:
+            abort(400, 'depth must be a positive whole number')
+
+    if request.args.get('relationshipType'):
+        relationship_types = {code.upper() for code in request.args.get('relationshipType').split(',')}
+    else:
+        relationship_types = None
+
+    return depth, relationship_types
+
+
+def get_graph_response(ods_code, results_name, traversal):
+    """
+    Returns a 200 response listing the organisations found by traversal, a function of the graph, or a 404 response
+    if the organisation isn't in the graph
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(str.format('requestId="{0}"|Retrieving data from organisation graph|',
+                            g.request_id))
+
+    organisation_graph = graph.get_graph()
+
+    if ods_code not in organisation_graph:
+        abort(404)
+
+    result = {
+        'odsCode': ods_code,
+        results_name: traversal(organisation_graph)
+    }
+
+    return serializer.json_response(result)
+
+
+# Handles a request for the organisations below an organisation in the hierarchy, e.g. the sites of a trust
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
+def get_organisation_descendants_response(request, ods_code):
+    depth, relationship_types = get_graph_traversal_filters(request)
+
+    return get_graph_response(ods_code, 'descendants',
+                              lambda organisation_graph: organisation_graph.descendants(ods_code, depth,
+                                                                                        relationship_types))
+
+
+# Handles a request for the organisations above an organisation in the hierarchy, e.g. the trust operating a site
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
+def get_organisation_ancestors_response(request, ods_code):
+    depth, relationship_types = get_graph_traversal_filters(request)
+
+    return get_graph_response(ods_code, 'ancestors',
+                              lambda organisation_graph: organisation_graph.ancestors(ods_code, depth,
+                                                                                      relationship_types))
+
+
+# Handles a request for the organisations which have succeeded an organisation, in the order they did so
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
+def get_organisation_successor_chain_response(request, ods_code):
+    depth, _ = get_graph_traversal_filters(request)
+
+    return get_graph_response(ods_code, 'successors',
+                              lambda organisation_graph: organisation_graph.successor_chain(ods_code, depth))
+
+
 # Handles a request for a list of role-types resources.
 # Returns a 200 response with a JSON object containing a list of role-type
 # resources.
 # TODO: Add logic to handle no records found (low priority as shouldn't happen
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
 def get_role_types_response():
     logger = logging.getLogger(__name__)
     logger.debug(str.format('requestId="{0}"|Retrieving data from database|',
@@ -173,15 +619,14 @@ def get_role_types_response():
         'role-types': roles_list
     }
 
-    return jsonify(result)
+    return serializer.json_response(result)
 
 
 # Handles request for a specific role-type resource taking a single Role Code
 # as the ID.
 # Returns a 200 response with a JSON object for the resource
 # TODO: Add logic to handle record not found scenario
-@ocache.cache.cached(timeout=app.config['CACHE_TIMEOUT'],
-                     key_prefix=ocache.generate_cache_key)
+@ocache.cached(timeout=app.config['CACHE_TIMEOUT'])
 def get_role_type_by_code_response(role_code):
     """
     Returns the list of available OrganisationRole types
@@ -193,4 +638,4 @@ def get_role_type_by_code_response(role_code):
 
     result = db.get_role_type_by_id(role_code)
 
-    return jsonify(result)
+    return serializer.json_response(result)
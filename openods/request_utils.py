@@ -1,3 +1,5 @@
+import base64
+import json
 import uuid
 from flask import g
 
@@ -20,8 +22,12 @@ def get_source_ip(my_request):
     return source_ip
 
 
-# Utility method to get the request_id from the X-Request-Id header, and if not present generate one
+# Utility method to get the request_id from the X-Request-Id header, and if not present generate one.
+# The same id is returned for every call made during a request.
 def get_request_id(my_request):
+    if 'request_id' in g:
+        return g.request_id
+
     try:
         request_id = my_request.headers['X-Request-Id']
     except KeyError:
@@ -38,3 +44,22 @@ def dict_to_piped_kv_pairs(dict_for_conversion):
     for key, value in sorted(dict_for_conversion.items()):
         output_string += "{0}={1}|".format(key, value)
     return output_string
+
+
+# Utility method which encodes the sort key of the last record on a page, e.g. its name and ODS code, as an opaque
+# cursor for the next page. A missing name is encoded as null.
+def encode_cursor(sort_value, ods_code):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, ods_code]).encode('utf-8')).decode('ascii')
+
+
+# Utility method which decodes a cursor produced by encode_cursor, raising ValueError if it is not valid
+def decode_cursor(cursor):
+    try:
+        sort_value, ods_code = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError(str.format("Invalid cursor: {0}", cursor))
+
+    if not ((sort_value is None or isinstance(sort_value, str)) and isinstance(ods_code, str)):
+        raise ValueError(str.format("Invalid cursor: {0}", cursor))
+
+    return sort_value, ods_code
@@ -1,14 +1,33 @@
 import logging
 import os
+import time
 
 from flasgger import Swagger
 from flask import jsonify, request, g, json, redirect, url_for, send_from_directory
 
-from openods import app
+from openods import app, connection, metrics, schema_check
+from openods import cache as ocache
+from openods.conditional import conditional
 from openods import request_handler, request_utils
 from openods.config_swagger import template
 
-Swagger(app, template=template)
+
+class CachedSwagger(Swagger):
+    """
+    Builds the Swagger spec from the route docstrings on the first request for it, and then serves the same spec
+    for the life of the process, including in debug mode where flasgger would rebuild it every time
+    """
+
+    def get_apispecs(self, endpoint='apispec_1'):
+        if endpoint not in self.apispecs:
+            started = time.perf_counter()
+            super(CachedSwagger, self).get_apispecs(endpoint)
+            metrics.registry.set('openods_api_spec_build_seconds', time.perf_counter() - started)
+
+        return self.apispecs[endpoint]
+
+
+CachedSwagger(app, template=template)
 
 
 # HTTP error handling
@@ -28,7 +47,8 @@ def not_found(error):
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|statusCode={status_code}|'
                 'errorText="{error_text}"|path="{path}"|'
-                'sourceIp={source_ip}|url="{url}"|'.format(
+                'sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     request_id=g.request_id,
                     source_ip=g.source_ip,
                     path=request.path,
@@ -45,6 +65,40 @@ def not_found(error):
     ), 404
 
 
+@app.errorhandler(400)
+def bad_request(error):
+
+    try:
+        g.request_id
+    except AttributeError:
+        request_utils.get_request_id(request)
+
+    try:
+        g.source_ip
+    except AttributeError:
+        request_utils.get_source_ip(request)
+
+    logger = logging.getLogger(__name__)
+    logger.info('logType=Request|requestId="{request_id}"|statusCode={status_code}|'
+                'errorText="{error_text}"|path="{path}"|'
+                'sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
+                    request_id=g.request_id,
+                    source_ip=g.source_ip,
+                    path=request.path,
+                    url=request.url,
+                    status_code=error.code,
+                    error_text=error.description)
+                )
+
+    return jsonify(
+        {
+            'errorCode': 400,
+            'errorText': 'Bad request'
+        }
+    ), 400
+
+
 @app.route('/favicon.ico', methods=['GET'])
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
@@ -69,7 +123,10 @@ def get_status():
                                                                status_code=200))
         return jsonify(
             {
-                'status': 'OK'
+                'status': 'OK',
+                'connectionPool': connection.get_pool_stats(),
+                'cache': ocache.get_cache_stats(),
+                'schema': schema_check.get_schema_status()
             }
         )
     else:
@@ -82,17 +139,30 @@ def get_status():
                                                                status_code=500))
         return jsonify(
             {
-                'status': 'ERROR'
+                'status': 'ERROR',
+                'connectionPool': connection.get_pool_stats(),
+                'cache': ocache.get_cache_stats(),
+                'schema': schema_check.get_schema_status()
             }
         ), 500
 
 
+@app.route(app.config['API_PATH'] + '/v1' + '/metrics')
+def get_metrics():
+    """
+    Returns the request, database, cache and serialization metrics for the worker process which handles the
+    request, in the Prometheus text format
+    """
+    return app.response_class(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def root():
     return redirect(url_for('get_root'))
 
 
 @app.route(app.config['API_PATH'], methods=['GET'])
+@conditional
 def get_root():
     """Endpoint returning information about available resources
     ---
@@ -110,7 +180,8 @@ def get_root():
     
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|statusCode={status_code}|path="{path}"|'
-                'sourceIp={source_ip}|url="{url}"|{parameters}'.format(
+                'sourceIp={source_ip}|url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     request_id=g.request_id,
                     source_ip=g.source_ip,
                     path=request.path,
@@ -124,10 +195,11 @@ def get_root():
         request_id=g.request_id)
     )
 
-    return jsonify(root_resource)
+    return root_resource
 
 
 @app.route(app.config['API_PATH'] + "/info", methods=['GET'])
+@conditional
 def get_info():
     """Endpoint returning information about the current ODS dataset
     ---
@@ -138,9 +210,13 @@ def get_info():
     request_utils.get_request_id(request)
     request_utils.get_source_ip(request)
 
+    dataset_info = request_handler.get_info_response()
+
+    # Logged once the response has been built, so that the timings cover the work done for it
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|'
-                'path="{path}"|sourceIp={source_ip}|url="{url}|"'.format(
+                'path="{path}"|sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     request_id=g.request_id,
                     source_ip=g.source_ip,
                     path=request.path,
@@ -148,12 +224,11 @@ def get_info():
                     )
                 )
 
-    dataset_info = request_handler.get_info_response()
-
-    return jsonify(dataset_info)
+    return dataset_info
 
 
 @app.route(app.config['API_PATH'] + "/organisations", methods=['GET'])
+@conditional
 def get_organisations():
     """
     Endpoint returning a list of ODS organisations
@@ -169,15 +244,57 @@ def get_organisations():
         in: query
         type: integer
         required: false
+      - name: cursor
+        description: Starts result set after the last record of a previous page. Takes the value from the
+          'next' link of the previous page, and is used instead of offset when walking large result sets.
+        in: query
+        type: string
+        required: false
+      - name: totalCount
+        description: exact (default) - returns the total number of matching records in the X-Total-Count header.
+          estimate - returns an estimate of the total, flagged by an X-Total-Count-Estimated header.
+          none - the X-Total-Count header is not returned.
+        in: query
+        type: string
+        enum: ['exact', 'estimate', 'none']
+        required: false
       - name: q
         description: Filters results by names which contain the specified string
         in: query
         type: string
         required: false
+      - name: sort
+        description: relevance - orders results by how closely their names match the q parameter, rather than
+          alphabetically. Ignored if q is not specified, or if the database doesn't have the pg_trgm extension.
+        in: query
+        type: string
+        enum: ['name', 'relevance']
+        required: false
       - name: postCode
         description: Filters results to only those with a postcode containing the specified value
         in: query
         type: string
+      - name: near
+        description: Filters results to only those within radius of the specified postcode, and orders them
+          nearest first, giving each its distance in km. Can't be used with cursor or sort=relevance.
+        in: query
+        type: string
+        required: false
+      - name: radius
+        description: The distance in km searched around the near postcode (default 5, up to 50)
+        in: query
+        type: number
+        required: false
+      - name: facets
+        description: Adds 'facets' to the response, counting every organisation matching the filters by each
+          value of the named fields, largest count first
+        in: query
+        type: array
+        items:
+          type: string
+          enum: ['recordClass', 'status', 'primaryRoleCode']
+        collectionFormat: csv
+        required: false
       - name: active
         description: true - filters results to only those with a status of 'Active'.
           false - filters results to only those with a status of 'Inactive'
@@ -216,6 +333,8 @@ def get_organisations():
     responses:
       200:
         description: A filtered list of organisation resources
+      400:
+        description: The near postcode is unknown, or the cursor, radius or facets are invalid
     """
 
     request_utils.get_request_id(request)
@@ -228,7 +347,8 @@ def get_organisations():
     parameters_as_string = request_utils.dict_to_piped_kv_pairs(request.args)
     
     logger.info('logType=Request|requestId="{request_id}"|path="{path}"|sourceIp={source_ip}|'
-                'url="{url}"|{parameters}'.format(
+                'url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     source_ip=g.source_ip,
                     request_id=g.request_id,
                     path=request.path,
@@ -241,6 +361,7 @@ def get_organisations():
 
 
 @app.route(app.config['API_PATH'] + "/organisations/<ods_code>", methods=['GET'])
+@conditional
 def get_organisation(ods_code):
     """Endpoint returns a single ODS organisation
         ---
@@ -265,7 +386,8 @@ def get_organisation(ods_code):
     
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|path="{path}"|'
-                'resourceId={resource_id}|sourceIp={source_ip}|url="{url}"'.format(
+                'resourceId={resource_id}|sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     request_id=g.request_id,
                     source_ip=g.source_ip,
                     path=request.path,
@@ -277,7 +399,327 @@ def get_organisation(ods_code):
     return response
 
 
+@app.route(app.config['API_PATH'] + "/organisations/export", methods=['GET'])
+@conditional
+def get_organisations_export():
+    """
+    Endpoint streaming every ODS organisation matching the filters, without paging
+    ---
+    parameters:
+      - name: format
+        description: ndjson (default) - one JSON object per line. csv - comma separated values with a header row.
+        in: query
+        type: string
+        enum: ['ndjson', 'csv']
+        required: false
+      - name: q
+        description: Filters results by names which contain the specified string
+        in: query
+        type: string
+        required: false
+      - name: postCode
+        description: Filters results to only those with a postcode containing the specified value
+        in: query
+        type: string
+      - name: active
+        description: true - filters results to only those with a status of 'Active'.
+          false - filters results to only those with a status of 'Inactive'
+        in: query
+        type: boolean
+      - name: roleCode
+        description: Filters results to only those with one of the specified role codes assigned
+        in: query
+        type: array
+        collectionFormat: csv
+        required: false
+      - name: primaryRoleCode
+        description: Filters results to only those with one of the specified role codes assigned as a Primary role.
+          Ignored if used alongside roleCode parameter.
+        in: query
+        type: array
+        collectionFormat: csv
+        required: false
+      - name: lastUpdatedSince
+        description: Filters results to only those with a lastChangeDate after the specified date.
+        in: query
+        type: string
+        format: date
+        required: false
+      - name: legallyActive
+        description: Filters results to only those that are still legally active.
+        in: query
+        type: boolean
+        required: false
+      - name: recordClass
+        description: Filters results to only those in the specified record class.
+        in: query
+        type: string
+        enum: ['HSCSite', 'HSCOrg']
+        required: false
+    responses:
+      200:
+        description: Every organisation matching the filters, ordered by name
+      400:
+        description: The format wasn't recognised
+    """
+
+    request_utils.get_request_id(request)
+    request_utils.get_source_ip(request)
+
+    logger = logging.getLogger(__name__)
+
+    resp = request_handler.get_organisations_export_response(request)
+
+    parameters_as_string = request_utils.dict_to_piped_kv_pairs(request.args)
+
+    logger.info('logType=Request|requestId="{request_id}"|path="{path}"|sourceIp={source_ip}|'
+                'url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
+                    source_ip=g.source_ip,
+                    request_id=g.request_id,
+                    path=request.path,
+                    url=request.url,
+                    parameters=parameters_as_string,
+                    )
+                )
+
+    return resp
+
+
+@app.route(app.config['API_PATH'] + "/organisations/changes", methods=['GET'])
+@conditional
+def get_organisation_changes():
+    """
+    Endpoint returning ODS organisations in the order they were last changed, for keeping a copy of the register
+    up to date. Organisations removed by a delta import are listed by their odsCode with removed set to true, on
+    the publication date of the dataset they were removed from. Removals made by restoring a full backup aren't
+    listed, so a copy must be reconciled in full after one.
+    ---
+    parameters:
+      - name: since
+        description: Starts the feed at organisations with a lastChangeDate on or after the specified date
+        in: query
+        type: string
+        format: date
+        required: false
+      - name: cursor
+        description: Resumes the feed after the point reached by an earlier page. Takes the value of 'cursor'
+          from that page, which is returned even with the last page so that later changes can be picked up.
+        in: query
+        type: string
+        required: false
+      - name: limit
+        description: Limits number of results to specified value (default 100, hard limit of 1000 records)
+        in: query
+        type: integer
+        minimum: 1
+        required: false
+      - name: include
+        description: documents - includes the full representation of each organisation, as returned by
+          /organisations/{ods_code}
+        in: query
+        type: string
+        enum: ['documents']
+        required: false
+    responses:
+      200:
+        description: A page of organisations ordered by lastChangeDate and then odsCode
+      400:
+        description: The since date, cursor, limit or include parameter wasn't valid
+    """
+
+    request_utils.get_request_id(request)
+    request_utils.get_source_ip(request)
+
+    logger = logging.getLogger(__name__)
+
+    resp = request_handler.get_organisation_changes_response(request)
+
+    parameters_as_string = request_utils.dict_to_piped_kv_pairs(request.args)
+
+    logger.info('logType=Request|requestId="{request_id}"|path="{path}"|sourceIp={source_ip}|'
+                'url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
+                    source_ip=g.source_ip,
+                    request_id=g.request_id,
+                    path=request.path,
+                    url=request.url,
+                    parameters=parameters_as_string,
+                    )
+                )
+
+    return resp
+
+
+@app.route(app.config['API_PATH'] + "/organisations/<ods_code>/descendants", methods=['GET'])
+@conditional
+def get_organisation_descendants(ods_code):
+    """
+    Endpoint returning the organisations below an ODS organisation in the hierarchy, such as the sites operated
+    by a trust, nearest first. Only active relationships are followed.
+    ---
+    parameters:
+      - name: ods_code
+        in: path
+        type: string
+        required: true
+      - name: depth
+        description: Only follows relationships this many levels down (default no limit)
+        in: query
+        type: integer
+        required: false
+      - name: relationshipType
+        description: Only follows relationships of these types (comma separated, e.g. RE6)
+        in: query
+        type: string
+        required: false
+    responses:
+      200:
+        description: A list of organisations, each with its depth and the organisation it is related to
+      400:
+        description: The depth wasn't a positive whole number
+      404:
+        description: The organisation wasn't found
+    """
+
+    return get_organisation_graph(ods_code, request_handler.get_organisation_descendants_response)
+
+
+@app.route(app.config['API_PATH'] + "/organisations/<ods_code>/ancestors", methods=['GET'])
+@conditional
+def get_organisation_ancestors(ods_code):
+    """
+    Endpoint returning the organisations above an ODS organisation in the hierarchy, such as the trust operating
+    a site, nearest first. Only active relationships are followed.
+    ---
+    parameters:
+      - name: ods_code
+        in: path
+        type: string
+        required: true
+      - name: depth
+        description: Only follows relationships this many levels up (default no limit)
+        in: query
+        type: integer
+        required: false
+      - name: relationshipType
+        description: Only follows relationships of these types (comma separated, e.g. RE6)
+        in: query
+        type: string
+        required: false
+    responses:
+      200:
+        description: A list of organisations, each with its depth and the organisation related to it
+      400:
+        description: The depth wasn't a positive whole number
+      404:
+        description: The organisation wasn't found
+    """
+
+    return get_organisation_graph(ods_code, request_handler.get_organisation_ancestors_response)
+
+
+@app.route(app.config['API_PATH'] + "/organisations/<ods_code>/successor-chain", methods=['GET'])
+@conditional
+def get_organisation_successor_chain(ods_code):
+    """
+    Endpoint returning the organisations which have succeeded an ODS organisation, and those which succeeded
+    them in turn
+    ---
+    parameters:
+      - name: ods_code
+        in: path
+        type: string
+        required: true
+      - name: depth
+        description: Only follows this many successions (default no limit)
+        in: query
+        type: integer
+        required: false
+    responses:
+      200:
+        description: A list of organisations, each with its depth and the organisation it succeeded
+      400:
+        description: The depth wasn't a positive whole number
+      404:
+        description: The organisation wasn't found
+    """
+
+    return get_organisation_graph(ods_code, request_handler.get_organisation_successor_chain_response)
+
+
+# Services the graph endpoints, which differ only in the handler that walks the graph
+def get_organisation_graph(ods_code, handler):
+    request_utils.get_request_id(request)
+    request_utils.get_source_ip(request)
+
+    ods_code = str.upper(ods_code)
+
+    resp = handler(request, ods_code)
+
+    parameters_as_string = request_utils.dict_to_piped_kv_pairs(request.args)
+
+    logger = logging.getLogger(__name__)
+    logger.info('logType=Request|requestId="{request_id}"|path="{path}"|'
+                'resourceId={resource_id}|sourceIp={source_ip}|url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
+                    request_id=g.request_id,
+                    source_ip=g.source_ip,
+                    path=request.path,
+                    resource_id=ods_code,
+                    url=request.url,
+                    parameters=parameters_as_string,
+                    )
+                )
+
+    return resp
+
+
+@app.route(app.config['API_PATH'] + "/organisations/batch", methods=['POST'])
+def get_organisations_batch():
+    """Endpoint returns several ODS organisations at once
+        ---
+        parameters:
+          - name: body
+            in: body
+            required: true
+            description: The ODS codes of the organisations to return
+            schema:
+              type: object
+              properties:
+                odsCodes:
+                  type: array
+                  items:
+                    type: string
+        responses:
+          200:
+            description: A JSON object holding each organisation keyed by its ODS code, or null if there is no
+              organisation with that code
+          400:
+            description: The body didn't contain a list of odsCodes, or contained too many
+        """
+
+    request_utils.get_request_id(request)
+    request_utils.get_source_ip(request)
+
+    response = request_handler.get_batch_organisations_response(request)
+
+    logger = logging.getLogger(__name__)
+    logger.info('logType=Request|requestId="{request_id}"|path="{path}"|'
+                'sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
+                    request_id=g.request_id,
+                    source_ip=g.source_ip,
+                    path=request.path,
+                    url=request.url,
+                    )
+                )
+
+    return response
+
+
 @app.route(app.config['API_PATH'] + "/role-types", methods=['GET'])
+@conditional
 def route_role_types():
     """
         Endpoint returning a list of ODS role types
@@ -296,7 +738,8 @@ def route_role_types():
     
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|'
-                'path="{path}"|sourceIp={source_ip}|url="{url}"|{parameters}'.format(
+                'path="{path}"|sourceIp={source_ip}|url="{url}"|{parameters}{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     source_ip=g.source_ip,
                     request_id=g.request_id,
                     path=request.path,
@@ -309,6 +752,7 @@ def route_role_types():
 
 
 @app.route(app.config['API_PATH'] + "/role-types/<role_code>", methods=['GET'])
+@conditional
 def route_role_type_by_code(role_code):
     """Endpoint returns a single ODS role type
         ---
@@ -332,7 +776,8 @@ def route_role_type_by_code(role_code):
 
     logger = logging.getLogger(__name__)
     logger.info('logType=Request|requestId="{request_id}"|path="{path}"|'
-                'resourceId={resource_id}|sourceIp={source_ip}|url="{url}"'.format(
+                'resourceId={resource_id}|sourceIp={source_ip}|url="{url}"|{timings}'.format(
+                    timings=metrics.format_request_timings(),
                     source_ip=g.source_ip,
                     request_id=g.request_id,
                     resource_id=role_code,
@@ -1,50 +1,42 @@
 import logging
 import sys
-from urllib.parse import urlparse as urlparse
+import threading
+import time
 
 import psycopg2
 import psycopg2.extras
 
-from openods import app
+from openods import app, connection as connect
 
-url = urlparse(app.config['DATABASE_URL'])
+# The outcome of the last check, reported by the status endpoint
+_status = {'checked': False}
+_check_lock = threading.Lock()
 
 
 # Connects to the database and checks that the database schema matches that which is expected by the code
 def check_schema_version():
-    try:
-        conn = psycopg2.connect(
-            database=url.path[1:],
-            user=url.username,
-            password=url.password,
-            host=url.hostname,
-            port=url.port
-        )
-        logger = logging.getLogger(__name__)
-        logger.debug("Checking schema version of {db_url}".format(db_url=app.config['DATABASE_URL']))
+    with connect.borrow_connection() as conn:
+        try:
+            logger = logging.getLogger(__name__)
+            logger.debug("Checking schema version of {db_url}".format(db_url=app.config['DATABASE_URL']))
 
-    except psycopg2.Error:
-        logger = logging.getLogger(__name__)
-        logger.error("Unable to connect to the database")
-        sys.exit(1)
+            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            sql = "SELECT value from settings WHERE key = 'schema_version';"
+            cur.execute(sql)
+            result = cur.fetchone()
 
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        sql = "SELECT value from settings WHERE key = 'schema_version';"
-        cur.execute(sql)
-        result = cur.fetchone()
-        db_schema_version = result['value']
+        except psycopg2.Error:
+            logger = logging.getLogger(__name__)
+            logger.error("Error retrieving schema_version from database")
+            raise
 
-    except TypeError as e:
-        logger = logging.getLogger(__name__)
-        logger.error("Unable to read schema version from the database")
-        logger.error("Exception: %s" % e)
-        sys.exit(1)
+        finally:
+            conn.rollback()
 
-    except psycopg2.Error:
-        logger = logging.getLogger(__name__)
-        logger.error("Error retrieving schema_version from database")
-        raise
+    if result is None:
+        raise RuntimeError("Unable to read schema version from the database")
+
+    db_schema_version = result['value']
 
     if not (app.config['TARGET_SCHEMA_VERSION'] == db_schema_version):
         raise RuntimeError(str.format("Incorrect database schema version. Wanted {0}, Got {1}",
@@ -56,3 +48,51 @@ def check_schema_version():
         logger.debug(str.format("Schema version is {0}", db_schema_version))
 
     return True
+
+
+def ensure_schema_checked():
+    """
+    Checks the schema version once per process. A problem with the database is logged and reported by the status
+    endpoint rather than stopping the app, so a worker can still start (and serve whatever it can) while the
+    database is unavailable.
+    """
+    global _status
+
+    with _check_lock:
+        if _status['checked']:
+            return _status
+
+        logger = logging.getLogger(__name__)
+        started = time.perf_counter()
+
+        try:
+            check_schema_version()
+            status = {'checked': True, 'ok': True}
+        except Exception as e:
+            logger.error(str.format('Schema check failed: {0}', e))
+            status = {'checked': True, 'ok': False, 'error': str(e)}
+
+        status['checkTimeMs'] = round((time.perf_counter() - started) * 1000, 2)
+        _status = status
+
+        return _status
+
+
+def get_schema_status():
+    """
+    Returns the outcome of the schema check, or {'checked': False} if it hasn't been made yet
+    """
+    return dict(_status)
+
+
+@app.before_first_request
+def check_schema_on_first_request():
+    ensure_schema_checked()
+
+
+if __name__ == '__main__':
+    # Checks the schema ahead of starting the app, e.g. in a release step, failing if it isn't as expected
+    from openods import schema_check
+
+    if not schema_check.ensure_schema_checked()['ok']:
+        sys.exit(1)
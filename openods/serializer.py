@@ -0,0 +1,145 @@
+import datetime
+import decimal
+import json
+import logging
+import time
+import uuid
+
+from flask import request, Response
+
+from openods import app, metrics
+
+# The faster encoders are optional, and the standard library encoder is used when they aren't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Stands in for pre-encoded fragments while the rest of a document is encoded. The random part makes sure it can't
+# be mistaken for a value from the data.
+_FRAGMENT_PLACEHOLDER = str.format('__openods_fragment_{0}_', uuid.uuid4().hex)
+
+
+class Fragment(object):
+    """
+    A piece of JSON that has already been encoded, such as a cached sub-document, which is copied into the output
+    as it is rather than being decoded and encoded again
+    """
+
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json.encode('utf-8') if isinstance(json, str) else json
+
+
+def accepts_default(encoder):
+    """
+    Returns True if an encoder module's dumps takes the default argument, which dumps relies on to encode dates and
+    fragments. Older releases of ujson, including every one which runs on Python 3.6, don't.
+    """
+    try:
+        encoder.dumps(None, default=str)
+    except TypeError:
+        return False
+
+    return True
+
+
+def get_backend():
+    """
+    Returns the name of the encoder in use, chosen by the JSON_SERIALIZER setting. 'auto' picks the fastest one
+    that is installed.
+    """
+    backend = app.config['JSON_SERIALIZER']
+    ujson_usable = ujson is not None and accepts_default(ujson)
+
+    if backend == 'auto':
+        if orjson is not None:
+            return 'orjson'
+        if ujson_usable:
+            return 'ujson'
+        return 'json'
+
+    if (backend == 'orjson' and orjson is None) or (backend == 'ujson' and not ujson_usable):
+        logger = logging.getLogger(__name__)
+        logger.warning(str.format('JSON serializer {0} is not installed or is too old, using json', backend))
+        return 'json'
+
+    return backend
+
+
+_backend = get_backend()
+
+
+def dumps(obj, pretty=False):
+    """
+    Encodes obj as JSON, returning UTF-8 bytes. Dates and times are written in ISO 8601 format, and any Fragment
+    values are copied in without being re-encoded.
+    """
+    fragments = []
+
+    def default(value):
+        if isinstance(value, Fragment):
+            fragments.append(value.json)
+            return str.format('{0}{1}', _FRAGMENT_PLACEHOLDER, len(fragments) - 1)
+
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+
+        if isinstance(value, decimal.Decimal):
+            return float(value)
+
+        raise TypeError(str.format('Object of type {0} is not JSON serializable', type(value).__name__))
+
+    sort_keys = app.config['JSON_SORT_KEYS']
+
+    if _backend == 'orjson':
+        option = (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if pretty else 0)
+        output = orjson.dumps(obj, default=default, option=option)
+
+    elif _backend == 'ujson':
+        output = ujson.dumps(obj, default=default, sort_keys=sort_keys, indent=2 if pretty else 0,
+                             ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    else:
+        # Matches the output of jsonify
+        output = json.dumps(obj, default=default, sort_keys=sort_keys, indent=2 if pretty else None,
+                            separators=(', ', ': ') if pretty else (',', ':')).encode('utf-8')
+
+    for index, fragment in enumerate(fragments):
+        output = output.replace(str.format('"{0}{1}"', _FRAGMENT_PLACEHOLDER, index).encode('utf-8'), fragment, 1)
+
+    return output
+
+
+def is_pretty():
+    """
+    Returns True if the response to the current request is pretty printed, under the same conditions as jsonify
+    """
+    return app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr
+
+
+def representation():
+    """
+    Names the encoding of the response to the current request. Responses with the same data but a different
+    representation differ byte for byte, so they must be cached and tagged separately.
+    """
+    return str.format('{0}-{1}', _backend, 'pretty' if is_pretty() else 'compact')
+
+
+def json_response(obj, status=200):
+    """
+    Builds a JSON response in place of jsonify, pretty printing it under the same conditions
+    """
+    pretty = is_pretty()
+
+    started = time.perf_counter()
+    body = dumps(obj, pretty) + b'\n'
+    metrics.record_serialization(time.perf_counter() - started)
+
+    return Response(body, status=status, mimetype=app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,368 @@
+import bisect
+import datetime
+import json
+import logging
+import re
+import time
+
+from openods import app, dataset, queries
+
+
+def like_to_regex(pattern):
+    """
+    Compiles a SQL LIKE pattern to the equivalent regular expression
+    """
+    regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.compile(regex, re.DOTALL)
+
+
+def like_check(column, pattern):
+    """
+    Returns a function which matches a column of an organisation against a SQL LIKE pattern in the same way as
+    Postgres, where NULL never matches
+    """
+    regex = like_to_regex(pattern)
+    return lambda org: org[column] is not None and regex.fullmatch(org[column]) is not None
+
+
+def sort_key(name, odscode):
+    """
+    Returns the key an organisation is sorted by in the list, matching ORDER BY name NULLS LAST, odscode
+    """
+    return name is None, name or '', odscode or ''
+
+
+def ordered_keys(keys):
+    """
+    Returns the (name, odscode) keys of the organisations, in the order they were read from the database, if that is
+    also their order by code point, so that a cursor can be placed among them by bisecting. Otherwise, as under a
+    database collation other than C, returns None.
+    """
+    return keys if all(key <= next_key for key, next_key in zip(keys, keys[1:])) else None
+
+
+def is_true(value):
+    return value in (True, 1, '1', 'True', 'true', 'TRUE', 'yes', 'Yes', 'YES')
+
+
+def is_false(value):
+    return value in (False, 0, '0', 'False', 'false', 'FALSE', 'no', 'No', 'NO')
+
+
+class TokenIndex(object):
+    """
+    Maps each space separated word of a text field to the organisations containing it, so that substring
+    searches can be narrowed down to a set of candidates without scanning every organisation
+    """
+
+    def __init__(self):
+        self._postings = {}
+
+    def add(self, org_id, text):
+        if text is None:
+            return
+
+        for word in text.split(' '):
+            if word:
+                self._postings.setdefault(word, set()).add(org_id)
+
+    def _matching(self, test):
+        result = set()
+        for word, org_ids in self._postings.items():
+            if test(word):
+                result |= org_ids
+        return result
+
+    def candidates(self, term):
+        """
+        Returns a superset of the organisations whose text contains term, or None if the term can't be narrowed
+        down using the index (e.g. because it contains LIKE wildcards)
+        """
+        if not term or '%' in term or '_' in term:
+            return None
+
+        pieces = term.split(' ')
+
+        # A term without spaces has to lie entirely inside one word
+        if len(pieces) == 1:
+            return self._matching(lambda word: term in word)
+
+        # Otherwise the first piece ends a word, any middle pieces are whole words and the last piece starts a word
+        constraints = []
+
+        if pieces[0]:
+            constraints.append(self._matching(lambda word: word.endswith(pieces[0])))
+
+        for piece in pieces[1:-1]:
+            if piece:
+                constraints.append(self._postings.get(piece, set()))
+
+        if pieces[-1]:
+            constraints.append(self._matching(lambda word: word.startswith(pieces[-1])))
+
+        if not constraints:
+            return None
+
+        return set.intersection(*constraints)
+
+
+class Snapshot(object):
+    """
+    A read-only, in-memory copy of the organisation data for one version of the dataset.
+
+    Organisations are numbered by their position when ordered by (name, odscode) in the database, so that sorting
+    a set of organisation ids puts them in the same order as the list query would.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.loaded_at = None
+
+        self._columns = None
+        self._orgs = []
+        self._children = []
+        self._by_odscode = {}
+        self._keys = None
+        self._by_record_class = {}
+        self._by_status = {}
+        self._by_role_code = {}
+        self._by_primary_role_code = {}
+        self._name_tokens = TokenIndex()
+        self._postcode_tokens = TokenIndex()
+
+    def load(self, conn):
+        logger = logging.getLogger(__name__)
+        started = time.time()
+
+        cur = conn.cursor()
+
+        # Each organisation's child records are held as the JSON text that Postgres builds for them, which is
+        # much more compact than the equivalent Python objects and is only decoded when the record is requested
+        sql = str.format("SELECT org.*, json_build_array({0})::text AS _children "
+                         "FROM organisations org "
+                         "ORDER BY org.name NULLS LAST, org.odscode;",
+                         ", ".join(queries.organisation_children_subqueries()))
+
+        cur.execute(sql)
+        self._columns = [column[0] for column in cur.description][:-1]
+
+        odscode_column = self._columns.index('odscode')
+        name_column = self._columns.index('name')
+        record_class_column = self._columns.index('record_class')
+        status_column = self._columns.index('status')
+        post_code_column = self._columns.index('post_code')
+
+        keys = []
+
+        for org_id, row in enumerate(cur):
+            org = tuple(row[:-1])
+
+            self._orgs.append(org)
+            self._children.append(row[-1].encode('utf-8'))
+            self._by_odscode[org[odscode_column]] = org_id
+            keys.append(sort_key(org[name_column], org[odscode_column]))
+            self._by_record_class.setdefault(org[record_class_column], set()).add(org_id)
+            self._by_status.setdefault(org[status_column], set()).add(org_id)
+            self._name_tokens.add(org_id, org[name_column])
+            self._postcode_tokens.add(org_id, org[post_code_column])
+
+        self._keys = ordered_keys(keys)
+
+        cur.execute("SELECT org_odscode, code, primary_role "
+                    "FROM roles "
+                    "WHERE status = 'Active';")
+
+        for org_odscode, code, primary_role in cur:
+            org_id = self._by_odscode.get(org_odscode)
+
+            if org_id is None:
+                continue
+
+            self._by_role_code.setdefault(code, set()).add(org_id)
+
+            if primary_role:
+                self._by_primary_role_code.setdefault(code, set()).add(org_id)
+
+        self.loaded_at = time.time()
+
+        logger.info(str.format('Loaded snapshot of dataset version {0}|organisations={1}|loadTime={2:.2f}s|',
+                               self.version, len(self._orgs), self.loaded_at - started))
+
+        return self
+
+    def _org_as_dict(self, org_id):
+        return dict(zip(self._columns, self._orgs[org_id]))
+
+    def fetch_organisation_rows(self, odscode):
+        """
+        Returns the organisation and its child records in the same form as db.fetch_organisation_rows_single_query,
+        or None if the organisation doesn't exist
+        """
+        org_id = self._by_odscode.get(str.upper(odscode))
+
+        if org_id is None:
+            return None
+
+        roles, relationships, addresses, successors = json.loads(self._children[org_id].decode('utf-8'))
+
+        return self._org_as_dict(org_id), roles, relationships, addresses, successors
+
+    def _position_after(self, after):
+        """
+        Returns the id of the last organisation up to the (name, odscode) of a cursor, or None if it can't be found
+        """
+        name, odscode = after
+        org_id = self._by_odscode.get(odscode)
+
+        if org_id is not None and self._orgs[org_id][self._columns.index('name')] == name:
+            return org_id
+
+        # The record the cursor was taken from is no longer in the dataset, so find where it would have been. This
+        # can only be done if the database orders names by code point.
+        if self._keys is None:
+            return None
+
+        return bisect.bisect_right(self._keys, sort_key(name, odscode)) - 1
+
+    def find_organisations(self, offset=0, limit=20, recordclass=None,
+                           primary_role_code_list=None, role_code_list=None,
+                           query=None, postcode=None, active=None, last_updated_since=None,
+                           legally_active=None, after=None):
+        """Filters the organisations in the same way as the list query in db.get_org_list
+
+        Returns
+        -------
+        Tuple of the page of organisation rows (as dicts) and the total number of organisations matching the filter,
+        or None if the organisation a cursor was taken from is no longer in the dataset and its place can't be found
+        """
+        position = None
+
+        if after:
+            position = self._position_after(after)
+
+            if position is None:
+                return None
+
+        matches = self.match_organisations(recordclass, primary_role_code_list, role_code_list, query, postcode,
+                                           active, last_updated_since, legally_active)
+        count = len(matches)
+
+        if after:
+            start = bisect.bisect_right(matches, position)
+        else:
+            start = int(offset)
+
+        rows = [self._org_as_dict(org_id) for org_id in matches[start:start + int(limit)]]
+
+        return rows, count
+
+    def count_facets(self, facets, recordclass=None, primary_role_code_list=None, role_code_list=None,
+                     query=None, postcode=None, active=None, last_updated_since=None, legally_active=None):
+        """
+        Counts the organisations matching the filter by each value of the facets named, in the same way as
+        db.get_org_facets, using the sets of organisations held for each value
+        """
+        matches = set(self.match_organisations(recordclass, primary_role_code_list, role_code_list, query,
+                                               postcode, active, last_updated_since, legally_active))
+
+        facet_sets = {
+            'recordClass': self._by_record_class,
+            'status': self._by_status,
+            'primaryRoleCode': self._by_primary_role_code,
+        }
+
+        counts = {}
+
+        for facet in facets:
+            value_counts = {value: len(matches & org_ids) for value, org_ids in facet_sets[facet].items()}
+
+            # Organisations without an active primary role are counted under null
+            if facet == 'primaryRoleCode':
+                value_counts[None] = len(matches.difference(*facet_sets[facet].values()))
+
+            counts[facet] = {value: count for value, count in value_counts.items() if count}
+
+        return counts
+
+    def match_organisations(self, recordclass=None, primary_role_code_list=None, role_code_list=None,
+                            query=None, postcode=None, active=None, last_updated_since=None,
+                            legally_active=None):
+        """
+        Returns the ids of the organisations matching the filter, in order of name
+        """
+        candidates = []
+        checks = []
+
+        name_column = self._columns.index('name')
+        post_code_column = self._columns.index('post_code')
+
+        if recordclass:
+            if '%' in recordclass or '_' in recordclass:
+                regex = like_to_regex(recordclass)
+                candidates.append(set().union(*[org_ids for value, org_ids in self._by_record_class.items()
+                                                if value is not None and regex.fullmatch(value)]))
+            else:
+                candidates.append(self._by_record_class.get(recordclass, set()))
+
+        if query:
+            candidates.append(self._name_tokens.candidates(str.upper(query)))
+            checks.append(like_check(name_column, str.format("%{0}%", str.upper(query))))
+
+        if postcode:
+            candidates.append(self._postcode_tokens.candidates(str.upper(postcode)))
+            checks.append(like_check(post_code_column, str.format("%{0}%", str.upper(postcode))))
+
+        if active:
+            candidates.append(self._by_status.get('Active' if is_true(active) else 'Inactive', set()))
+
+        if last_updated_since:
+            last_changed_column = self._columns.index('last_changed')
+            checks.append(lambda org: org[last_changed_column] is not None and
+                          org[last_changed_column] > last_updated_since)
+
+        if legally_active:
+            legal_end_date_column = self._columns.index('legal_end_date')
+            today = datetime.date.today()
+
+            # Dates are compared against now() in the database, so a legal end date of today has already passed
+            if is_true(legally_active):
+                checks.append(lambda org: org[legal_end_date_column] is None or
+                              org[legal_end_date_column] > today)
+            elif is_false(legally_active):
+                checks.append(lambda org: org[legal_end_date_column] is not None and
+                              org[legal_end_date_column] <= today)
+
+        if role_code_list:
+            candidates.append(set().union(*[self._by_role_code.get(code, set()) for code in role_code_list]))
+
+        elif primary_role_code_list:
+            candidates.append(set().union(*[self._by_primary_role_code.get(code, set())
+                                            for code in primary_role_code_list]))
+
+        candidates = [c for c in candidates if c is not None]
+
+        if candidates:
+            org_ids = sorted(set.intersection(*candidates))
+        else:
+            org_ids = range(len(self._orgs))
+
+        return [org_id for org_id in org_ids if all(check(self._orgs[org_id]) for check in checks)]
+
+
+_snapshots = dataset.VersionedIndex(Snapshot, 'snapshot')
+
+
+def get_snapshot():
+    """
+    Returns the snapshot of the current dataset, or None if snapshots are disabled or haven't been loaded yet
+    """
+    if not app.config['SNAPSHOT_ENABLED']:
+        return None
+
+    return _snapshots.get()
+
+
+@app.before_first_request
+def load_snapshot():
+    if app.config['SNAPSHOT_ENABLED']:
+        _snapshots.reload()
@@ -0,0 +1,2 @@
+-- Supports paging through /organisations by (name, odscode), both for ORDER BY and for resuming from a cursor
+CREATE INDEX IF NOT EXISTS ix_organisations_name_odscode ON organisations (name, odscode);
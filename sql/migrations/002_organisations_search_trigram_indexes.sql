@@ -0,0 +1,9 @@
+-- Trigram indexes supporting the substring matches used by the q= and postCode= filters on /organisations,
+-- which can't use a B-tree index because of the leading wildcard. pg_trgm also provides the similarity()
+-- function used when ordering search results by relevance (sort=relevance).
+-- pg_trgm is a trusted extension from PostgreSQL 13, so can be created by the database owner. Earlier versions
+-- need this statement to be run by a superuser.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS ix_organisations_name_trgm ON organisations USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_organisations_post_code_trgm ON organisations USING gin (post_code gin_trgm_ops);
@@ -0,0 +1,8 @@
+-- Holds the finished JSON document returned by /organisations/<odsCode> for each organisation, with the host part
+-- of its links left as a placeholder. Documents are written by `python -m openods.documents` after each import and
+-- are only served while their dataset_version matches the dataset in the database.
+CREATE TABLE IF NOT EXISTS organisation_documents (
+    odscode character varying(10) PRIMARY KEY,
+    dataset_version character varying(16) NOT NULL,
+    document text NOT NULL
+);
@@ -0,0 +1,11 @@
+-- Lists the organisations whose API representation was changed by each delta import (`python -m
+-- openods.delta_import`), so that caches can keep the responses for every other organisation when the dataset
+-- version moves on. change_type is one of added, updated, removed or related, where related organisations didn't
+-- change themselves but name one that did in their relationships or successors.
+CREATE TABLE IF NOT EXISTS organisation_changes (
+    dataset_version character varying(16) NOT NULL,
+    previous_version character varying(16) NOT NULL,
+    odscode character varying(10) NOT NULL,
+    change_type character varying(10) NOT NULL,
+    PRIMARY KEY (dataset_version, odscode)
+);
@@ -0,0 +1,3 @@
+-- Supports the /organisations/changes feed, which pages through organisations by (last_changed, odscode), both for
+-- ORDER BY and for resuming from a cursor
+CREATE INDEX IF NOT EXISTS ix_organisations_last_changed_odscode ON organisations (last_changed, odscode);
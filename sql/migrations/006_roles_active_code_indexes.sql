@@ -0,0 +1,8 @@
+-- Support the roleCode and primaryRoleCode filters on /organisations, which look for organisations holding an
+-- active role with one of the given codes. The indexes only cover active roles, matching the filters, and include
+-- org_odscode so that the lookup is answered from the index without visiting the roles table.
+CREATE INDEX IF NOT EXISTS ix_roles_active_code_org_odscode ON roles (code, org_odscode)
+    WHERE status = 'Active';
+
+CREATE INDEX IF NOT EXISTS ix_roles_active_primary_code_org_odscode ON roles (code, org_odscode)
+    WHERE status = 'Active' AND primary_role = TRUE;
@@ -0,0 +1,8 @@
+-- Holds the location of each postcode, for finding organisations near a postcode with /organisations?near=.
+-- Loaded from a postcode lookup file (such as the ONS Postcode Directory) by `python -m openods.geo <file>`.
+-- Postcodes are stored in upper case without spaces.
+CREATE TABLE IF NOT EXISTS postcodes (
+    postcode character varying(8) PRIMARY KEY,
+    latitude double precision NOT NULL,
+    longitude double precision NOT NULL
+);
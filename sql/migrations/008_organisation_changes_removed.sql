@@ -0,0 +1,8 @@
+-- Dates the organisations removed by each delta import, so that the /organisations/changes feed can list them
+-- alongside the organisations still present, in the same (last_changed, odscode) order. A removal is dated with
+-- the publication date of the dataset the organisation was no longer in.
+ALTER TABLE organisation_changes ADD COLUMN IF NOT EXISTS last_changed character varying;
+
+CREATE INDEX IF NOT EXISTS ix_organisation_changes_removed_last_changed_odscode
+    ON organisation_changes (last_changed, odscode)
+    WHERE change_type = 'removed';
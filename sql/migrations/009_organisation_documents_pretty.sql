@@ -0,0 +1,4 @@
+-- Holds each stored document pretty printed as well, as the API returns it to requests other than XHR when
+-- JSONIFY_PRETTYPRINT_REGULAR is set, so that those can be served without re-encoding the compact document. It is
+-- filled in when the documents are next built, and until then those requests are assembled from the database.
+ALTER TABLE organisation_documents ADD COLUMN IF NOT EXISTS pretty_document text;
@@ -0,0 +1,92 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def dataset_bitmaps():
+    from openods import app, bitmap_index, connection, dataset
+
+    with app.app_context():
+        with connection.borrow_connection() as conn:
+            version = dataset.get_dataset_version(conn.cursor())
+            loaded = bitmap_index.BitmapIndex(version).load(conn)
+            conn.rollback()
+
+    return loaded
+
+
+def test_set_bits_are_listed_in_order_across_blocks():
+    from openods import bitmap_index
+
+    positions = [0, 3, bitmap_index.BLOCK_BITS - 1, bitmap_index.BLOCK_BITS, 3 * bitmap_index.BLOCK_BITS + 5]
+    bitmap = bitmap_index.bitmap_from_positions(positions, 4 * bitmap_index.BLOCK_BITS)
+
+    assert bitmap_index.popcount(bitmap) == len(positions)
+    assert list(bitmap_index.iter_bits(bitmap)) == positions
+    assert list(bitmap_index.iter_bits(bitmap, skip=3)) == positions[3:]
+    assert list(bitmap_index.iter_bits(bitmap, skip=5)) == []
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'limit': 3, 'offset': 2},
+    {'recordclass': 'HSCSite', 'active': 'true'},
+    {'recordclass': 'HSC%'},
+    {'active': 'false'},
+    {'role_code_list': ['RO198', 'RO197']},
+    {'primary_role_code_list': ['RO198'], 'legally_active': 'true'},
+    {'legally_active': 'false'},
+    {'limit': 4, 'after': ('HINDLEY HEALTH CENTRE', 'RRF26')},
+    {'limit': 4, 'after': ('HINDLEY', 'RRF00')},
+    {'limit': 4, 'after': (None, 'RRF00')},
+])
+def test_bitmap_index_filters_organisations_the_same_as_the_database(dataset_bitmaps, filters):
+    from openods import app, bitmap_index, db
+
+    offset = filters.pop('offset', 0)
+    limit = filters.pop('limit', 20)
+    after = filters.pop('after', None)
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        db_rows, db_count = db.query_org_list(offset, limit,
+                                              filters.get('recordclass'), filters.get('primary_role_code_list'),
+                                              filters.get('role_code_list'), None, None, filters.get('active'),
+                                              None, filters.get('legally_active'), after, 'exact', False)
+
+    rows, count = dataset_bitmaps.find_organisations(offset, limit, after, **filters)
+
+    assert count == db_count
+    assert rows == [{column: row[column] for column in bitmap_index.ROW_COLUMNS} for row in db_rows]
+
+
+def test_bitmap_index_cannot_place_a_cursor_when_names_are_not_ordered_by_code_point(dataset_bitmaps,
+                                                                                     monkeypatch):
+    monkeypatch.setattr(dataset_bitmaps, '_keys', None)
+
+    assert dataset_bitmaps.find_organisations(0, 4, ('HINDLEY', 'RRF00')) is None
+    assert dataset_bitmaps.find_organisations(0, 4, ('HINDLEY HEALTH CENTRE', 'RRF26')) is not None
+
+
+def test_bitmap_index_counts_facets_the_same_as_the_database(dataset_bitmaps):
+    from openods import app, db
+
+    facets = ['recordClass', 'status', 'primaryRoleCode']
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        db_counts = db.get_org_facets(facets, active='true')
+
+    assert {facet: {item['value']: item['count'] for item in items} for facet, items in db_counts.items()} == \
+        dataset_bitmaps.count_facets(facets, active='true')
+
+
+def test_bitmap_index_only_supports_indexed_filters():
+    from openods import bitmap_index
+
+    assert bitmap_index.BitmapIndex.supports()
+    assert not bitmap_index.BitmapIndex.supports(query='clinic')
+    assert not bitmap_index.BitmapIndex.supports(last_updated_since='2014-01-01')
@@ -0,0 +1,91 @@
+import pytest
+
+
+def test_cache_key_is_namespaced_by_dataset_version():
+    from openods import app, dataset, serializer
+    from openods import cache as ocache
+
+    with app.test_request_context('/api/organisations?q=clinic&limit=5'):
+        from flask import g
+        g.request_id = 'test'
+
+        key = ocache.generate_cache_key()
+
+        assert dataset.current_version() is not None
+        assert key == (dataset.current_version() + ':' + serializer.representation() +
+                       ':/api/organisations?limit=5&q=clinic')
+
+
+def test_cache_key_is_namespaced_when_the_versions_table_is_empty(monkeypatch):
+    import time
+    import psycopg2
+    from openods import app, dataset, serializer
+    from openods import cache as ocache
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM versions;")
+        version, imported_at = dataset.read_dataset_version(cur)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    assert (version, imported_at) == (dataset.UNVERSIONED, None)
+
+    monkeypatch.setattr(dataset, '_version', version)
+    monkeypatch.setattr(dataset, '_version_checked_at', time.time())
+
+    with app.test_request_context('/api/organisations/RRF12'):
+        from flask import g
+        g.request_id = 'test'
+
+        assert ocache.generate_cache_key() == ('unversioned:' + serializer.representation() +
+                                               ':/api/organisations/RRF12?')
+
+
+def test_local_cache_evicts_least_recently_used_entries_when_full():
+    from openods import cache as ocache
+
+    local_cache = ocache.LocalCache(max_bytes=25)
+    local_cache.set('a', (200, [], b'0123456789'), timeout=60)
+    local_cache.set('b', (200, [], b'0123456789'), timeout=60)
+    local_cache.get('a')
+    local_cache.set('c', (200, [], b'0123456789'), timeout=60)
+
+    assert local_cache.get('a') is not None
+    assert local_cache.get('b') is None
+    assert local_cache.get('c') is not None
+    assert local_cache.size == 20
+
+
+def test_cached_response_is_rebuilt_from_serialized_entry():
+    from flask import Response
+    from openods import cache as ocache
+
+    response = Response(b'{"a": 1}', status=200, mimetype='application/json', headers={'X-Total-Count': '1'})
+    rebuilt = ocache.response_from_entry(ocache.entry_from_response(response))
+
+    assert rebuilt.get_data() == response.get_data()
+    assert rebuilt.headers['X-Total-Count'] == '1'
+    assert rebuilt.mimetype == 'application/json'
+
+
+def test_responses_are_not_cached_when_the_cache_is_disabled(monkeypatch):
+    from openods import app
+    from openods import cache as ocache
+
+    monkeypatch.setitem(app.config, 'RESPONSE_CACHE_ENABLED', False)
+    calls = []
+
+    @ocache.cached(timeout=60)
+    def handler():
+        calls.append(1)
+        return 'response'
+
+    with app.test_request_context('/api/uncached'):
+        handler()
+        handler()
+
+    assert len(calls) == 2
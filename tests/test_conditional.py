@@ -0,0 +1,38 @@
+import pytest
+
+
+def test_responses_carry_validators_and_repeat_requests_get_304():
+    from openods import app
+    client = app.test_client()
+
+    response = client.get('/api/role-types')
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'].startswith('public')
+
+    not_modified = client.get('/api/role-types', headers={'If-None-Match': etag})
+
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert not_modified.headers['ETag'] == etag
+
+
+def test_etag_differs_between_resources():
+    from openods import app
+    client = app.test_client()
+
+    assert client.get('/api/role-types').headers['ETag'] != client.get('/api/role-types/RO198').headers['ETag']
+
+
+def test_pretty_and_compact_responses_are_tagged_separately():
+    from openods import app
+    client = app.test_client()
+
+    pretty = client.get('/api/role-types')
+    compact = client.get('/api/role-types', headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    assert pretty.data != compact.data
+    assert pretty.headers['ETag'] != compact.headers['ETag']
+    assert 'X-Requested-With' in pretty.headers['Vary']
+    assert client.get('/api/role-types', headers={'If-None-Match': compact.headers['ETag']}).status_code == 200
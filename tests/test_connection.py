@@ -0,0 +1,16 @@
+import pytest
+
+
+def test_connection_is_shared_within_a_request_and_returned_to_pool():
+    from openods import app, connection
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        first = connection.get_connection()
+        second = connection.get_connection()
+        assert first is second
+        assert connection.get_pool_stats()['inUse'] == 1
+
+    assert connection.get_pool_stats()['inUse'] == 0
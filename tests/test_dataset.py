@@ -0,0 +1,80 @@
+import logging
+
+import pytest
+
+
+class Loaded(object):
+
+    def __init__(self, version):
+        self.version = version
+
+    def load(self, conn):
+        return self
+
+
+class Broken(Loaded):
+
+    def load(self, conn):
+        raise RuntimeError('unable to load')
+
+
+def test_versioned_index_is_built_from_the_current_dataset():
+    from openods import app, dataset
+
+    indexes = dataset.VersionedIndex(Loaded, 'test index')
+
+    with app.app_context():
+        assert indexes.get() is None
+
+        loaded = indexes.get(wait=True)
+        indexes.reload()
+
+    assert loaded is not None
+    assert indexes.current is loaded
+
+
+def test_versioned_index_logs_failed_builds(caplog):
+    from openods import app, dataset
+
+    indexes = dataset.VersionedIndex(Broken, 'test index')
+
+    with app.app_context():
+        with caplog.at_level(logging.ERROR):
+            indexes.reload()
+
+        assert indexes.current is None
+        assert 'Unable to build test index of the dataset' in caplog.text
+
+        with pytest.raises(RuntimeError):
+            indexes.get(wait=True)
+
+
+def test_versioned_index_built_from_an_older_dataset_is_not_served(monkeypatch):
+    from openods import app, dataset
+
+    indexes = dataset.VersionedIndex(Loaded, 'test index')
+
+    with app.app_context():
+        indexes.reload(wait=True)
+        built = indexes.current
+
+        # A new dataset has been imported since the index was built
+        monkeypatch.setattr(dataset, 'current_version', lambda: 'newer')
+        monkeypatch.setattr(indexes, 'reload', lambda wait=False: True)
+
+        assert indexes.get() is None
+        assert indexes.current is built
+
+
+def test_versioned_index_is_rebuilt_before_use_when_waiting():
+    from openods import app, dataset
+
+    indexes = dataset.VersionedIndex(Loaded, 'test index')
+    indexes.current = Loaded('older')
+
+    with app.app_context():
+        version = dataset.current_version()
+        loaded = indexes.get(wait=True)
+
+    assert loaded.version == version
+    assert indexes.current is loaded
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 
@@ -14,3 +16,302 @@ def test_none_type_method_removes_none_types():
     }
 
     assert db.remove_none_values_from_dictionary(dirty_dictionary) == clean_dictionary
+
+
+def test_rename_keys_skips_missing_keys():
+    import datetime
+    from openods import db
+
+    record = {'legal_start_date': datetime.date(2001, 4, 1), 'name': 'TEST'}
+    db.rename_keys(record, db.DATE_FIELDS)
+
+    assert record == {'legalStartDate': datetime.date(2001, 4, 1), 'name': 'TEST'}
+
+
+def test_single_query_organisation_fetch_matches_per_table_fetch():
+    from openods import app, connection, db
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        multi = db.fetch_organisation_rows(connection.get_cursor(), 'rrf12')
+        single = db.fetch_organisation_rows_single_query(connection.get_cursor(), 'rrf12')
+
+    assert single[0] == multi[0]
+
+    for single_rows, multi_rows in zip(single[1:], multi[1:]):
+        assert len(single_rows) == len(multi_rows)
+        for single_row, multi_row in zip(single_rows, multi_rows):
+            assert set(single_row) == set(multi_row)
+            for key in multi_row:
+                if hasattr(multi_row[key], 'isoformat'):
+                    assert single_row[key] == multi_row[key].isoformat()
+                else:
+                    assert str(single_row[key]) == str(multi_row[key])
+
+
+def test_batch_organisation_fetch_matches_single_fetch():
+    from openods import app, connection, db
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        single = db.fetch_organisation_rows_single_query(connection.get_cursor(), 'RRF12')
+        batch = db.fetch_organisations_rows(connection.get_cursor(), ['RRF12', 'NOTACODE'])
+
+    assert list(batch) == ['RRF12']
+    assert batch['RRF12'] == single
+
+
+def test_batch_endpoint_returns_organisations_keyed_by_code():
+    from openods import app
+    client = app.test_client()
+
+    response = client.post('/api/organisations/batch', data='{"odsCodes": ["notacode"]}',
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == {'organisations': {'NOTACODE': None}}
+
+    too_many = ['X' + str(i) for i in range(app.config['BATCH_MAX_ORGANISATIONS'] + 1)]
+    response = client.post('/api/organisations/batch', data=json.dumps({'odsCodes': too_many}),
+                           content_type='application/json')
+
+    assert response.status_code == 400
+    assert client.post('/api/organisations/batch', data='[]').status_code == 400
+
+
+def test_export_streams_every_matching_organisation():
+    from openods import app, db
+    client = app.test_client()
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        listed, count, _ = db.get_org_list(limit=1000, recordclass=None, query='clinic', active=None)
+
+    response = client.get('/api/organisations/export?q=clinic')
+    exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert response.status_code == 200
+    assert len(exported) == count
+    assert [org['odsCode'] for org in exported] == [org['odsCode'] for org in listed]
+
+    csv_lines = client.get('/api/organisations/export?q=clinic&format=csv').get_data(as_text=True).splitlines()
+
+    assert csv_lines[0].split(',') == [field for field, column in db.EXPORT_FIELDS]
+    assert len(csv_lines) == count + 1
+    assert client.get('/api/organisations/export?format=xml').status_code == 400
+
+
+def test_org_list_filter_builds_clause_and_parameters_together():
+    from openods import db
+
+    sql, data = db.build_org_list_filter(query='clinic', active='true', role_code_list=['RO198'])
+
+    assert sql.count('%s') == len(data)
+    assert 'UPPER(code)' not in sql
+    assert data == ('%CLINIC%', 'Active', ['RO198'])
+
+
+def test_org_list_total_is_the_same_for_every_count_mode():
+    from openods import app, db
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        _, exact, _ = db.get_org_list(limit=2, query='clinic', count_mode='exact')
+        _, from_cursor, _ = db.get_org_list(limit=2, query='clinic', after=('A', 'A'), count_mode='exact')
+        _, skipped, _ = db.get_org_list(limit=2, query='clinic', count_mode='none')
+
+    assert exact == from_cursor
+    assert skipped is None
+
+
+def test_cursor_pages_reach_organisations_without_a_name():
+    import psycopg2
+    import psycopg2.extras
+    from openods import app, query_builder
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("INSERT INTO organisations (odscode, name) VALUES ('ZZNULL2', NULL), ('ZZNULL1', NULL);")
+
+        cur.execute("SELECT odscode FROM organisations ORDER BY name NULLS LAST, odscode;")
+        expected = [row['odscode'] for row in cur.fetchall()]
+
+        where = query_builder.org_list_filter()
+        seen = []
+        after = None
+
+        while True:
+            query_builder.execute(cur, query_builder.org_list_page(where, 0, 3, after), prepare=False)
+            rows = cur.fetchall()
+
+            if not rows:
+                break
+
+            seen.extend(row['odscode'] for row in rows)
+            after = (rows[-1]['name'], rows[-1]['odscode'])
+
+        assert seen == expected
+        assert seen[-2:] == ['ZZNULL1', 'ZZNULL2']
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_changes_feed_pages_through_every_organisation_in_change_order():
+    from openods import app
+    client = app.test_client()
+
+    changes = []
+    response = json.loads(client.get('/api/organisations/changes?limit=3').get_data(as_text=True))
+    changes.extend(response['changes'])
+
+    while 'links' in response:
+        response = json.loads(client.get('/api/organisations/changes?limit=3&cursor=' +
+                                         response['cursor']).get_data(as_text=True))
+        changes.extend(response['changes'])
+
+    keys = [(change['lastChangeDate'], change['odsCode']) for change in changes]
+
+    assert keys == sorted(set(keys))
+
+    # The cursor from the last page resumes after everything seen so far
+    response = json.loads(client.get('/api/organisations/changes?cursor=' + response['cursor']).get_data(
+        as_text=True))
+    assert response['changes'] == []
+
+    since = keys[-1][0]
+    response = json.loads(client.get('/api/organisations/changes?since=' + since).get_data(as_text=True))
+    assert [change['odsCode'] for change in response['changes']] == [key[1] for key in keys if key[0] >= since]
+
+
+def test_changes_feed_rejects_invalid_parameters():
+    from openods import app
+    client = app.test_client()
+
+    assert client.get('/api/organisations/changes?since=yesterday').status_code == 400
+    assert client.get('/api/organisations/changes?cursor=notacursor').status_code == 400
+    assert client.get('/api/organisations/changes?include=roles').status_code == 400
+    assert client.get('/api/organisations/changes?limit=abc').status_code == 400
+    assert client.get('/api/organisations/changes?limit=-1').status_code == 400
+
+
+def index_names(plan):
+    """
+    Returns the names of the indexes used anywhere in a JSON query plan
+    """
+    names = {plan['Index Name']} if 'Index Name' in plan else set()
+
+    for child in plan.get('Plans', []):
+        names |= index_names(child)
+
+    return names
+
+
+@pytest.mark.parametrize('filters, index', [
+    ({'role_code_list': ['RO198']}, 'ix_roles_active_code_org_odscode'),
+    ({'primary_role_code_list': ['RO198']}, 'ix_roles_active_primary_code_org_odscode'),
+])
+def test_role_code_filters_use_the_active_role_indexes(filters, index):
+    import psycopg2
+    from openods import app, db
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (index,))
+
+        if not cur.fetchone()[0]:
+            pytest.skip('the migrations have not been applied')
+
+        # The sample data is small enough that scanning the whole table would otherwise be cheapest
+        cur.execute("SET LOCAL enable_seqscan = off;")
+
+        filter_sql, filter_data = db.build_org_list_filter(**filters)
+        cur.execute(str.format("EXPLAIN (FORMAT JSON) SELECT COUNT(*) FROM organisations {0};", filter_sql),
+                    filter_data)
+
+        assert index in index_names(cur.fetchone()[0][0]['Plan'])
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_organisation_list_can_be_counted_by_facet():
+    from openods import app
+
+    client = app.test_client()
+
+    response = client.get('/api/organisations?q=clinic&limit=2&facets=status,primaryRoleCode')
+    body = json.loads(response.get_data(as_text=True))
+
+    assert len(body['organisations']) == 2
+    assert body['facets'] == {
+        'status': [{'value': 'Active', 'count': 7}],
+        'primaryRoleCode': [{'value': 'RO198', 'count': 7}],
+    }
+
+    empty = json.loads(client.get('/api/organisations?q=nomatch&facets=recordClass').get_data(as_text=True))
+
+    assert empty == {'organisations': [], 'facets': {'recordClass': []}}
+    assert client.get('/api/organisations?facets=name').status_code == 400
+
+
+def test_relevance_ranking_falls_back_to_name_order_without_pg_trgm(monkeypatch):
+    from openods import app, db
+    client = app.test_client()
+
+    monkeypatch.setattr(db, '_trigram_search_available', False)
+
+    ranked = client.get('/api/organisations?q=clinic&sort=relevance')
+    by_name = client.get('/api/organisations?q=clinic')
+
+    assert ranked.status_code == 200
+    assert json.loads(ranked.get_data(as_text=True)) == json.loads(by_name.get_data(as_text=True))
+
+
+def test_trigram_search_is_checked_once(monkeypatch):
+    from openods import app, db
+
+    monkeypatch.setattr(db, '_trigram_search_available', None)
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        available = db.trigram_search_available()
+
+        assert available in (True, False)
+        assert db._trigram_search_available is available
+
+
+def test_total_is_only_marked_estimated_when_it_was_estimated(monkeypatch):
+    from openods import app, connection, dataset, snapshot
+    client = app.test_client()
+
+    estimated = client.get('/api/organisations?totalCount=estimate')
+
+    assert estimated.headers['X-Total-Count-Estimated'] == 'true'
+
+    # The snapshot counts exactly
+    with app.app_context():
+        with connection.borrow_connection() as conn:
+            loaded = snapshot.Snapshot(dataset.get_dataset_version(conn.cursor())).load(conn)
+            conn.rollback()
+
+    monkeypatch.setattr(snapshot, 'get_snapshot', lambda: loaded)
+
+    counted = client.get('/api/organisations?totalCount=estimate&limit=3')
+
+    assert 'X-Total-Count-Estimated' not in counted.headers
+    assert counted.headers['X-Total-Count'] == client.get('/api/organisations').headers['X-Total-Count']
@@ -0,0 +1,118 @@
+import psycopg2
+import pytest
+
+
+def test_find_changes_compares_last_change_dates():
+    from openods import delta_import
+
+    source = {'A1': '2017-01-01', 'B1': '2017-06-01', 'D1': '2017-06-01'}
+    target = {'A1': '2017-01-01', 'B1': '2017-01-01', 'C1': '2017-01-01'}
+
+    assert delta_import.find_changes(source, target) == (['D1'], ['B1'], ['C1'])
+
+
+@pytest.fixture
+def connections():
+    from openods import app
+
+    source_conn = psycopg2.connect(app.config['DATABASE_URL'])
+    target_conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    cur = target_conn.cursor()
+    cur.execute("SELECT to_regclass('organisation_changes') IS NOT NULL;")
+
+    if not cur.fetchone()[0]:
+        pytest.skip('the migrations have not been applied')
+
+    # The source reads temporary copies of the tables, which hide the real ones for the rest of its session
+    cur = source_conn.cursor()
+    for table in ('organisations', 'roles', 'relationships', 'addresses', 'successors', 'codesystems', 'versions'):
+        cur.execute(str.format("CREATE TEMP TABLE {0} AS SELECT * FROM public.{0};", table))
+
+    yield source_conn, target_conn
+
+    source_conn.rollback()
+    target_conn.rollback()
+    source_conn.close()
+    target_conn.close()
+
+
+def test_apply_delta_copies_only_changed_organisations(connections):
+    from openods import delta_import
+
+    source_conn, target_conn = connections
+    cur = source_conn.cursor()
+    cur.execute("SELECT odscode FROM organisations ORDER BY odscode LIMIT 1;")
+    odscode = cur.fetchone()[0]
+    cur.execute("UPDATE organisations SET name = 'RENAMED', last_changed = '2099-01-01' WHERE odscode = %s;",
+                (odscode,))
+
+    summary = delta_import.apply_delta(source_conn, target_conn)
+
+    assert summary['updated'] == [odscode]
+    assert summary['added'] == summary['removed'] == []
+    assert summary['version'] != summary['previousVersion']
+
+    cur = target_conn.cursor()
+    cur.execute("SELECT name FROM organisations WHERE odscode = %s;", (odscode,))
+    assert cur.fetchone()[0] == 'RENAMED'
+
+    cur.execute("SELECT odscode, change_type FROM organisation_changes WHERE dataset_version = %s;",
+                (summary['version'],))
+    assert (odscode, 'updated') in cur.fetchall()
+
+
+def test_apply_delta_does_nothing_without_changes(connections):
+    from openods import delta_import
+
+    source_conn, target_conn = connections
+
+    assert delta_import.apply_delta(source_conn, target_conn) is None
+
+
+def test_previous_version_only_for_unchanged_organisations(monkeypatch):
+    from openods import app, dataset
+
+    monkeypatch.setattr(dataset, '_refresh', lambda: None)
+    monkeypatch.setattr(dataset, '_previous_version', 'v1')
+    monkeypatch.setattr(dataset, '_changed_odscodes', {'RRF'})
+
+    with app.test_request_context('/'):
+        assert dataset.previous_version_for('RRF12') == 'v1'
+        assert dataset.previous_version_for('rrf') is None
+
+        monkeypatch.setattr(dataset, '_changed_odscodes', None)
+        assert dataset.previous_version_for('RRF12') is None
+
+
+def test_removed_organisations_are_listed_in_the_changes_feed(connections, monkeypatch):
+    import psycopg2.extras
+    from openods import app, connection, db, delta_import
+
+    source_conn, target_conn = connections
+    cur = target_conn.cursor()
+    cur.execute("SELECT to_regclass('ix_organisation_changes_removed_last_changed_odscode') IS NOT NULL;")
+
+    if not cur.fetchone()[0]:
+        pytest.skip('the migrations have not been applied')
+
+    cur = source_conn.cursor()
+    cur.execute("SELECT odscode FROM organisations ORDER BY odscode LIMIT 1;")
+    odscode = cur.fetchone()[0]
+    cur.execute("DELETE FROM organisations WHERE odscode = %s;", (odscode,))
+    cur.execute("UPDATE versions SET publication_date = '2099-01-01';")
+
+    summary = delta_import.apply_delta(source_conn, target_conn)
+
+    assert summary['removed'] == [odscode]
+
+    monkeypatch.setattr(connection, 'get_cursor',
+                        lambda: target_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor))
+
+    with app.test_request_context('/'):
+        changes = db.get_org_changes(after=('2098-12-31', ''))
+        assert changes == [{'odsCode': odscode, 'lastChangeDate': '2099-01-01', 'removed': True}]
+
+        assert db.get_org_changes(after=('2099-01-01', odscode)) == []
+        assert odscode not in [change['odsCode'] for change in db.get_org_changes(limit=1000)
+                               if not change.get('removed')]
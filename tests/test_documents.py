@@ -0,0 +1,51 @@
+import copy
+import datetime
+
+import pytest
+
+
+@pytest.fixture
+def organisation_rows():
+    org = {
+        'ref': 1, 'odscode': 'TST01', 'name': 'TEST CLINIC', 'status': 'Active', 'record_class': 'HSCSite',
+        'last_changed': '2013-05-08', 'legal_start_date': None, 'legal_end_date': None,
+        'operational_start_date': datetime.date(2001, 4, 1), 'operational_end_date': None,
+        'ref_only': False, 'post_code': 'WN4 8LB',
+    }
+    roles = [{
+        'code': 'RO198', 'displayname': 'NHS TRUST SITE', 'primary_role': True, 'status': 'Active',
+        'unique_id': 7, 'operational_start_date': '2001-04-01',
+    }]
+    relationships = [{
+        'unique_id': 3, 'target_odscode': 'TST', 'name': 'TEST TRUST', 'displayname': 'IS OPERATED BY',
+        'status': 'Active', 'operational_start_date': '2001-04-01',
+    }]
+    return org, roles, relationships, [], []
+
+
+@pytest.mark.parametrize('headers', [{}, {'X-Requested-With': 'XMLHttpRequest'}])
+def test_stored_document_matches_response_once_links_are_prefixed(organisation_rows, headers):
+    from openods import app, db, documents, serializer
+
+    with app.test_request_context('/', headers=headers):
+        expected = serializer.json_response(db.format_organisation(copy.deepcopy(organisation_rows))).get_data(
+            as_text=True)
+
+        stored = documents.render_document(db.format_organisation(copy.deepcopy(organisation_rows),
+                                                                  documents.HOSTNAME_PLACEHOLDER),
+                                           serializer.is_pretty())
+
+        served = documents.document_response(documents.prefix_links(stored)).get_data(as_text=True)
+
+    assert app.config['APP_HOSTNAME'] not in stored
+    assert served == expected
+
+
+def test_prefix_links_escapes_the_hostname():
+    import json
+    from openods import documents
+
+    document = json.dumps({'href': documents.HOSTNAME_PLACEHOLDER + '/organisations/TST01'})
+
+    assert json.loads(documents.prefix_links(document, 'http://host/"api"'))['href'] == \
+        'http://host/"api"/organisations/TST01'
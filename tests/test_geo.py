@@ -0,0 +1,135 @@
+import io
+import json
+import math
+import random
+
+import psycopg2
+import pytest
+
+# Approximate locations of the sample organisations' postcodes
+SAMPLE_LOCATIONS = [
+    ('RRF34', 53.5460, -2.6320),
+    ('RRF17', 53.5440, -2.6300),
+    ('RRF16', 53.5390, -2.6070),
+    ('RRF33', 53.5370, -2.6620),
+    ('RRF12', 53.5199, -2.5793),
+    ('RRF29', 53.5290, -2.7100),
+]
+
+
+def test_kd_tree_finds_the_same_points_as_a_full_scan():
+    from openods import geo
+
+    generator = random.Random(42)
+    points = [(generator.uniform(-1, 1), generator.uniform(-1, 1), generator.uniform(-1, 1)) for _ in range(500)]
+    tree = geo.KDTree(points)
+
+    for _ in range(20):
+        centre = (generator.uniform(-1, 1), generator.uniform(-1, 1), generator.uniform(-1, 1))
+        radius = generator.uniform(0.05, 0.6)
+
+        expected = {index for index, point in enumerate(points)
+                    if math.sqrt(sum((a - b) ** 2 for a, b in zip(centre, point))) <= radius}
+
+        assert {index for _, index in tree.within(centre, radius)} == expected
+
+
+def test_location_index_lists_organisations_nearest_first():
+    from openods import geo
+
+    index = geo.LocationIndex('test').build([('NORTH', 52.0, 0.0), ('SAME', 51.0, 0.0), ('FAR', 40.0, 0.0)])
+
+    nearby = index.near(51.0, 0.0, 150)
+
+    assert [odscode for odscode, _ in nearby] == ['SAME', 'NORTH']
+    assert nearby[0][1] == pytest.approx(0, abs=1e-6)
+    # One degree of latitude is about 111.2 km
+    assert nearby[1][1] == pytest.approx(111.2, abs=0.1)
+
+
+def test_postcode_lookup_is_read_from_ons_postcode_directory_columns():
+    from openods import geo
+
+    lookup_file = io.StringIO('pcd,pcds,lat,long\n'
+                              'WN1 1AH,WN1 1AH,53.546,-2.632\n'
+                              'ZZ9 9ZZ,ZZ9 9ZZ,99.999999,0.000000\n'
+                              'WN2 5NG,wn2 5ng,53.5199,-2.5793\n')
+
+    assert list(geo.read_postcode_lookup(lookup_file)) == [('WN11AH', 53.546, -2.632), ('WN25NG', 53.5199, -2.5793)]
+
+
+def test_load_postcodes_replaces_the_lookup():
+    from openods import app, geo
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('postcodes') IS NOT NULL;")
+
+        if not cur.fetchone()[0]:
+            pytest.skip('the migrations have not been applied')
+
+        lookup_file = io.StringIO('postcode,latitude,longitude\n'
+                                  'WN1 1AH,53.546,-2.632\n'
+                                  'WN11AH,53.546,-2.632\n')
+
+        assert geo.load_postcodes(conn, lookup_file) == 1
+
+        cur.execute("SELECT postcode, latitude, longitude FROM postcodes;")
+        assert cur.fetchall() == [('WN11AH', 53.546, -2.632)]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.fixture
+def sample_locations(monkeypatch):
+    from openods import app, connection, dataset, geo
+
+    with app.app_context():
+        with connection.borrow_connection() as conn:
+            version = dataset.get_dataset_version(conn.cursor())
+            conn.rollback()
+
+    index = geo.LocationIndex(version).build(SAMPLE_LOCATIONS)
+
+    monkeypatch.setattr(geo._indexes, 'current', index)
+    monkeypatch.setattr(geo, 'find_postcode', lambda postcode: (53.5460, -2.6320) if postcode == 'WN1 1AH' else None)
+
+    return index
+
+
+def test_organisations_near_a_postcode_are_ordered_by_distance(sample_locations):
+    from openods import app
+
+    resp = app.test_client().get('/api/organisations?near=WN1 1AH&radius=3&limit=2&offset=1')
+    organisations = json.loads(resp.get_data(as_text=True))['organisations']
+
+    assert resp.status_code == 200
+    assert resp.headers['X-Total-Count'] == '4'
+    assert [organisation['odsCode'] for organisation in organisations] == ['RRF17', 'RRF16']
+    assert organisations[0]['distance'] < organisations[1]['distance'] < 3
+    assert 'offset=3' in resp.headers['Link']
+
+
+def test_organisations_near_a_postcode_can_be_filtered(sample_locations):
+    from openods import app
+
+    resp = app.test_client().get('/api/organisations?near=WN1 1AH&radius=10&q=clinic')
+    organisations = json.loads(resp.get_data(as_text=True))['organisations']
+
+    assert [organisation['odsCode'] for organisation in organisations] == ['RRF17', 'RRF33', 'RRF12', 'RRF29']
+
+
+@pytest.mark.parametrize('url', [
+    '/api/organisations?near=XX1 1XX',
+    '/api/organisations?near=WN1 1AH&radius=0',
+    '/api/organisations?near=WN1 1AH&radius=51',
+    '/api/organisations?near=WN1 1AH&radius=far',
+    '/api/organisations?near=WN1 1AH&q=clinic&sort=relevance',
+])
+def test_invalid_searches_near_a_postcode_are_rejected(sample_locations, url):
+    from openods import app
+
+    assert app.test_client().get(url).status_code == 400
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def organisation_graph():
+    from openods import graph
+
+    return graph.OrganisationGraph('test').build(
+        organisations=[('TRUST', 'A TRUST'), ('SITE1', 'SITE ONE'), ('SITE2', 'SITE TWO'), ('WARD', 'A WARD'),
+                       ('CCG', 'A CCG'), ('NEW', 'A NEW SITE'), ('NEWER', 'A NEWER SITE')],
+        relationships=[('SITE1', 'TRUST', 'RE6'), ('SITE2', 'TRUST', 'RE6'), ('WARD', 'SITE1', 'RE6'),
+                       ('TRUST', 'CCG', 'RE4')],
+        successions=[('SITE2', 'NEW'), ('NEW', 'NEWER'), ('NEWER', 'SITE2')],
+        descriptions=[('RE6', 'IS OPERATED BY')])
+
+
+def odscodes(results):
+    return [(result['odsCode'], result['depth']) for result in results]
+
+
+def test_descendants_are_listed_nearest_first(organisation_graph):
+    results = organisation_graph.descendants('CCG')
+
+    assert odscodes(results) == [('TRUST', 1), ('SITE1', 2), ('SITE2', 2), ('WARD', 3)]
+    assert results[3]['fromOdsCode'] == 'SITE1'
+    assert results[3]['relationshipDescription'] == 'IS OPERATED BY'
+    assert 'relationshipDescription' not in results[0]
+
+
+def test_traversal_can_be_limited_by_depth_and_relationship_type(organisation_graph):
+    assert odscodes(organisation_graph.descendants('CCG', depth=2)) == [('TRUST', 1), ('SITE1', 2), ('SITE2', 2)]
+    assert odscodes(organisation_graph.descendants('CCG', relationship_types={'RE6'})) == []
+    assert odscodes(organisation_graph.ancestors('WARD', relationship_types={'RE6'})) == [('SITE1', 1),
+                                                                                          ('TRUST', 2)]
+    assert odscodes(organisation_graph.ancestors('WARD')) == [('SITE1', 1), ('TRUST', 2), ('CCG', 3)]
+
+
+def test_successor_chain_stops_at_a_cycle(organisation_graph):
+    results = organisation_graph.successor_chain('SITE2')
+
+    assert odscodes(results) == [('NEW', 1), ('NEWER', 2)]
+    assert 'relationshipType' not in results[0]
+
+
+def test_descendants_endpoint_reads_the_sample_database():
+    from openods import app
+
+    resp = app.test_client().get('/api/organisations/rrf/descendants?relationshipType=re6&depth=1')
+    body = json.loads(resp.get_data(as_text=True))
+
+    assert resp.status_code == 200
+    assert body['odsCode'] == 'RRF'
+    assert 'RRF12' in [result['odsCode'] for result in body['descendants']]
+    assert all(result['depth'] == 1 and result['fromOdsCode'] == 'RRF' for result in body['descendants'])
+
+
+def test_inactive_relationships_are_not_part_of_the_hierarchy():
+    import psycopg2
+    from openods import app, graph
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO relationships (org_odscode, target_odscode, code, status) "
+                    "VALUES ('RRF12', 'RJY12', 'RE6', 'Inactive');")
+
+        organisation_graph = graph.OrganisationGraph('test').load(conn)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    assert 'RRF12' in [result['odsCode'] for result in organisation_graph.descendants('RRF')]
+    assert organisation_graph.descendants('RJY12') == []
+
+
+def test_successor_chain_endpoint_follows_predecessor_records():
+    from openods import app
+
+    body = json.loads(app.test_client().get('/api/organisations/RJY12/successor-chain').get_data(as_text=True))
+
+    assert odscodes(body['successors']) == [('RRF12', 1)]
+
+
+@pytest.mark.parametrize('url, status_code', [
+    ('/api/organisations/NOTANORG/ancestors', 404),
+    ('/api/organisations/RRF12/ancestors?depth=0', 400),
+    ('/api/organisations/RRF12/ancestors?depth=two', 400),
+])
+def test_graph_endpoints_reject_unknown_organisations_and_bad_depths(url, status_code):
+    from openods import app
+
+    assert app.test_client().get(url).status_code == status_code
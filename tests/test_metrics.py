@@ -0,0 +1,83 @@
+import pytest
+
+
+def test_responses_carry_server_timing_with_query_counts():
+    from openods import app
+    client = app.test_client()
+
+    response = client.get('/api/role-types?metricsTest=1')
+    server_timing = response.headers['Server-Timing']
+
+    assert response.status_code == 200
+    assert 'db;dur=' in server_timing
+    assert 'cache;desc="miss"' in server_timing
+    assert 'total;dur=' in server_timing
+
+    cached = client.get('/api/role-types?metricsTest=1')
+
+    assert 'desc="0 queries"' in cached.headers['Server-Timing']
+    assert 'cache;desc="local-hit"' in cached.headers['Server-Timing']
+
+
+def test_queries_are_counted_against_the_request():
+    from openods import app, connection, metrics
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+        metrics.start_request_timings()
+
+        cur = connection.get_cursor()
+        cur.execute("SELECT 1;")
+        cur.execute("SELECT 2;")
+
+        timings = metrics.get_request_timings()
+
+    assert timings['dbQueries'] == 2
+    assert timings['dbTimeMs'] >= 0
+
+
+def test_metrics_endpoint_renders_prometheus_text():
+    from openods import app
+    client = app.test_client()
+
+    client.get('/api/role-types')
+    body = client.get('/api/v1/metrics').get_data(as_text=True)
+
+    assert '# TYPE openods_requests_total counter' in body
+    assert 'openods_requests_total{endpoint="/api/role-types",status="200"}' in body
+    assert 'openods_request_duration_seconds_bucket{endpoint="/api/role-types",le="+Inf"}' in body
+
+
+def test_histogram_buckets_are_cumulative():
+    from openods import metrics
+
+    registry = metrics.Registry()
+    registry.describe('test_seconds', 'histogram', 'Test')
+    registry.observe('test_seconds', 0.001)
+    registry.observe('test_seconds', 0.02)
+    registry.observe('test_seconds', 60)
+
+    lines = registry.render().splitlines()
+
+    assert 'test_seconds_bucket{le="0.005"} 1' in lines
+    assert 'test_seconds_bucket{le="0.025"} 2' in lines
+    assert 'test_seconds_bucket{le="10.0"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_count 3' in lines
+
+
+def test_info_request_is_logged_with_the_timings_of_its_response(caplog):
+    import logging
+    from openods import app
+    client = app.test_client()
+
+    with caplog.at_level(logging.INFO):
+        client.get('/api/info?metricsTest=1')
+
+    lines = [record.getMessage() for record in caplog.records
+             if record.getMessage().startswith('logType=Request') and 'path="/api/info"' in record.getMessage()]
+
+    assert len(lines) == 1
+    assert 'cache=miss|' in lines[0] or 'cache=disabled|' in lines[0]
+    assert 'dbQueries=0|' not in lines[0]
@@ -17,3 +17,9 @@ def test_database_url_is_not_none():
     from openods import app
     value = app.config['DATABASE_URL']
     assert value is not None
+
+
+def test_database_pool_max_connections_is_at_least_min_connections():
+    from openods import app
+    assert app.config['DATABASE_POOL_MIN_CONNECTIONS'] >= 0
+    assert app.config['DATABASE_POOL_MAX_CONNECTIONS'] >= max(1, app.config['DATABASE_POOL_MIN_CONNECTIONS'])
@@ -0,0 +1,58 @@
+import psycopg2
+import psycopg2.extras
+import pytest
+
+
+def test_statement_text_depends_only_on_the_filters_used():
+    from openods import query_builder
+
+    clinics = query_builder.org_list_filter(query='clinic', active='true', role_code_list=['RO198'])
+    wards = query_builder.org_list_filter(query='ward', active='false', role_code_list=['RO197', 'RO198'])
+    any_name = query_builder.org_list_filter(active='true', role_code_list=['RO198'])
+
+    assert clinics.sql == wards.sql
+    assert clinics.params == ['%CLINIC%', 'Active', ['RO198']]
+    assert any_name.sql != clinics.sql
+
+
+def test_placeholders_are_numbered_for_prepare():
+    from openods import query_builder
+
+    query = query_builder.Query("SELECT %s, '100%%'", 1).add("WHERE a = %s AND b = %s", 2, 3)
+
+    assert query.numbered_sql() == "SELECT $1, '100%' WHERE a = $2 AND b = $3"
+
+
+def test_fragments_must_have_a_parameter_for_each_placeholder():
+    from openods import query_builder
+
+    with pytest.raises(ValueError):
+        query_builder.Query("WHERE name LIKE %s")
+
+
+def test_list_statements_are_prepared_once_per_connection():
+    from openods import app, query_builder
+
+    conn = psycopg2.connect(app.config['DATABASE_URL'])
+
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        pages = [query_builder.org_list_page(query_builder.org_list_filter(query=term, active='true'), 0, 5)
+                 for term in ('clinic', 'centre', 'clinic')]
+
+        results = []
+
+        for page in pages:
+            query_builder.execute(cur, page)
+            results.append(cur.fetchall())
+
+        cur.execute("SELECT COUNT(*) FROM pg_prepared_statements;")
+        assert cur.fetchone()['count'] == 1
+
+        query_builder.execute(cur, pages[0], prepare=False)
+        assert results[0] == results[2] == cur.fetchall()
+        assert all('CENTRE' in row['name'] for row in results[1])
+    finally:
+        conn.rollback()
+        conn.close()
@@ -10,3 +10,21 @@ def test_method_converts_dict_to_piped_kv_pairs():
     }
     result = request_utils.dict_to_piped_kv_pairs(input_dict)
     assert result == 'limit=1000|postCode=AB13DF|q=search term|'
+
+
+def test_cursor_round_trips_name_and_ods_code():
+    from openods import request_utils
+    cursor = request_utils.encode_cursor('PLATT BRIDGE CLINIC', 'RRF12')
+    assert request_utils.decode_cursor(cursor) == ('PLATT BRIDGE CLINIC', 'RRF12')
+
+
+def test_cursor_round_trips_missing_name():
+    from openods import request_utils
+    cursor = request_utils.encode_cursor(None, 'RRF12')
+    assert request_utils.decode_cursor(cursor) == (None, 'RRF12')
+
+
+def test_invalid_cursor_raises_value_error():
+    from openods import request_utils
+    with pytest.raises(ValueError):
+        request_utils.decode_cursor('not-a-cursor')
@@ -0,0 +1,74 @@
+import datetime
+import json
+
+import pytest
+
+from openods import serializer
+
+
+@pytest.fixture(params=['orjson', 'ujson', 'json'])
+def backend(request, monkeypatch):
+    if request.param != 'json' and getattr(serializer, request.param) is None:
+        pytest.skip(str.format('{0} is not installed', request.param))
+
+    if request.param == 'ujson' and not serializer.accepts_default(serializer.ujson):
+        pytest.skip('the installed ujson is too old')
+
+    monkeypatch.setattr(serializer, '_backend', request.param)
+    return request.param
+
+
+def test_dates_are_written_in_iso_format(backend):
+    document = {'date': datetime.date(2001, 4, 1), 'time': datetime.datetime(2017, 6, 29, 13, 39, 42)}
+
+    assert json.loads(serializer.dumps(document).decode('utf-8')) == {
+        'date': '2001-04-01',
+        'time': '2017-06-29T13:39:42'
+    }
+
+
+def test_fragments_are_copied_in_as_they_are(backend):
+    document = {'organisations': {'RRF12': serializer.Fragment('{"name":"PLATT BRIDGE CLINIC"}'), 'NOPE': None}}
+
+    output = serializer.dumps(document, pretty=True)
+
+    assert b'{"name":"PLATT BRIDGE CLINIC"}' in output
+    assert json.loads(output.decode('utf-8')) == {
+        'organisations': {'RRF12': {'name': 'PLATT BRIDGE CLINIC'}, 'NOPE': None}
+    }
+
+
+def test_standard_library_output_matches_jsonify(monkeypatch):
+    from flask import jsonify
+    from openods import app
+
+    monkeypatch.setattr(serializer, '_backend', 'json')
+    document = {'b': [1, {'c': 'd'}], 'a': 'é'}
+
+    with app.test_request_context('/'):
+        assert serializer.json_response(document).get_data() == jsonify(document).get_data()
+
+
+class EncoderWithoutDefault(object):
+    """
+    Stands in for the releases of ujson whose dumps doesn't take the default argument
+    """
+
+    @staticmethod
+    def dumps(obj, sort_keys=False, indent=0, ensure_ascii=True, escape_forward_slashes=True):
+        return json.dumps(obj)
+
+
+def test_ujson_is_only_chosen_if_it_takes_the_default_argument(monkeypatch):
+    from openods import app
+
+    monkeypatch.setattr(serializer, 'orjson', None)
+    monkeypatch.setattr(serializer, 'ujson', EncoderWithoutDefault)
+
+    monkeypatch.setitem(app.config, 'JSON_SERIALIZER', 'auto')
+    assert serializer.get_backend() == 'json'
+
+    monkeypatch.setitem(app.config, 'JSON_SERIALIZER', 'ujson')
+    assert serializer.get_backend() == 'json'
+
+    assert serializer.accepts_default(json)
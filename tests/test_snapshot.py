@@ -0,0 +1,133 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def dataset_snapshot():
+    from openods import app, connection, dataset, snapshot
+
+    with app.app_context():
+        with connection.borrow_connection() as conn:
+            version = dataset.get_dataset_version(conn.cursor())
+            loaded = snapshot.Snapshot(version).load(conn)
+            conn.rollback()
+
+    return loaded
+
+
+def test_token_index_candidates_include_every_substring_match():
+    from openods import snapshot
+
+    index = snapshot.TokenIndex()
+    index.add(1, 'PLATT BRIDGE CLINIC')
+    index.add(2, 'ORRELL CLINIC')
+    index.add(3, 'BRYAN HOUSE')
+
+    assert index.candidates('LINI') == {1, 2}
+    assert index.candidates('TT BRIDGE CL') == {1}
+    assert index.candidates('L CLINIC') == {2}
+    assert index.candidates('%HOUSE') is None
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'limit': 3, 'offset': 2},
+    {'query': 'clinic'},
+    {'query': 'ic c'},
+    {'postcode': 'wn2'},
+    {'recordclass': 'HSCSite', 'active': 'true'},
+    {'active': 'false'},
+    {'role_code_list': ['RO198']},
+    {'primary_role_code_list': ['RO198'], 'legally_active': 'true'},
+    {'last_updated_since': '2014-01-01'},
+    {'limit': 4, 'after': ('HINDLEY HEALTH CENTRE', 'RRF26')},
+    {'limit': 4, 'after': ('HINDLEY', 'RRF00')},
+    {'limit': 4, 'after': (None, 'RRF00')},
+])
+def test_snapshot_filters_organisations_the_same_as_the_database(dataset_snapshot, filters):
+    from openods import app, db
+
+    offset = filters.pop('offset', 0)
+    limit = filters.pop('limit', 20)
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        db_rows, db_count = db.query_org_list(offset, limit,
+                                              filters.get('recordclass'), filters.get('primary_role_code_list'),
+                                              filters.get('role_code_list'), filters.get('query'),
+                                              filters.get('postcode'), filters.get('active'),
+                                              filters.get('last_updated_since'), filters.get('legally_active'),
+                                              filters.get('after'), 'exact', False)
+
+    snapshot_rows, snapshot_count = dataset_snapshot.find_organisations(offset, limit, **filters)
+
+    assert snapshot_count == db_count
+    assert [row['odscode'] for row in snapshot_rows] == [row['odscode'] for row in db_rows]
+
+
+def test_keys_are_only_bisected_when_ordered_by_code_point():
+    from openods import snapshot
+
+    assert snapshot.ordered_keys([('BRYAN HOUSE', 'RRF01'), ('CHILD & FAMILY', 'RRF16'), ('CHILDCARE', 'RRF02')])
+    # The order of a collation such as en_US, which passes over spaces and punctuation
+    assert snapshot.ordered_keys([('CHILDCARE', 'RRF02'), ('CHILD & FAMILY', 'RRF16')]) is None
+
+
+def test_cursor_from_a_removed_organisation_is_read_from_the_database(dataset_snapshot, monkeypatch):
+    from openods import app, db, snapshot
+
+    after = ('HINDLEY', 'RRF00')
+
+    # As if the database collation didn't order names by code point
+    monkeypatch.setattr(dataset_snapshot, '_keys', None)
+    monkeypatch.setattr(snapshot, 'get_snapshot', lambda: dataset_snapshot)
+
+    assert dataset_snapshot.find_organisations(0, 4, after=after) is None
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        rows, count, _ = db.get_org_list(0, 4, recordclass=None, active=None, after=after)
+        db_rows, db_count = db.query_org_list(0, 4, None, None, None, None, None, None, None, None, after, 'exact',
+                                              False)
+
+    assert count == db_count
+    assert [row['odsCode'] for row in rows] == [row['odscode'] for row in db_rows]
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'query': 'clinic'},
+    {'active': 'false'},
+    {'role_code_list': ['RO198'], 'postcode': 'wn2'},
+])
+def test_snapshot_counts_facets_the_same_as_the_database(dataset_snapshot, filters):
+    from openods import app, db
+
+    facets = ['recordClass', 'status', 'primaryRoleCode']
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        db_counts = db.get_org_facets(facets, **filters)
+
+    snapshot_counts = dataset_snapshot.count_facets(facets, **filters)
+
+    assert {facet: {item['value']: item['count'] for item in items} for facet, items in db_counts.items()} == \
+        snapshot_counts
+
+
+def test_snapshot_returns_organisation_rows_the_same_as_the_database(dataset_snapshot):
+    from openods import app, connection, db
+
+    with app.test_request_context('/'):
+        from flask import g
+        g.request_id = 'test'
+
+        db_rows = db.fetch_organisation_rows_single_query(connection.get_cursor(), 'RRF12')
+
+    assert dataset_snapshot.fetch_organisation_rows('rrf12') == db_rows
+    assert dataset_snapshot.fetch_organisation_rows('NOPE') is None
@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture
+def unchecked_schema(monkeypatch):
+    from openods import schema_check
+    monkeypatch.setattr(schema_check, '_status', {'checked': False})
+    return schema_check
+
+
+def test_failed_schema_check_is_reported_rather_than_fatal(unchecked_schema, monkeypatch):
+    calls = []
+
+    def failing_check():
+        calls.append(1)
+        raise RuntimeError('Incorrect database schema version. Wanted 015, Got 014')
+
+    monkeypatch.setattr(unchecked_schema, 'check_schema_version', failing_check)
+
+    status = unchecked_schema.ensure_schema_checked()
+    unchecked_schema.ensure_schema_checked()
+
+    assert status['checked'] and not status['ok']
+    assert 'Wanted 015' in unchecked_schema.get_schema_status()['error']
+    assert len(calls) == 1
+
+
+def test_schema_check_passes_against_the_sample_database(unchecked_schema):
+    assert unchecked_schema.ensure_schema_checked()['ok']
+
+
+def test_api_spec_is_built_once_even_in_debug_mode(monkeypatch):
+    from openods import app
+
+    monkeypatch.setattr(app, 'debug', True)
+
+    with app.test_request_context('/'):
+        assert app.swag.get_apispecs() is app.swag.get_apispecs()
+
+
+def test_startup_time_is_reported():
+    from openods import app
+
+    body = app.test_client().get('/api/v1/metrics').get_data(as_text=True)
+
+    assert 'openods_startup_seconds ' in body